@@ -1,9 +1,8 @@
 import streamlit as st
-# --- 导入所有视图模块 ---
-import views_dashboard
-import views_input
-import views_bot
-import views_admin  # <--- [新增] 必须导入这个新文件！
+import importlib
+import sys
+import time
+import query_profiler
 
 # 1. 页面配置
 st.set_page_config(page_title="FCO Cloud ERP", layout="wide", initial_sidebar_state="expanded")
@@ -22,21 +21,46 @@ st.markdown("""
 # 3. 侧边栏导航
 st.sidebar.title("🌲 FCO Cloud ERP")
 
-# 4. 定义页面映射
-# [新增] 在字典最后加入 "⚙️ Admin Settings"
+# 4. 定义页面映射 (懒加载)
+# 每个页面: (模块名, 函数名, 参数)。只有被选中的页面才会 import 对应模块，
+# 所以打开 Dashboard 时不会加载 Invoice Bot 的 google.generativeai 等重量级依赖。
 pages = {
-    "Dashboard": views_dashboard.view_dashboard,
-    "1. Log Sales Data": views_input.view_log_sales,
-    "2. Budget Planning": lambda: views_input.view_monthly_input("Budget"),
-    "3. Actuals Entry": lambda: views_input.view_monthly_input("Actual"),
-    "4. Analysis & Invoice": views_dashboard.view_analysis_invoice,
-    "5. 3rd Party Invoice Check": views_bot.view_invoice_bot,
-    "6. 🛠️ DEBUG MODELS": views_bot.view_debug_models,
-    "⚙️ Admin Settings": views_admin.view_admin_upload  # <--- [新增] 这一行让菜单显示出来
+    "Dashboard": ("views_dashboard", "view_dashboard", ()),
+    "1. Log Sales Data": ("views_input", "view_log_sales", ()),
+    "2. Budget Planning": ("views_input", "view_monthly_input", ("Budget",)),
+    "3. Actuals Entry": ("views_input", "view_monthly_input", ("Actual",)),
+    "4. Analysis & Invoice": ("views_dashboard", "view_analysis_invoice", ()),
+    "5. 3rd Party Invoice Check": ("views_bot", "view_invoice_bot", ()),
+    "6. 🛠️ DEBUG MODELS": ("views_bot", "view_debug_models", ()),
+    "7. ⏱️ Query Profiler": ("views_admin", "view_query_profiler", ()),
+    "⚙️ Admin Settings": ("views_admin", "view_admin_upload", ()),
+    "⚙️ Budget Workbook Import": ("views_admin", "view_budget_import", ()),
+    "⚙️ Analytics Snapshot": ("views_admin", "view_snapshot_admin", ()),
 }
 
+@st.cache_resource
+def _import_times():
+    """{模块名: 首次 import 耗时 (秒)}，整个进程共享"""
+    return {}
+
+def load_page(module_name, func_name):
+    if module_name not in sys.modules:
+        t0 = time.perf_counter()
+        importlib.import_module(module_name)
+        _import_times()[module_name] = time.perf_counter() - t0
+    return getattr(sys.modules[module_name], func_name)
+
 # 5. 渲染导航栏
 selection = st.sidebar.radio("Navigate", list(pages.keys()))
 
-# 6. 执行选中的页面
-pages[selection]()
\ No newline at end of file
+# 6. 执行选中的页面 (整个 rerun 的查询 / AI 调用都记录到 profile)
+module_name, func_name, args = pages[selection]
+trace = query_profiler.start_rerun(selection)
+try:
+    load_page(module_name, func_name)(*args)
+finally:
+    query_profiler.finish_rerun(trace, st.session_state.setdefault("_profile_history", []))
+
+with st.sidebar.expander("⏱️ Module Load Times"):
+    for name, secs in _import_times().items():
+        st.caption(f"`{name}`: {secs * 1000:.0f} ms")
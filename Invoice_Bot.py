@@ -1,130 +1,171 @@
-import streamlit as st
-import pandas as pd
+"""
+发票批量对账 (无界面)：识别一个文件夹里的所有 PDF，与 ERP Actual 成本对账，输出对账 CSV 和耗时统计。
+识别 / 对账 / 重复检测与 Invoice Bot 页面 (views_bot) 走同一套引擎：
+    invoice_jobs (队列 + worker 并发) -> backend.real_extract_invoice_data -> backend.reconcile_invoices
+
+    python Invoice_Bot.py invoices/ --out reconciliation.csv
+    python Invoice_Bot.py invoices/ --offline --ai-latency 1.5 --workers 8 --stats-json stats.json
+
+默认读取 .streamlit/secrets.toml 里的 Supabase / Google 配置；--offline 时使用本地替身
+(benchmarks.fake_gemini + 种子数据的 FakeSupabase)，不需要网络和 API Key，适合夜间审计演练和性能回归。
+"""
+import argparse
+import json
+import statistics
+import sys
+import tempfile
 import time
-import random
-from supabase import create_client
-
-# --- 1. 配置 ---
-st.set_page_config(page_title="🧾 Invoice 3rd Party Check", layout="wide")
-
-st.markdown("""
-<style>
-    .match { color: green; font-weight: bold; }
-    .mismatch { color: red; font-weight: bold; }
-    .stDataFrame { border: 1px solid #ccc; }
-</style>
-""", unsafe_allow_html=True)
-
-# 独立连接 Supabase (复用 secrets)
-@st.cache_resource
-def init_connection():
-    try:
-        return create_client(st.secrets["supabase"]["url"], st.secrets["supabase"]["key"])
-    except: return None
+from pathlib import Path
+
+import pandas as pd
+import streamlit.config
+import streamlit.logger
+
+# 无界面运行时 st.cache_data / session_state 会打印 "bare mode" 警告。
+# 先解析配置 (解析时会按配置重设日志级别)，再调低级别，之后导入 backend 时就不会再输出
+streamlit.config.get_config_options()
+streamlit.logger.set_log_level("error")
+
+import backend
+import blob_store
+import db_client
+import invoice_jobs
 
-supabase = init_connection()
+DEFAULT_WORKERS = 4
+POLL_SECONDS = 0.2
+CSV_COLS = ["File", "Vendor", "Date", "Desc", "Inv #", "Inv Amount", "ERP Amount", "Diff", "Status", "Duplicate", "Error"]
 
-# --- 2. 模拟 AI 识别 (Mock OCR) ---
-def mock_extract_invoice_data(file_obj):
+
+# --- 1. 环境 (真实 / 离线替身) ---
+def install_offline(fake_model, fake_db, ai_latency, db_latency, seed_scale):
+    if fake_model:
+        from benchmarks import fake_gemini
+        fake_gemini.install(backend, latency_s=ai_latency)
+    if fake_db:
+        from benchmarks import seed
+        from benchmarks.fake_supabase import FakeSupabase
+        raw = FakeSupabase()
+        seed.seed(raw, seed_scale)
+        raw.latency_s = db_latency  # 种子写入不计延迟
+        backend.supabase = db_client.DataClient(raw)
+
+
+def use_private_queue(workdir):
     """
-    模拟调用 Gemini/GPT 读取 PDF。
-    在真实场景中，这里会调用 google-generativeai 库。
+    队列和 blob 放在本次运行的临时目录：不与正在运行的 Streamlit 应用共享 worker (否则双方会互相领取对方的文件)，
+    运行结束后连同 PDF 副本一起删除。
     """
-    time.sleep(1.5) # 假装在思考
-    
-    # 随机生成一些识别结果用于演示
-    filename = file_obj.name
-    predicted_amount = random.randint(1000, 20000)
-    vendor = "Unknown"
-    
-    if "Road" in filename: vendor = "Road Maintenance"
-    elif "Harv" in filename: vendor = "Groundbase Harvesting"
-    elif "Truck" in filename: vendor = "Cartage"
-    
+    invoice_jobs.JOBS_DB = Path(workdir) / "jobs.sqlite"
+    blob_store.BLOB_DIR = Path(workdir) / "blobs"
+
+
+def find_pdfs(folder, recursive=False):
+    pattern = "**/*" if recursive else "*"
+    return sorted(p for p in Path(folder).glob(pattern) if p.is_file() and p.suffix.lower() == ".pdf")
+
+
+# --- 2. 识别 + 对账 ---
+def run_batch(paths, workers, progress=True):
+    """返回 (对账行 DataFrame, 每个文件的耗时列表, 识别阶段耗时, 对账阶段耗时)"""
+    t0 = time.perf_counter()
+    files = []
+    try:
+        for p in paths: files.append(open(p, "rb"))
+        job_id = invoice_jobs.submit([(p.name, f) for p, f in zip(paths, files)], owner="cli", workers=workers)
+    finally:
+        for f in files: f.close()
+
+    last = None
+    while True:
+        status = invoice_jobs.job_status(job_id)
+        done = status["done"] + status["failed"] + status["cancelled"]
+        if progress and done != last:
+            print(f"  extracted {done}/{status['total']} files", file=sys.stderr)
+            last = done
+        if status["finished"]: break
+        time.sleep(POLL_SECONDS)
+    invoice_jobs.stop_workers()
+    t_extract = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    results = invoice_jobs.job_results(job_id)
+    rows = backend.reconcile_invoices(results)
+    t_reconcile = time.perf_counter() - t0
+
+    df = pd.DataFrame(rows, columns=[c for c in CSV_COLS if c != "Error"])
+    df["Error"] = [item.get("error_msg", "") for item in results]
+    return df[CSV_COLS], invoice_jobs.file_timings(job_id), t_extract, t_reconcile
+
+
+def summarize(df, timings, t_extract, t_reconcile, workers):
+    per_file = sorted(t["seconds"] for t in timings if t["seconds"] is not None)
+    total = t_extract + t_reconcile
     return {
-        "filename": filename,
-        "vendor_detected": vendor,
-        "invoice_no": f"INV-{random.randint(10000,99999)}",
-        "date_detected": "2025-01-15",
-        "amount_detected": float(predicted_amount)
+        "files": len(timings),
+        "files_failed": sum(t["status"] != "done" for t in timings),
+        "invoices": int((df["Status"] != "❌ AI Error").sum()),
+        "status": {k: int(v) for k, v in df["Status"].value_counts().items()},
+        "duplicates": int((df["Duplicate"] != "").sum()),
+        "workers": workers,
+        "extract_seconds": round(t_extract, 3),
+        "reconcile_seconds": round(t_reconcile, 3),
+        "total_seconds": round(total, 3),
+        "files_per_minute": round(len(timings) / total * 60, 1) if total else None,
+        "file_seconds_p50": round(statistics.median(per_file), 3) if per_file else None,
+        "file_seconds_p95": round(per_file[min(len(per_file) - 1, int(len(per_file) * 0.95))], 3) if per_file else None,
+        "file_seconds_max": round(per_file[-1], 3) if per_file else None,
+        # 逐个文件串行处理的估计耗时 / 实际识别耗时
+        "concurrency_speedup": round(sum(per_file) / t_extract, 2) if per_file and t_extract else None,
     }
 
-# --- 3. 界面逻辑 ---
-st.title("🤖 3rd Party Invoice Reconciliation Bot")
-st.caption("Upload contractor invoices (PDF) to verify against Actual Costs in ERP.")
-
-col_upload, col_review = st.columns([1, 2])
-
-with col_upload:
-    st.subheader("1. Upload Invoices")
-    uploaded_files = st.file_uploader("Drag PDFs here", type=["pdf"], accept_multiple_files=True)
-    
-    if uploaded_files:
-        st.success(f"Loaded {len(uploaded_files)} files.")
-        if st.button("🚀 Start AI Analysis"):
-            results = []
-            progress_bar = st.progress(0)
-            
-            for i, file in enumerate(uploaded_files):
-                data = mock_extract_invoice_data(file)
-                results.append(data)
-                progress_bar.progress((i + 1) / len(uploaded_files))
-            
-            st.session_state['ocr_results'] = results
-            st.success("Analysis Complete!")
-
-with col_review:
-    st.subheader("2. Reconciliation Review")
-    
-    if 'ocr_results' in st.session_state:
-        results = st.session_state['ocr_results']
-        
-        # 准备对比表格
-        reconcile_data = []
-        
-        for item in results:
-            # 1. 尝试去数据库找匹配的费用
-            # 这里简单匹配: 找 2025-01-01 的 Actual Cost，且 Activity Name 包含识别出的 Vendor
-            match_status = "❌ Not Found"
-            db_amount = 0
-            diff = 0
-            
-            if supabase:
-                # 查询 dim_cost_activities 获取 ID
-                acts = supabase.table("dim_cost_activities").select("id").ilike("activity_name", f"%{item['vendor_detected']}%").execute().data
-                if acts:
-                    act_id = acts[0]['id']
-                    # 查询 fact_operational_costs
-                    costs = supabase.table("fact_operational_costs").select("total_amount")\
-                        .eq("activity_id", act_id)\
-                        .eq("month", "2025-01-01")\
-                        .eq("record_type", "Actual").execute().data
-                    
-                    if costs:
-                        db_amount = costs[0]['total_amount']
-                        diff = item['amount_detected'] - db_amount
-                        if abs(diff) < 1.0: match_status = "✅ Match"
-                        else: match_status = "⚠️ Variance"
-            
-            reconcile_data.append({
-                "Invoice File": item['filename'],
-                "Vendor (AI)": item['vendor_detected'],
-                "Inv #": item['invoice_no'],
-                "Inv Amount": item['amount_detected'],
-                "ERP Amount": db_amount,
-                "Diff": diff,
-                "Status": match_status
-            })
-            
-        df_rec = pd.DataFrame(reconcile_data)
-        
-        # 样式化显示
-        st.dataframe(
-            df_rec.style.applymap(
-                lambda x: 'color: red' if 'Variance' in str(x) else ('color: green' if 'Match' in str(x) else ''),
-                subset=['Status']
-            ),
-            use_container_width=True
-        )
-        
-        st.info("⚠️ 'Variance' indicates the invoice amount differs from what was entered in the Actuals Entry page.")
\ No newline at end of file
+
+# --- 3. 命令行 ---
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Headless batch invoice reconciliation")
+    ap.add_argument("folder", help="folder containing invoice PDFs")
+    ap.add_argument("--out", default="reconciliation.csv", help="reconciliation CSV path")
+    ap.add_argument("--stats-json", help="also write timing stats to this JSON file")
+    ap.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="files processed concurrently")
+    ap.add_argument("--recursive", action="store_true", help="include PDFs in sub-folders")
+    ap.add_argument("--offline", action="store_true", help="fake model + seeded fake database (no network)")
+    ap.add_argument("--fake-model", action="store_true", help="use the fake Gemini model only")
+    ap.add_argument("--fake-db", action="store_true", help="use the seeded fake database only")
+    ap.add_argument("--ai-latency", type=float, default=0.0, help="fake model seconds per call")
+    ap.add_argument("--db-latency", type=float, default=0.0, help="fake database seconds per request")
+    ap.add_argument("--seed-scale", default="1k", help="fake database seed scale")
+    ap.add_argument("--quiet", action="store_true")
+    args = ap.parse_args(argv)
+
+    paths = find_pdfs(args.folder, args.recursive)
+    if not paths:
+        print(f"No PDFs found in {args.folder}", file=sys.stderr)
+        return 2
+
+    install_offline(args.offline or args.fake_model, args.offline or args.fake_db,
+                    args.ai_latency, args.db_latency, args.seed_scale)
+    if not backend.supabase:
+        print("Supabase is not configured (.streamlit/secrets.toml); use --offline or --fake-db", file=sys.stderr)
+        return 2
+    if not backend.check_google_key():
+        print("Google API key is not configured (.streamlit/secrets.toml); use --offline or --fake-model", file=sys.stderr)
+        return 2
+
+    with tempfile.TemporaryDirectory(prefix="fco_invoice_bot_") as workdir:
+        use_private_queue(workdir)
+        df, timings, t_extract, t_reconcile = run_batch(paths, args.workers, progress=not args.quiet)
+
+    df.to_csv(args.out, index=False)
+    stats = summarize(df, timings, t_extract, t_reconcile, args.workers)
+    if args.stats_json: Path(args.stats_json).write_text(json.dumps(stats, indent=2, ensure_ascii=False))
+
+    print(f"{stats['files']} files ({stats['files_failed']} failed), {stats['invoices']} invoices -> {args.out}")
+    print("  " + ", ".join(f"{k}: {v}" for k, v in stats["status"].items()) + f", duplicates: {stats['duplicates']}")
+    print(f"  extract {stats['extract_seconds']:.2f}s ({args.workers} workers, {stats['concurrency_speedup']}x vs serial), "
+          f"reconcile {stats['reconcile_seconds']:.2f}s, total {stats['total_seconds']:.2f}s, "
+          f"{stats['files_per_minute']} files/min")
+    print(f"  per file p50 {stats['file_seconds_p50']}s, p95 {stats['file_seconds_p95']}s, max {stats['file_seconds_max']}s")
+    return 1 if stats["files_failed"] or stats["status"].get("❌ AI Error") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
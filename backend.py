@@ -1,61 +1,290 @@
 import streamlit as st
 import pandas as pd
-from supabase import create_client
-import google.generativeai as genai  # <--- 改回使用这个标准库，兼容性最好
+import numpy as np
+import db_client
+import query_profiler
+import io
 import json
 import time
 import re
+import threading
+import contextvars
+from datetime import date
+from difflib import SequenceMatcher
+from concurrent.futures import ThreadPoolExecutor
 
 # --- A. 数据库连接 ---
+# 整个进程共用一个带连接池 / 重试 / 熔断的客户端 (见 db_client.py)
 @st.cache_resource
 def init_connection():
     try:
-        if "supabase" in st.secrets:
-            return create_client(st.secrets["supabase"]["url"], st.secrets["supabase"]["key"])
-    except: return None
-    return None
+        if "supabase" not in st.secrets: return None
+        cfg = st.secrets["supabase"]
+    except Exception as e:
+        print(f"Supabase secrets not available: {e}")
+        return None
+    try:
+        return db_client.create_data_client(cfg["url"], cfg["key"])
+    except Exception as e:
+        print(f"Supabase connection error: {e}")
+        return None
 
 supabase = init_connection()
 
+# --- A2. 数据版本总线 (每次写入递增，作为缓存 key 的一部分) ---
+# 版本按 (table, forest, year, month) 分层记录：写入某林地某月，只会让
+# 读取该月 / 该年 / 该林地 / 整张表的缓存失效，其它林地和月份的缓存继续有效。
+# 写入范围未知时 (例如没有 forest_id) 记为通配，所有更细的读取都会失效。
+
+@st.cache_resource
+def _data_versions():
+    return {"global": 0, "keys": {}, "wild": {}, "lock": threading.Lock()}
+
+def _scope_key(table, forest_id=None, year=None, month=None):
+    if month is not None: year = str(month)[:4]
+    key = (table,)
+    for part in (forest_id, year, month):
+        if part is None: break
+        key += (str(part),)
+    return key
+
+def bump_data_version(table=None, forest_id=None, year=None, month=None):
+    """写入后调用。table 为 None 时表示范围未知，所有缓存都会失效"""
+    reg = _data_versions()
+    with reg["lock"]:
+        reg["global"] += 1
+        v = reg["global"]
+        if table is None:
+            reg["wild"][()] = v
+            return v
+        key = _scope_key(table, forest_id, year, month)
+        for i in range(1, len(key) + 1):
+            reg["keys"][key[:i]] = v
+        reg["wild"][key] = v
+        return v
+
+def get_data_version(table=None, forest_id=None, year=None, month=None):
+    """
+    不带参数：全局版本 (任何写入都会变化)。
+    带参数：最近一次影响该读取范围的写入版本 —— 包括更细粒度的写入，以及更粗粒度的通配写入。
+    """
+    reg = _data_versions()
+    if table is None: return reg["global"]
+    key = _scope_key(table, forest_id, year, month)
+    versions = [reg["keys"].get(key, 0), reg["wild"].get((), 0)]
+    versions += [reg["wild"].get(key[:i], 0) for i in range(1, len(key))]
+    return max(versions)
+
+def data_token(*scopes):
+    """多个读取范围的版本组合成一个 token，例如 data_token(("fact_operational_costs", fid, 2025))"""
+    return tuple(get_data_version(*scope) for scope in scopes)
+
+def bump_for_records(table_name, records, date_col="month"):
+    """根据写入记录里的 forest_id / 日期列，精确地 bump 受影响的 (table, forest, month)"""
+    scopes = set()
+    for r in records:
+        d = r.get(date_col)
+        scopes.add((r.get("forest_id"), f"{str(d)[:7]}-01" if d else None))
+    if not scopes: bump_data_version(table_name)
+    for forest_id, month in scopes:
+        bump_data_version(table_name, forest_id, month=month)
+
+# --- A3. 会话级查询缓存 (跨 Streamlit rerun) ---
+MEMO_MAX_ENTRIES = 32
+
+def memo_query(name, params, loader, scopes=None):
+    """
+    按 (name, params) 把查询结果缓存在当前会话的 session_state 中，并记录数据版本。
+    Streamlit 每次交互都会重跑整个脚本；只要查询参数没变、期间也没有写入，就直接复用上次结果。
+    scopes 为读取范围列表 (见 data_token)；不传时使用全局版本。
+    """
+    store = st.session_state.setdefault("_query_memo", {})
+    key = (name, params)
+    version = data_token(*scopes) if scopes else get_data_version()
+    hit = store.get(key)
+    if hit is not None and hit[0] == version:
+        return hit[1]
+
+    value = loader()
+    store.pop(key, None)
+    store[key] = (version, value)
+    while len(store) > MEMO_MAX_ENTRIES:
+        store.pop(next(iter(store)))  # dict 保持插入顺序，最早的先淘汰
+    return value
+
+# --- A4. 列投影 + 统一 dtype (替代 select("*")) ---
+# 每个调用处声明自己需要的列，只把这些列拉回来；建 DataFrame 时按 TABLE_SCHEMA 一次性定好类型。
+# 嵌入列写作 "dim_products(grade_code)"，返回时直接展平成 grade_code 列。
+# compact=True 用于只读分析 (Dashboard / Analysis / 预测)：名称类列转 category，吨数/数量转 float32。
+# 金额和单价始终 float64 (发票合计要精确到分)；可编辑表格 (data_editor) 用 compact=False，避免 category 限制输入。
+TABLE_SCHEMA = {
+    "dim_forests": {"id": "int64", "name": "str"},
+    "dim_products": {"id": "int64", "grade_code": "str", "market": "str", "customer": "str"},
+    "dim_cost_activities": {"id": "int64", "activity_name": "str"},
+    "dim_gl_mappings": {"id": "int64", "forest_id": "int64", "item_type": "str", "item_id": "int64", "gl_code": "str", "gl_name": "str"},
+    "fact_production_volume": {"id": "int64", "forest_id": "int64", "grade_id": "int64", "month": "str", "record_type": "str",
+                               "vol_tonnes": "qty", "vol_jas": "qty", "price_jas": "float64", "amount": "float64",
+                               "market": "str", "customer": "str"},
+    "fact_operational_costs": {"id": "int64", "forest_id": "int64", "activity_id": "int64", "month": "str", "record_type": "str",
+                               "quantity": "qty", "unit_rate": "float64", "total_amount": "float64"},
+    "actual_sales_transactions": {"id": "int64", "forest_id": "int64", "date": "str", "ticket_number": "str", "compartment": "str",
+                                  "sale_type": "str", "grade_id": "Int64", "customer": "str", "market": "str",
+                                  "net_tonnes": "qty", "jas": "qty", "price": "float64", "levy_deduction": "float64", "total_value": "float64"},
+    "invoice_archive": {"id": "int64", "invoice_no": "str", "vendor": "str", "invoice_date": "str", "description": "str",
+                        "amount": "float64", "file_name": "str", "file_url": "str", "status": "str", "created_at": "str"},
+}
+# 可选列：旧库 / 部分部署没有，select 时先试着带上，PostgREST 报列不存在后本进程内不再请求 (见 fetch_frame_optional)
+OPTIONAL_COLS = {
+    "dim_products": ["market", "customer"],
+    "fact_production_volume": ["market", "customer"],
+}
+CATEGORY_COLS = {"name", "grade_code", "activity_name", "record_type", "market", "sale_type", "customer", "compartment", "item_type", "status"}
+
+# 常用的列组合
+VOLUME_VALUE_COLS = ['vol_tonnes', 'vol_jas', 'price_jas', 'amount']
+COST_VALUE_COLS = ['quantity', 'unit_rate', 'total_amount']
+SALES_COLS = ['id', 'date', 'ticket_number', 'compartment', 'sale_type', 'grade_id', 'customer', 'market',
+              'net_tonnes', 'jas', 'price', 'levy_deduction', 'total_value']
+
+def schema_cols(table):
+    """TABLE_SCHEMA 里必定存在的列 (不含可选列)，整表同步 (快照) 用"""
+    optional = OPTIONAL_COLS.get(table, [])
+    return [c for c in TABLE_SCHEMA[table] if c not in optional]
+
+def _parse_col(col):
+    """'dim_products(grade_code)' -> ('dim_products', 'grade_code')；普通列 -> (None, col)"""
+    m = re.match(r'^(\w+)\((\w+)\)$', col)
+    return (m.group(1), m.group(2)) if m else (None, col)
+
+def select_cols(table, columns):
+    """拼 select 字符串，并校验列名 (拼错的列名在这里就报错，而不是等 PostgREST 返回 400)"""
+    known = TABLE_SCHEMA[table]
+    for col in columns:
+        rel, name = _parse_col(col)
+        if name not in (TABLE_SCHEMA[rel] if rel else known):
+            raise KeyError(f"{table}: unknown column {col!r}")
+    return ",".join(columns)
+
+def column_dtype(table, col, compact=False):
+    rel, name = _parse_col(col)
+    kind = TABLE_SCHEMA[rel or table][name]
+    if kind == "qty": return "float32" if compact else "float64"
+    if kind == "str": return "category" if compact and name in CATEGORY_COLS else "object"
+    return kind
+
+def typed_frame(rows, table, columns, compact=False):
+    """rows (PostgREST 返回的 list[dict]) -> DataFrame：列顺序固定、嵌入列展平、按 schema 定型；空结果也保留列"""
+    flat = [_parse_col(c) for c in columns]
+    if rows and any(rel for rel, _ in flat):
+        rows = [{**r, **{name: (r.get(rel) or {}).get(name) for rel, name in flat if rel}} for r in rows]
+    df = pd.DataFrame.from_records(rows or [], columns=[name for _, name in flat])
+    return cast_frame(df, table, columns, compact)
+
+def cast_frame(df, table, columns, compact=False):
+    """按 TABLE_SCHEMA 给已有 DataFrame 定型 (typed_frame 和 Parquet 快照共用)"""
+    for col in columns:
+        name = _parse_col(col)[1]
+        dtype = column_dtype(table, col, compact)
+        if dtype == "object" or name not in df.columns: continue
+        try: df[name] = df[name].astype(dtype)
+        except (TypeError, ValueError):
+            # 旧数据里有空值 / 非数字时退回宽松类型，不让整个页面报错
+            if dtype.startswith("float") or dtype.startswith("int"): df[name] = pd.to_numeric(df[name], errors='coerce')
+    return df
+
+def fetch_frame(table, columns, build=None, compact=False):
+    """
+    fetch_frame("fact_operational_costs", ["activity_id", "total_amount"], lambda q: q.eq("forest_id", fid))
+    build 接收 select 之后的查询对象，负责加过滤 / 排序；返回带类型的 DataFrame。
+    """
+    query = supabase.table(table).select(select_cols(table, columns))
+    if build: query = build(query)
+    return typed_frame(query.execute().data, table, columns, compact)
+
+_missing_optional = set()  # {(table, col)}：已确认不存在的可选列
+
+def fetch_frame_optional(table, columns, build=None, compact=False):
+    """fetch_frame + 表上的可选列 (OPTIONAL_COLS)；可选列不存在时只多一次请求，之后直接跳过"""
+    extra = [c for c in OPTIONAL_COLS.get(table, []) if c not in columns and (table, c) not in _missing_optional]
+    if extra:
+        try:
+            return fetch_frame(table, list(columns) + extra, build, compact)
+        except Exception as e:
+            if not any(c in str(e) for c in extra): raise
+            _missing_optional.update((table, c) for c in extra)
+    return fetch_frame(table, columns, build, compact)
+
+# --- A5. 并发查询 (互不依赖的查询同时发出，页面耗时接近最慢的一条而不是总和) ---
+# 工作线程里带上当前 Streamlit 脚本上下文 (session_state / cache_data 需要) 和 contextvars (查询 profiler)。
+FETCH_WORKERS = 8
+
+def _script_ctx_runner():
+    try:
+        from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+        ctx = get_script_run_ctx(suppress_warning=True)
+    except Exception:
+        ctx = None
+
+    def run(fn):
+        if ctx is not None: add_script_run_ctx(threading.current_thread(), ctx)
+        return fn()
+    return run
+
+def fetch_parallel(tasks, max_workers=FETCH_WORKERS):
+    """
+    并发执行互不依赖的查询：tasks 为 {name: 无参函数}，全部完成后返回 {name: 结果}。
+    任一任务出错时，等其它任务结束后抛出 (按 tasks 顺序) 第一个异常。只有一个任务时直接在当前线程执行。
+    """
+    if len(tasks) <= 1: return {k: fn() for k, fn in tasks.items()}
+    run = _script_ctx_runner()
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(tasks))) as pool:
+        futures = {k: pool.submit(contextvars.copy_context().run, run, fn) for k, fn in tasks.items()}
+    return {k: f.result() for k, f in futures.items()}
+
 # --- B. Google AI 检查 ---
 def check_google_key():
     return "google" in st.secrets and "api_key" in st.secrets["google"]
 
+def google_api_key():
+    return st.secrets["google"]["api_key"]
+
+def load_genai():
+    """延迟导入 google.generativeai：只有真正调用 AI 时才加载这个很重的库"""
+    import google.generativeai as genai  # <--- 改回使用这个标准库，兼容性最好
+    return genai
+
 # --- C. 核心数据函数 (保持不变) ---
 def get_forest_list():
     if not supabase: return []
-    try: return supabase.table("dim_forests").select("*").execute().data
-    except: return []
+    try: return supabase.table("dim_forests").select("id,name").execute().data
+    except Exception as e:
+        print(f"Forest list error: {e}")
+        return []
 
 def get_monthly_data(table_name, dim_table, dim_id_col, dim_name_col, forest_id, target_date, record_type, value_cols):
     if not supabase: return pd.DataFrame()
-    dims = supabase.table(dim_table).select("*").execute().data
-    df_dims = pd.DataFrame(dims)
+    # 维度表没有 dim_name_col 时退回 activity_name (与旧版 select("*") 时的行为一致)
+    name_col = dim_name_col if dim_name_col in TABLE_SCHEMA[dim_table] else 'activity_name'
+    df_dims = fetch_frame_optional(dim_table, ['id', name_col]).rename(columns={'id': dim_id_col, name_col: dim_name_col})
     if df_dims.empty: return pd.DataFrame()
-    
-    if dim_name_col not in df_dims.columns and 'activity_name' in df_dims.columns:
-        df_dims[dim_name_col] = df_dims['activity_name']
 
+    # 只取维度 ID + 数值列 (+ 表上存在的 market / customer)，按 dim_id_col 合并，不会再出现 id_x / id_y
     try:
-        res = supabase.table(table_name).select("*").eq("forest_id", forest_id).eq("record_type", record_type).eq("month", target_date).execute()
-        df_facts = pd.DataFrame(res.data)
-    except: df_facts = pd.DataFrame()
-    
-    if df_facts.empty:
-        cols_to_keep = ['id', dim_name_col]
-        if 'grade_code' in df_dims.columns: cols_to_keep.append('grade_code')
-        df_merged = df_dims[cols_to_keep].rename(columns={'id': dim_id_col})
-        for c in value_cols: df_merged[c] = 0.0
-    else:
-        df_merged = pd.merge(df_dims, df_facts, left_on='id', right_on=dim_id_col, how='left')
-        for c in value_cols: df_merged[c] = df_merged[c].fillna(0.0)
-    
-    df_merged = df_merged.loc[:, ~df_merged.columns.duplicated()]
-    df_merged = df_merged.reset_index(drop=True)
+        df_facts = fetch_frame_optional(table_name, [dim_id_col] + list(value_cols),
+                                        lambda q: q.eq("forest_id", forest_id).eq("record_type", record_type).eq("month", target_date))
+    except: df_facts = typed_frame([], table_name, [dim_id_col] + list(value_cols))
+
+    df_merged = df_dims.merge(df_facts, on=dim_id_col, how='left', suffixes=('_dim', ''))
+    for c in value_cols: df_merged[c] = df_merged[c].fillna(0.0)
+    # 维度和事实表都有 market / customer 时以事实行为准，没有事实行的用维度上的值
+    for c in ('market', 'customer'):
+        if c + '_dim' in df_merged.columns:
+            df_merged[c] = df_merged[c].astype(object).fillna(df_merged.pop(c + '_dim').astype(object))
 
-    if 'market' not in df_merged.columns and 'grade_code' in df_merged.columns:
-        df_merged['market'] = df_merged['grade_code'].apply(lambda x: 'Domestic' if 'Domestic' in str(x) else 'Export')
-    if 'customer' not in df_merged.columns: df_merged['customer'] = 'FCO' 
+    if 'grade_code' in df_merged.columns:
+        derived = np.where(df_merged['grade_code'].astype(str).str.contains('Domestic'), 'Domestic', 'Export')
+        df_merged['market'] = df_merged['market'].fillna(pd.Series(derived, index=df_merged.index)) if 'market' in df_merged.columns else derived
+    df_merged['customer'] = df_merged['customer'].fillna('FCO') if 'customer' in df_merged.columns else 'FCO'
     return df_merged
 
 def save_monthly_data(edited_df, table_name, dim_id_col, forest_id, target_date, record_type):
@@ -69,9 +298,539 @@ def save_monthly_data(edited_df, table_name, dim_id_col, forest_id, target_date,
         records.append(rec)
     try:
         supabase.table(table_name).upsert(records, on_conflict=f"forest_id,{dim_id_col},month,record_type").execute()
+        bump_data_version(table_name, forest_id, month=target_date)
         return True
     except: return False
 
+# --- C2. 全年矩阵 (Year Matrix: 维度为行, Jan-Dec 为列) ---
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+UPSERT_CHUNK_SIZE = 500
+
+# 季节性分摊模板 (权重会被归一化, 新西兰冬季 6-8 月作业量偏低)
+SEASONAL_PROFILES = {
+    "Flat": [1.0] * 12,
+    "NZ Winter Slowdown": [1.1, 1.1, 1.1, 1.0, 0.9, 0.75, 0.7, 0.75, 0.9, 1.0, 1.1, 1.1],
+    "Summer Peak": [1.3, 1.3, 1.2, 1.0, 0.8, 0.6, 0.6, 0.7, 0.9, 1.1, 1.2, 1.3],
+}
+
+def to_native(v):
+    """numpy 标量转成 Python 原生类型，否则 JSON 序列化会失败"""
+    return v.item() if hasattr(v, 'item') else v
+
+def year_bounds(year):
+    return f"{year}-01-01", f"{year + 1}-01-01"
+
+def get_yearly_data(table_name, dim_table, dim_id_col, dim_name_col, forest_id, year, record_type, value_col):
+    """
+    一次查询拉取某林地全年的事实数据，并透视成矩阵：
+    每个维度 (grade / activity) 一行，Jan..Dec 为 12 列，缺失月份补 0。
+    查询失败时抛出 (与 fetch_frame 一致)：不能返回全 0 矩阵，否则会被当作基准把真实数据覆盖掉。
+    """
+    if not supabase: return pd.DataFrame()
+    df_dims = fetch_frame(dim_table, ['id', dim_name_col])
+    if df_dims.empty: return pd.DataFrame()
+
+    start, end = year_bounds(year)
+    res = supabase.table(table_name).select(f"{dim_id_col},month,{value_col}")\
+        .eq("forest_id", forest_id).eq("record_type", record_type)\
+        .gte("month", start).lt("month", end).execute()
+    df_facts = pd.DataFrame(res.data)
+
+    matrix = df_dims[['id', dim_name_col]].rename(columns={'id': dim_id_col})
+    if df_facts.empty:
+        for m in MONTHS: matrix[m] = 0.0
+    else:
+        df_facts['m'] = pd.to_datetime(df_facts['month']).dt.month
+        pivot = df_facts.pivot_table(index=dim_id_col, columns='m', values=value_col, aggfunc='sum')
+        pivot = pivot.reindex(columns=range(1, 13))
+        pivot.columns = MONTHS
+        matrix = matrix.merge(pivot, left_on=dim_id_col, right_index=True, how='left')
+        matrix[MONTHS] = matrix[MONTHS].astype(float).fillna(0.0)
+    return matrix.reset_index(drop=True)
+
+def diff_year_matrix(original_df, edited_df, dim_id_col):
+    """对比两个年度矩阵，只返回发生变化的单元格 (dim_id, 月序号, 新值) 的长表"""
+    orig = original_df.set_index(dim_id_col)[MONTHS].astype(float)
+    new = edited_df.set_index(dim_id_col)[MONTHS].astype(float).reindex(orig.index).fillna(0.0)
+    changed = ~np.isclose(orig.to_numpy(), new.to_numpy())
+    if not changed.any(): return pd.DataFrame(columns=[dim_id_col, 'month_no', 'value'])
+    rows, cols = np.nonzero(changed)
+    return pd.DataFrame({
+        dim_id_col: orig.index.to_numpy()[rows],
+        'month_no': cols + 1,
+        'value': new.to_numpy()[rows, cols],
+    })
+
+def save_yearly_data(original_df, edited_df, table_name, dim_id_col, forest_id, year, record_type, value_col):
+    """
+    只把改动过的单元格分块 upsert 回去。
+    返回 (是否成功, 写入的单元格数量)。
+    """
+    if not supabase or edited_df.empty: return False, 0
+    changes = diff_year_matrix(original_df, edited_df, dim_id_col)
+    if changes.empty: return True, 0
+
+    records = [
+        {"forest_id": forest_id, dim_id_col: to_native(dim_id), "month": f"{year}-{int(m):02d}-01",
+         "record_type": record_type, value_col: float(val)}
+        for dim_id, m, val in changes[[dim_id_col, 'month_no', 'value']].itertuples(index=False)
+    ]
+    try:
+        bulk_upsert(table_name, records, f"forest_id,{dim_id_col},month,record_type")
+        return True, len(records)
+    except Exception as e:
+        print(f"Year Save Error: {e}")
+        return False, 0
+
+def bulk_upsert(table_name, records, on_conflict, chunk_size=UPSERT_CHUNK_SIZE, on_progress=None):
+    """分块 upsert，避免单个请求过大；任何一块失败都会抛出异常。写入范围从记录中推断并 bump 版本"""
+    try:
+        for i in range(0, len(records), chunk_size):
+            supabase.table(table_name).upsert(records[i:i + chunk_size], on_conflict=on_conflict).execute()
+            if on_progress: on_progress(min(i + chunk_size, len(records)) / len(records))
+    finally:
+        bump_for_records(table_name, records)
+    return len(records)
+
+def save_sales_transactions(records):
+    """Log Sales 明细 upsert (失败时抛出异常，由页面显示)"""
+    try:
+        supabase.table("actual_sales_transactions").upsert(records).execute()
+    finally:
+        bump_for_records("actual_sales_transactions", records, date_col="date")
+
+def archive_invoice(record):
+    """写入 invoice_archive 一条记录 (同时追加到本会话的重复检测索引)"""
+    try:
+        res = supabase.table("invoice_archive").insert(record).execute()
+        idx = st.session_state.get("_dup_index")
+        if idx is not None:
+            for row in res.data or []: idx.add(row)
+        return res
+    finally:
+        bump_data_version("invoice_archive")
+
+# 分摊工具：输入为每行年度总额 (Series)，输出 Jan..Dec 的 DataFrame
+def spread_flat(totals):
+    return spread_seasonal(totals, SEASONAL_PROFILES["Flat"])
+
+def spread_seasonal(totals, profile):
+    weights = np.asarray(profile, dtype=float)
+    weights = weights / weights.sum()
+    values = np.outer(totals.to_numpy(dtype=float), weights)
+    return pd.DataFrame(values, index=totals.index, columns=MONTHS)
+
+def profile_from_matrix(matrix):
+    """用已有矩阵 (例如去年的 Actual) 的月度分布作为季节性模板"""
+    col_totals = matrix[MONTHS].sum().to_numpy(dtype=float)
+    if col_totals.sum() <= 0: return SEASONAL_PROFILES["Flat"]
+    return list(col_totals / col_totals.sum())
+
+# --- C3. Actual 预填引擎 (Budget 单价 -> Actual) ---
+# 一次性 (Lump Sum) 项目关键词：路、施工、维护、费用等按总额结算，不按单价
+LUMP_SUM_KEYWORDS = ['road', 'construct', 'mainten', 'fee', 'lump', 'fixed', 'general']
+
+def classify_lump_sum(df_dims):
+    """
+    向量化分类：返回与 df_dims 对齐的布尔 Series。
+    如果 dim_cost_activities 已有 is_lump_sum 列则以它为准，空值再按关键词判断。
+    """
+    pattern = '|'.join(LUMP_SUM_KEYWORDS)
+    by_name = df_dims['activity_name'].astype(str).str.lower().str.contains(pattern, regex=True, na=False)
+    if 'is_lump_sum' in df_dims.columns:
+        return df_dims['is_lump_sum'].astype('boolean').fillna(by_name).astype(bool)
+    return by_name
+
+# 缓存函数内部不吞异常：查询失败直接抛出 (st.cache_data 不缓存异常)，由外层不缓存的包装函数兜底，
+# 否则一次网络抖动的空结果会被缓存一小时。
+def get_lump_sum_flags():
+    """{activity_id: 是否一次性项目}，每个 activity 只分类一次并缓存"""
+    if not supabase: return {}
+    try: return _get_lump_sum_flags()
+    except Exception as e:
+        print(f"Lump sum flags error: {e}")
+        return {}
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _get_lump_sum_flags():
+    # is_lump_sum 是可选列 (旧库没有)，维度表很小，这里保留 select("*") 以便探测
+    df_dims = pd.DataFrame(supabase.table("dim_cost_activities").select("*").execute().data)
+    if df_dims.empty: return {}
+    return dict(zip(df_dims['id'], classify_lump_sum(df_dims)))
+
+def load_year_facts(table_name, forest_id, year, record_types=("Actual", "Budget")):
+    """一次拉取某林地全年 (多个 record_type) 的事实行，供预填 / 预测等复用；写入后数据版本变化，缓存自动失效。查询失败返回空表"""
+    try: return _year_facts(table_name, forest_id, year, record_types)
+    except Exception as e:
+        print(f"Year facts error: {e}")
+        return pd.DataFrame()
+
+def _year_facts(table_name, forest_id, year, record_types=("Actual", "Budget")):
+    """同 load_year_facts，但查询失败时抛出；供其它缓存函数内部使用"""
+    return _load_year_facts(table_name, forest_id, year, tuple(record_types), get_data_version(table_name, forest_id, year))
+
+def _year_facts_many(table_names, forest_ids, year):
+    """多张表 × 多个林地的全年事实并发拉取 (各自走 _load_year_facts 缓存)，返回 {(table, forest_id): DataFrame}"""
+    return fetch_parallel({(t, f): (lambda t=t, f=f: _year_facts(t, f, year)) for t in table_names for f in forest_ids})
+
+# 全年事实只读分析 (预填 / 预测 / 差异立方体) 用到的列
+YEAR_FACT_COLS = {
+    "fact_production_volume": ['forest_id', 'grade_id', 'month', 'record_type'] + VOLUME_VALUE_COLS,
+    "fact_operational_costs": ['forest_id', 'activity_id', 'month', 'record_type'] + COST_VALUE_COLS,
+}
+
+@st.cache_data(ttl=3600, show_spinner=False, max_entries=256)
+def _load_year_facts(table_name, forest_id, year, record_types, data_version):
+    if not supabase: return pd.DataFrame()
+    start, end = year_bounds(year)
+    import snapshot  # 有本地 Parquet 快照时，已结账月份直接读快照，本月仍走实时查询
+    if snapshot.is_ready(table_name):
+        df = snapshot.query_year(table_name, YEAR_FACT_COLS[table_name], [forest_id], year,
+                                 [("record_type", "in", list(record_types))])
+    else:
+        df = fetch_frame(table_name, YEAR_FACT_COLS[table_name],
+                         lambda q: q.eq("forest_id", forest_id).in_("record_type", list(record_types)).gte("month", start).lt("month", end),
+                         compact=True)
+    if not df.empty: df['month'] = pd.to_datetime(df['month'])
+    return df
+
+def prefill_actual_costs(df_actual, df_budget_facts, lump_flags):
+    """
+    用 Budget 单价预填 Actual 成本表 (向量化)：
+    - 一次性项目：单价置 0，数量置 1 作为标记，总额留给用户填写
+    - 常规项目 (Logging/Cartage)：有预算单价时预填，数量留 0 等待输入
+    """
+    df = df_actual.copy()
+    if df_budget_facts.empty: bud_rates = pd.Series(dtype=float)
+    else: bud_rates = df_budget_facts.groupby('activity_id')['unit_rate'].max()
+
+    is_lump = df['activity_id'].map(lump_flags).fillna(False).astype(bool)
+    bud_rate = df['activity_id'].map(bud_rates).fillna(0.0).astype(float)
+
+    df.loc[is_lump, 'unit_rate'] = 0.0
+    df.loc[is_lump, 'quantity'] = 1.0
+    use_rate = ~is_lump & (bud_rate > 0)
+    df.loc[use_rate, 'unit_rate'] = bud_rate[use_rate]
+    return df
+
+def fill_cost_totals(df):
+    """只在 Total 为 0 且有单价和数量时自动计算 (避免覆盖用户手动输入的一次性总额)"""
+    df = df.copy()
+    auto = (df['total_amount'] == 0) & (df['quantity'] > 0) & (df['unit_rate'] > 0)
+    df.loc[auto, 'total_amount'] = df.loc[auto, 'quantity'] * df.loc[auto, 'unit_rate']
+    return df
+
+# --- C4. 滚动预测 (Actual 至今 + 剩余月份 Budget) ---
+def get_dim_lookup(dim_table, name_col):
+    """{id: 名称}，用于把 grade_id / activity_id 显示成名字"""
+    if not supabase: return {}
+    try: return _get_dim_lookup(dim_table, name_col)
+    except Exception as e:
+        print(f"Dim lookup error ({dim_table}): {e}")
+        return {}
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _get_dim_lookup(dim_table, name_col):
+    rows = supabase.table(dim_table).select(f"id,{name_col}").execute().data
+    return {r['id']: r[name_col] for r in rows}
+
+def build_forecast(df_vol, df_cost):
+    """
+    纯 pandas 预测计算。输入为全年事实 (Actual + Budget 混合)。
+    截止月 = 最后一个有 Actual 数据的月份；截止月及之前取 Actual，之后取 Budget。
+    返回 dict: cutoff_month, monthly, by_grade, by_activity, totals (forecast / budget)。
+    """
+    frames = {}
+    for name, df, val_cols in (("vol", df_vol, ['amount', 'vol_tonnes']), ("cost", df_cost, ['total_amount'])):
+        if df.empty:
+            frames[name] = pd.DataFrame(columns=['month_no', 'record_type'] + val_cols)
+            continue
+        df = df.copy()
+        df['month_no'] = pd.to_datetime(df['month']).dt.month
+        for c in val_cols: df[c] = pd.to_numeric(df[c], errors='coerce').fillna(0.0)
+        frames[name] = df
+
+    vol, cost = frames["vol"], frames["cost"]
+    act_months = pd.concat([
+        vol.loc[(vol['record_type'] == 'Actual') & (vol['amount'] != 0), 'month_no'],
+        cost.loc[(cost['record_type'] == 'Actual') & (cost['total_amount'] != 0), 'month_no'],
+    ])
+    cutoff = int(act_months.max()) if not act_months.empty else 0
+
+    def pick(df):
+        use_act = (df['record_type'] == 'Actual') & (df['month_no'] <= cutoff)
+        use_bud = (df['record_type'] == 'Budget') & (df['month_no'] > cutoff)
+        return df[use_act | use_bud]
+
+    f_vol, f_cost = pick(vol), pick(cost)
+    months = pd.Index(range(1, 13), name='month_no')
+    monthly = pd.DataFrame(index=months)
+    monthly['revenue'] = f_vol.groupby('month_no')['amount'].sum().reindex(months, fill_value=0.0)
+    monthly['volume'] = f_vol.groupby('month_no')['vol_tonnes'].sum().reindex(months, fill_value=0.0)
+    monthly['cost'] = f_cost.groupby('month_no')['total_amount'].sum().reindex(months, fill_value=0.0)
+    monthly['margin'] = monthly['revenue'] - monthly['cost']
+    monthly['source'] = np.where(monthly.index <= cutoff, 'Actual', 'Budget')
+    monthly = monthly.reset_index()
+    monthly['month'] = [MONTHS[m - 1] for m in monthly['month_no']]
+
+    by_grade = f_vol.groupby('grade_id')[['vol_tonnes', 'amount']].sum().reset_index() if 'grade_id' in f_vol.columns else pd.DataFrame()
+    by_activity = f_cost.groupby('activity_id')['total_amount'].sum().reset_index() if 'activity_id' in f_cost.columns else pd.DataFrame()
+
+    bud_rev = float(vol.loc[vol['record_type'] == 'Budget', 'amount'].sum())
+    bud_cost = float(cost.loc[cost['record_type'] == 'Budget', 'total_amount'].sum())
+    totals = {
+        "revenue": float(monthly['revenue'].sum()), "cost": float(monthly['cost'].sum()),
+        "margin": float(monthly['margin'].sum()), "volume": float(monthly['volume'].sum()),
+        "budget_revenue": bud_rev, "budget_cost": bud_cost, "budget_margin": bud_rev - bud_cost,
+    }
+    return {"cutoff_month": cutoff, "monthly": monthly, "by_grade": by_grade, "by_activity": by_activity, "totals": totals}
+
+def get_forecast(forest_id, year):
+    """按 (forest, year, data version) 缓存的全年预测；没有新的写入就不会重新扫描事实表"""
+    token = data_token(("fact_production_volume", forest_id, year), ("fact_operational_costs", forest_id, year))
+    if not supabase: return build_forecast(pd.DataFrame(), pd.DataFrame())
+    try: return _get_forecast(forest_id, year, token)
+    except Exception as e:
+        print(f"Forecast error: {e}")
+        return build_forecast(pd.DataFrame(), pd.DataFrame())
+
+@st.cache_data(ttl=3600, show_spinner=False, max_entries=128)
+def _get_forecast(forest_id, year, data_version):
+    df_vol = _year_facts("fact_production_volume", forest_id, year)
+    df_cost = _year_facts("fact_operational_costs", forest_id, year)
+    return build_forecast(df_vol, df_cost)
+
+# --- C5. Budget vs Actual 差异立方体 (forest × month × activity/grade × record_type) ---
+CUBE_MEASURES = {"Revenue": "amount", "Volume": "vol_tonnes", "Cost": "total_amount"}
+
+def build_variance_cube(df_vol, df_cost, forest_names, grade_names, activity_names):
+    """
+    把产量/成本事实压成一个紧凑的长表：
+    forest / dim / item / record_type / measure 为 categorical，month_no 为 int8，value 为 float64。
+    """
+    parts = []
+    for df, dim, id_col, names, measures in (
+        (df_vol, "Grade", "grade_id", grade_names, ("Revenue", "Volume")),
+        (df_cost, "Activity", "activity_id", activity_names, ("Cost",)),
+    ):
+        if df.empty or id_col not in df.columns: continue
+        base = pd.DataFrame({
+            'forest': df['forest_id'].map(forest_names).fillna('Unknown'),
+            'month_no': pd.to_datetime(df['month']).dt.month.astype('int8'),
+            'dim': dim,
+            'item': df[id_col].map(names).fillna('Unknown'),
+            'record_type': df['record_type'],
+        })
+        for m in measures:
+            parts.append(base.assign(measure=m, value=pd.to_numeric(df[CUBE_MEASURES[m]], errors='coerce').fillna(0.0).astype('float64')))
+
+    cols = ['forest', 'month_no', 'dim', 'item', 'record_type', 'measure']
+    if not parts: return pd.DataFrame(columns=cols + ['value'])
+    cube = pd.concat(parts, ignore_index=True)
+    for c in ('forest', 'dim', 'item', 'record_type', 'measure'): cube[c] = cube[c].astype('category')
+    return cube.groupby(cols, observed=True, as_index=False)['value'].sum()
+
+def get_variance_cube(forest_ids, year):
+    """按 (forests, year, data version) 缓存；Dashboard 和 Analysis 页面共用"""
+    forest_ids = tuple(sorted(forest_ids))
+    token = data_token(*[(t, f, year) for f in forest_ids for t in ("fact_production_volume", "fact_operational_costs")])
+    empty = lambda: build_variance_cube(pd.DataFrame(), pd.DataFrame(), {}, {}, {})
+    if not supabase: return empty()
+    try: return _get_variance_cube(forest_ids, year, token)
+    except Exception as e:
+        print(f"Variance cube error: {e}")
+        return empty()
+
+@st.cache_data(ttl=3600, show_spinner=False, max_entries=64)
+def _get_variance_cube(forest_ids, year, data_version):
+    tables = ("fact_production_volume", "fact_operational_costs")
+    res = fetch_parallel({
+        "facts": lambda: _year_facts_many(tables, forest_ids, year),
+        "forests": lambda: supabase.table("dim_forests").select("id,name").execute().data,
+        "grades": lambda: _get_dim_lookup("dim_products", "grade_code"),
+        "activities": lambda: _get_dim_lookup("dim_cost_activities", "activity_name"),
+    })
+    facts = res["facts"]
+    df_vol, df_cost = [pd.concat([facts[(t, f)] for f in forest_ids], ignore_index=True) if forest_ids else pd.DataFrame()
+                       for t in tables]
+    forest_names = {f['id']: f['name'] for f in res["forests"]}
+    return build_variance_cube(df_vol, df_cost, forest_names, res["grades"], res["activities"])
+
+def cube_slice(cube, measure=None, months=None, forest=None, dim=None, item=None):
+    """按条件切片 (months 可为单月或月份列表，例如 YTD = range(1, m+1))"""
+    mask = pd.Series(True, index=cube.index)
+    if measure is not None: mask &= cube['measure'] == measure
+    if forest is not None: mask &= cube['forest'] == forest
+    if dim is not None: mask &= cube['dim'] == dim
+    if item is not None: mask &= cube['item'] == item
+    if months is not None:
+        months = [months] if isinstance(months, int) else list(months)
+        mask &= cube['month_no'].isin(months)
+    return cube[mask]
+
+def cube_variance(cube, by, measure, **filters):
+    """透视成 Budget / Actual / Variance / Var % 表；by 可为 'item'、'month_no'、'forest' 或列表"""
+    sub = cube_slice(cube, measure=measure, **filters)
+    index = [by] if isinstance(by, str) else list(by)
+    if sub.empty: return pd.DataFrame(columns=index + ['Budget', 'Actual', 'Variance', 'Var %'])
+    pv = sub.pivot_table(index=index, columns='record_type', values='value', aggfunc='sum', observed=True, fill_value=0.0)
+    pv = pv.reindex(columns=['Budget', 'Actual'], fill_value=0.0)
+    pv.columns = list(pv.columns)
+    pv['Variance'] = pv['Actual'] - pv['Budget']
+    pv['Var %'] = (pv['Variance'] / pv['Budget'].where(pv['Budget'] != 0)) * 100
+    return pv.reset_index()
+
+# --- C6. 多林地合并视图 (Dashboard "ALL") ---
+# 每张事实表对所有林地只发一次 (分页) 查询，有快照时读本地 Parquet；在内存里聚合成 forest × month × record_type
+# 一张小表，合并 KPI、逐林地 Budget vs Actual、逐林地预测和小多图都从这张表派生。
+# 按数据版本缓存：林地数量增加不会增加查询次数，也不会增加图表数量 (小多图是一张 facet 图)。
+CONSOLIDATED_COLS = {
+    "fact_production_volume": ['id', 'forest_id', 'month', 'record_type', 'amount', 'vol_tonnes'],
+    "fact_operational_costs": ['id', 'forest_id', 'month', 'record_type', 'total_amount'],
+}
+CONSOLIDATED_MEASURES = {"fact_production_volume": {'amount': 'revenue', 'vol_tonnes': 'volume'},
+                         "fact_operational_costs": {'total_amount': 'cost'}}
+PAGE_SIZE = 1000  # PostgREST 默认单次最多返回 1000 行
+
+def get_available_years(include_next=False):
+    """事实表里实际出现过的年份 (最早 ~ 最晚月份，加上今年)；include_next 时再加一年 (编制下一年 Budget)"""
+    years = [date.today().year]
+    if supabase:
+        try: years = _get_available_years(data_token(("fact_production_volume",), ("fact_operational_costs",)))
+        except Exception as e: print(f"Available years error: {e}")
+    return years + [years[-1] + 1] if include_next else years
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _get_available_years(data_version):
+    def edge(table, desc):
+        rows = supabase.table(table).select("month").order("month", desc=desc).limit(1).execute().data
+        return rows[0]["month"] if rows else None
+
+    res = fetch_parallel({(t, d): (lambda t=t, d=d: edge(t, d)) for t in CONSOLIDATED_COLS for d in (False, True)})
+    years = {date.today().year} | {int(str(v)[:4]) for v in res.values() if v}
+    return list(range(min(years), max(years) + 1))
+
+def default_year_index(years):
+    """年份下拉框默认选今年"""
+    return years.index(date.today().year) if date.today().year in years else len(years) - 1
+
+def _fetch_year_all_forests(table, forest_ids, year):
+    """某年所有 (指定) 林地的事实行：一次查询按 id 分页，不按林地拆分"""
+    import snapshot
+    cols = CONSOLIDATED_COLS[table]
+    if snapshot.is_ready(table):
+        return snapshot.query_year(table, cols, forest_ids, year)
+    start, end = year_bounds(year)
+    parts, last_id = [], 0
+    while True:
+        df = fetch_frame(table, cols, lambda q: q.in_("forest_id", list(forest_ids)).gte("month", start).lt("month", end)
+                         .gt("id", last_id).order("id").limit(PAGE_SIZE), compact=True)
+        parts.append(df)
+        if len(df) < PAGE_SIZE: break
+        last_id = int(df['id'].iloc[-1])
+    return pd.concat(parts, ignore_index=True)
+
+def build_consolidated(df_vol, df_cost):
+    """forest_id × month_no × record_type 长表，列 revenue / volume / cost / margin"""
+    keys = ['forest_id', 'month_no', 'record_type']
+    aggs = []
+    for df, measures in ((df_vol, CONSOLIDATED_MEASURES["fact_production_volume"]),
+                         (df_cost, CONSOLIDATED_MEASURES["fact_operational_costs"])):
+        if df.empty: continue
+        g = df.assign(month_no=pd.to_datetime(df['month']).dt.month.astype('int8'), record_type=df['record_type'].astype(str))
+        aggs.append(g.groupby(keys)[list(measures)].sum().astype('float64').rename(columns=measures))
+    if not aggs: return pd.DataFrame(columns=keys + ['revenue', 'volume', 'cost', 'margin'])
+    agg = pd.concat(aggs, axis=1).fillna(0.0).reset_index()
+    for c in ('revenue', 'volume', 'cost'):
+        if c not in agg.columns: agg[c] = 0.0
+    agg['margin'] = agg['revenue'] - agg['cost']
+    return agg
+
+def get_consolidated(forest_ids, year):
+    """按 (forests, year, data version) 缓存的合并聚合表"""
+    forest_ids = tuple(sorted(forest_ids))
+    token = data_token(*[(t, f, year) for f in forest_ids for t in CONSOLIDATED_COLS])
+    return _get_consolidated(forest_ids, year, token)
+
+@st.cache_data(ttl=3600, show_spinner=False, max_entries=32)
+def _get_consolidated(forest_ids, year, data_version):
+    if not supabase or not forest_ids: return build_consolidated(pd.DataFrame(), pd.DataFrame())
+    res = fetch_parallel({t: (lambda t=t: _fetch_year_all_forests(t, forest_ids, year)) for t in CONSOLIDATED_COLS})
+    return build_consolidated(res["fact_production_volume"], res["fact_operational_costs"])
+
+def consolidated_forecast(agg):
+    """
+    逐林地预测 (与 build_forecast 相同的规则：各林地最后一个有 Actual 的月份及之前取 Actual，之后取 Budget)。
+    返回 (monthly: forest_id × month_no 的 revenue/cost/margin/volume, cutoffs: {forest_id: 截止月})。
+    """
+    has_act = (agg['record_type'] == 'Actual') & ((agg['revenue'] != 0) | (agg['cost'] != 0))
+    cutoffs = agg[has_act].groupby('forest_id')['month_no'].max()
+    cut = agg['forest_id'].map(cutoffs).fillna(0)
+    use = ((agg['record_type'] == 'Actual') & (agg['month_no'] <= cut)) | ((agg['record_type'] == 'Budget') & (agg['month_no'] > cut))
+    monthly = agg[use].groupby(['forest_id', 'month_no'], as_index=False)[['revenue', 'cost', 'margin', 'volume']].sum()
+    return monthly, {int(k): int(v) for k, v in cutoffs.items()}
+
+def consolidated_summary(agg, forest_names, months=None):
+    """逐林地 Budget vs Actual (+ 全年预测毛利)：每个林地一行"""
+    sel = agg if months is None else agg[agg['month_no'].isin(months)]
+    piv = sel.pivot_table(index='forest_id', columns='record_type', values=['revenue', 'cost', 'margin'], aggfunc='sum', fill_value=0.0)
+    out = pd.DataFrame(index=pd.Index(sorted(forest_names), name='forest_id'))
+    for m in ('revenue', 'cost', 'margin'):
+        for rt in ('Actual', 'Budget'):
+            out[f"{m.title()} {rt}"] = piv[(m, rt)] if (m, rt) in piv.columns else 0.0
+        out[f"{m.title()} Var"] = out[f"{m.title()} Actual"] - out[f"{m.title()} Budget"]
+    fc, _ = consolidated_forecast(agg)
+    out['Forecast Margin'] = fc.groupby('forest_id')['margin'].sum()
+    out = out.fillna(0.0)
+    out.insert(0, 'Forest', [forest_names.get(f, 'Unknown') for f in out.index])
+    return out.reset_index(drop=True)
+
+# --- C7. 结账 (Period Close：冻结月度对账单) ---
+# 结账时把当月计算好的对账单 (calculate_invoice_context 结果、按 GL 汇总的成本 / 收入明细、财务导出行、设置)
+# 原样写入 closed_periods；之后该月直接读快照，不再拉明细重算，事实数据再改也不影响已结账的对账单。
+# 快照只增不改：(forest_id, month) 唯一，重复结账报错。
+#   create table closed_periods (
+#     id bigint generated always as identity primary key,
+#     forest_id bigint not null references dim_forests(id),
+#     month date not null,
+#     closed_at timestamptz not null default now(),
+#     statement jsonb not null,
+#     unique (forest_id, month)
+#   );  -- RLS / 权限只开放 insert + select
+def get_closed_period(forest_id, month):
+    """
+    已结账时返回 {"month", "closed_at", "statement"}，否则 None。
+    查询失败时抛出 (不当作未结账处理，否则会绕过冻结)，由页面提示错误。
+    """
+    if not supabase: return None
+    return _get_closed_periods(forest_id, data_token(("closed_periods", forest_id))).get(str(month)[:10])
+
+def is_period_closed(forest_id, month):
+    return get_closed_period(forest_id, month) is not None
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _get_closed_periods(forest_id, data_version):
+    """某林地所有已结账月份 (每月一行，数量很小)：{month: row}"""
+    rows = supabase.table("closed_periods").select("month,closed_at,statement").eq("forest_id", forest_id).execute().data
+    out = {}
+    for r in rows:
+        stmt = r["statement"]
+        out[str(r["month"])[:10]] = {"month": str(r["month"])[:10], "closed_at": r["closed_at"],
+                                     "statement": json.loads(stmt) if isinstance(stmt, str) else stmt}
+    return out
+
+def close_period(forest_id, month, statement):
+    """冻结一个月的对账单；已结账时抛 ValueError"""
+    month = str(month)[:10]
+    if is_period_closed(forest_id, month):
+        raise ValueError(f"{month} is already closed")
+    try:
+        supabase.table("closed_periods").insert({"forest_id": forest_id, "month": month,
+                                                 "closed_at": pd.Timestamp.now(tz="UTC").isoformat(),
+                                                 "statement": statement}).execute()
+    finally:
+        bump_data_version("closed_periods", forest_id, month=month)
+
 # --- D. 发票 HTML 生成 ---
 def generate_invoice_html(invoice_no, invoice_date, bill_to, month_str, year, items, subtotal, gst_val, total_due):
     rows_html = ""
@@ -83,26 +842,14 @@ def generate_invoice_html(invoice_no, invoice_date, bill_to, month_str, year, it
     """
 
 # --- E. AI 识别核心逻辑 (稳定兼容版) ---
-# --- 替换 backend.py 中的 real_extract_invoice_data 函数 ---
+# 大的多发票 PDF 先在本地按页分组 (pypdf，不走网络)，每组并行调用一次 Gemini，
+# 失败的组单独重试，最后按 (vendor, invoice_no) 合并去重。
+# 这样输出长度与每组页数有关，而不是整份文件；某一组失败也不会丢掉其它组的结果。
+PDF_PAGES_PER_GROUP = 4
+EXTRACT_WORKERS = 4
+EXTRACT_GROUP_RETRIES = 2
 
-def real_extract_invoice_data(file_obj):
-    try:
-        if not check_google_key():
-            return [{"vendor_detected": "Error", "error_msg": "API Key missing", "amount_detected": 0, "filename": file_obj.name}]
-
-        # 1. 配置 & 模型选择
-        genai.configure(api_key=st.secrets["google"]["api_key"])
-        try:
-            model = genai.GenerativeModel('gemini-2.5-flash') 
-        except:
-            model = genai.GenerativeModel('gemini-2.0-flash')
-        
-        # 2. 读取文件
-        file_obj.seek(0)
-        file_bytes = file_obj.read()
-        
-        # 3. 构建 Prompt (新增 description 和 invoice_date)
-        prompt_text = """
+INVOICE_PROMPT = """
         Analyze this PDF file. It contains MULTIPLE distinct invoices.
         Extract ALL invoices found into a single JSON ARRAY.
         
@@ -124,60 +871,509 @@ def real_extract_invoice_data(file_obj):
         2. Format dates as YYYY-MM-DD.
         3. Return ONLY the JSON ARRAY.
         """
+
+def split_pdf_pages(file_bytes, pages_per_group=PDF_PAGES_PER_GROUP, stream=None):
+    """
+    本地拆分 PDF：返回 [((首页, 末页), pdf_bytes), ...]，页码从 1 开始。
+    file_bytes 可以是 bytes 或 memoryview；stream 为同一内容的可 seek 文件对象时 pypdf 直接从它读取，
+    不再把整份文件复制进 BytesIO。页数不超过一组、没有安装 pypdf 或文件无法解析时，原样作为一组返回。
+    """
+    try:
+        from pypdf import PdfReader, PdfWriter
+        reader = PdfReader(stream if stream is not None else io.BytesIO(file_bytes))
+        n_pages = len(reader.pages)
+    except Exception:
+        return [((1, None), file_bytes)]
+    if n_pages <= pages_per_group: return [((1, n_pages), file_bytes)]
+
+    groups = []
+    for first in range(0, n_pages, pages_per_group):
+        last = min(first + pages_per_group, n_pages)
+        writer = PdfWriter()
+        for i in range(first, last): writer.add_page(reader.pages[i])
+        buf = io.BytesIO()
+        writer.write(buf)
+        groups.append(((first + 1, last), buf.getvalue()))
+    return groups
+
+def _pages_label(pages):
+    first, last = pages
+    if last is None: return "all pages"
+    return f"page {first}" if first == last else f"pages {first}-{last}"
+
+# --- 结构化输出 + 增量解析 + 字段校验 ---
+# 优先使用 Gemini 的 JSON 输出模式 (response_schema)，模型不支持时退回纯文本提示。
+# 无论哪种模式，输出都按流式分段送进 JsonObjectStream：每个完整的 {...} 单独解析，
+# 坏掉的对象只丢它自己，截断的输出也保留已完成的发票；只有一张有效发票都没有时才重试该页组。
+INVOICE_FIELDS = {
+    "vendor_detected": "STRING",
+    "invoice_no": "STRING",
+    "invoice_date": "STRING",
+    "amount_detected": "NUMBER",
+    "description": "STRING",
+}
+INVOICE_REQUIRED = ["vendor_detected", "invoice_no", "amount_detected"]
+INVOICE_RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {"type": "OBJECT", "properties": {k: {"type": t} for k, t in INVOICE_FIELDS.items()},
+              "required": INVOICE_REQUIRED},
+}
+STRUCTURED_OUTPUT_CONFIG = {"response_mime_type": "application/json", "response_schema": INVOICE_RESPONSE_SCHEMA}
+_structured_output = {"enabled": True}  # 模型 / SDK 拒绝 JSON 模式后置为 False，本进程不再尝试
+
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+_EMPTY_ARRAY = re.compile(r"^\s*(```(json)?)?\s*\[\s*\]\s*(```)?\s*$")
+
+class JsonObjectStream:
+    """
+    增量 JSON 对象解析：feed() 接收文本片段 (流式输出)，返回其中新完成的最外层 {...} 对象。
+    只跟踪花括号和字符串边界，不要求外层数组完整，也不在乎前后夹带的 ``` 或说明文字。
+    解析失败的对象计入 skipped，并尝试从它内部恢复后面被"吞掉"的完整对象。
+    """
+
+    def __init__(self):
+        self.objects, self.skipped, self.truncated = [], 0, False
+        self._buf, self._depth, self._in_str, self._esc = [], 0, False, False
+
+    def feed(self, text):
+        done = []
+        for ch in text:
+            if not self._depth:
+                if ch == "{": self._depth, self._buf = 1, ["{"]
+                continue
+            self._buf.append(ch)
+            if self._in_str:
+                if self._esc: self._esc = False
+                elif ch == "\\": self._esc = True
+                elif ch == '"': self._in_str = False
+            elif ch == '"': self._in_str = True
+            elif ch == "{": self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if not self._depth: done += self._decode("".join(self._buf))
+        self.objects += done
+        return done
+
+    def close(self):
+        """输入结束：未闭合的对象 (输出被截断) 丢弃，但其中已经完整的内层对象仍然恢复"""
+        done = []
+        if self._depth:
+            self.truncated = True
+            done = self._recover("".join(self._buf))
+        self._buf, self._depth, self._in_str, self._esc = [], 0, False, False
+        self.objects += done
+        return done
+
+    def _decode(self, text):
+        for candidate in (text, _TRAILING_COMMA.sub(r"\1", text)):
+            try: return [json.loads(candidate)]
+            except ValueError: pass
+        self.skipped += 1
+        return self._recover(text)
+
+    def _recover(self, text):
+        sub = JsonObjectStream()
+        sub.feed(text[1:])
+        sub.close()
+        self.skipped += sub.skipped
+        return sub.objects
+
+def _invoice_candidates(obj):
+    """模型偶尔会包一层 {"invoices": [...]}，展开成发票对象列表"""
+    if not isinstance(obj, dict): return []
+    if any(k in obj for k in INVOICE_FIELDS): return [obj]
+    return [x for v in obj.values() if isinstance(v, list) for x in v if isinstance(x, dict)]
+
+def _parse_amount(v):
+    """
+    1,234.50 / "$1,234.50" / "(100.00)" / "-$5.00" / "1.234,56" -> float；无法识别返回 None。
+    负号可以在货币符号前后 (含 Unicode 减号 −)；最后一个分隔符后只有 1-2 位时视为小数点 (欧洲写法)。
+
+    >>> [_parse_amount(x) for x in ["-$5.00", "-$1,234.50", "−$20", "$-7.5", "(100.00)", "NZD 1,234.50"]]
+    [-5.0, -1234.5, -20.0, -7.5, -100.0, 1234.5]
+    >>> [_parse_amount(x) for x in ["1.234,56", "12,50", "1,234", "1.234.567", "1 234,56", "1,234.567", "n/a"]]
+    [1234.56, 12.5, 1234.0, 1234567.0, 1234.56, 1234.567, None]
+    """
+    if isinstance(v, bool) or v is None: return None
+    if isinstance(v, (int, float)): return float(v) if np.isfinite(v) else None
+    text = str(v).strip().replace("\u2212", "-")
+    match = re.search(r"\d[\d,. ]*", text)
+    if not match: return None
+    negative = (text.startswith("(") and text.endswith(")")) or "-" in text[:match.start()]
+    number = match.group(0).replace(" ", "").rstrip(".,")
+    # 小数点：两种分隔符都有时取最后一个；只有 "." 且只出现一次；只有 "," 且只出现一次、后面 1-2 位。其余都是千分位
+    last = max(number.rfind(","), number.rfind("."))
+    if "," in number and "." in number: decimal = number[last]
+    elif "." in number: decimal = "." if number.count(".") == 1 else None
+    elif "," in number: decimal = "," if number.count(",") == 1 and len(number) - last - 1 in (1, 2) else None
+    else: decimal = None
+    whole, frac = (number[:last], number[last + 1:]) if decimal else (number, "")
+    amount = float(whole.replace(",", "").replace(".", "") + ("." + frac if frac else ""))
+    return -abs(amount) if negative else amount
+
+def _parse_date(v):
+    """YYYY-MM-DD 优先；其它写法按日在前 (NZ 习惯) 解析；无法识别返回 None"""
+    if v is None or str(v).strip() == "": return None
+    text = str(v).strip()
+    try: return date.fromisoformat(text[:10]).isoformat()
+    except ValueError: pass
+    parsed = pd.to_datetime(text, dayfirst=True, errors="coerce")
+    return None if pd.isna(parsed) else parsed.date().isoformat()
+
+def validate_invoice(obj):
+    """
+    按 INVOICE_FIELDS 校验并规整一条识别结果，返回 (item, problems)。
+    缺失 / 无法识别的字段填默认值并记入 problems；三个必填字段全无效时返回 (None, problems)。
+    """
+    if not isinstance(obj, dict): return None, ["not an object"]
+    item, problems = dict(obj), []
+    for k, default in (("vendor_detected", "Unknown"), ("invoice_no", "Unknown"), ("description", "N/A")):
+        v = item.get(k)
+        if v is None or isinstance(v, (dict, list)) or str(v).strip() == "":
+            if k in INVOICE_REQUIRED: problems.append(f"missing {k}")
+            item[k] = default
+        else:
+            item[k] = str(v).strip()
+    amount = _parse_amount(item.get("amount_detected"))
+    if amount is None: problems.append("invalid amount_detected")
+    item["amount_detected"] = amount if amount is not None else 0.0
+    inv_date = _parse_date(item.get("invoice_date"))
+    if inv_date is None: problems.append("invalid invoice_date")
+    item["invoice_date"] = inv_date or str(date.today())  # 如果没读到日期，暂填今天
+
+    if all(f"missing {k}" in problems or f"invalid {k}" in problems for k in INVOICE_REQUIRED): return None, problems
+    if problems: item["warnings"] = "; ".join(problems)
+    return item, problems
+
+def parse_invoice_objects(chunks):
+    """
+    从模型输出 (完整文本或流式片段) 中恢复所有有效发票。
+    返回 (invoices, report)；report 含 skipped (坏对象 + 校验不通过)、truncated、empty_array。
+    """
+    if isinstance(chunks, str): chunks = [chunks]
+    stream, text_seen = JsonObjectStream(), []
+    for chunk in chunks:
+        stream.feed(chunk)
+        if len(text_seen) < 8: text_seen.append(chunk)  # 只留开头，用来判断是否为空数组
+    stream.close()
+    invoices, rejected = [], 0
+    for obj in stream.objects:
+        for cand in _invoice_candidates(obj):
+            item, _ = validate_invoice(cand)
+            if item is None: rejected += 1
+            else: invoices.append(item)
+    report = {"skipped": stream.skipped + rejected, "truncated": stream.truncated,
+              "empty_array": not stream.objects and bool(_EMPTY_ARRAY.match("".join(text_seen)))}
+    return invoices, report
+
+# 只有明确指向结构化输出参数的错误才说明 SDK / 模型不支持 JSON 模式；
+# 其它 TypeError / 400 (例如 PDF 的 mime type 被拒) 是真实错误，不能因此在整个进程里关掉结构化输出
+STRUCTURED_OUTPUT_ERRORS = ("response_schema", "response_mime_type", "generation_config", "json mode is not enabled")
+
+def _is_config_error(e):
+    msg = str(e).lower()
+    return any(s in msg for s in STRUCTURED_OUTPUT_ERRORS)
+
+def _generate_stream(model, contents):
+    """流式调用模型，逐段返回文本；优先 JSON 输出模式，被拒绝时退回纯文本"""
+    response = None
+    if _structured_output["enabled"]:
+        try:
+            response = model.generate_content(contents, generation_config=STRUCTURED_OUTPUT_CONFIG, stream=True)
+        except Exception as e:
+            if not _is_config_error(e): raise
+            _structured_output["enabled"] = False
+            print(f"Structured output unavailable, using plain text: {e}")
+    if response is None:
+        response = model.generate_content(contents, stream=True)
+    for chunk in response:
+        try: text = chunk.text
+        except ValueError: continue  # 没有文本 part 的分片 (例如安全拦截)
+        if text: yield text
+
+def _extract_page_group(model, pdf_bytes, pages, n_groups, file_name):
+    """
+    识别一个页组，返回 (invoices, note)。note 非空表示结果不完整 (坏对象被跳过 / 输出中断)，
+    但已恢复的发票照常使用、不重试；一张有效发票都没有时抛 ValueError，由调用方重试。
+    """
+    prompt_text = INVOICE_PROMPT
+    if n_groups > 1:
+        prompt_text += f"\n        Note: this file is {_pages_label(pages)} of a larger document; an invoice may start or end outside these pages.\n"
+    received, stream_error = [], None
+    with query_profiler.track("ai", model.model_name, f"{file_name} ({_pages_label(pages)})") as ev:
+        try:
+            # SDK 的 Blob 只接受 bytes；memoryview 在这里才转换，副本只在这次调用期间存在
+            for text in _generate_stream(model, [{'mime_type': 'application/pdf', 'data': bytes(pdf_bytes)}, prompt_text]):
+                received.append(text)
+        except Exception as e:
+            if not received: raise
+            stream_error = e  # 流中途断开：保留已收到的部分
+        ev["bytes"] = len(pdf_bytes)
+
+    invoices, report = parse_invoice_objects(received)
+    if not invoices:
+        if report["empty_array"] and stream_error is None: return [], None
+        if stream_error is not None: raise stream_error
+        raise ValueError("No valid invoice objects in response" if report["skipped"] else "No JSON Array found")
+
+    notes = []
+    if report["skipped"]: notes.append(f"{report['skipped']} malformed invoice object(s) skipped")
+    if stream_error is not None: notes.append(f"response interrupted ({stream_error})")
+    elif report["truncated"]: notes.append("response truncated")
+    return invoices, "; ".join(notes) or None
+
+def merge_invoices(items):
+    """
+    按 (vendor, invoice_no) 去重：跨页分组的同一张发票会被识别多次，保留金额最大的那条
+    (发票合计通常在最后一页，前面的页只看到部分明细)。没有发票号的条目不合并。
+    """
+    merged, order = {}, []
+    for item in items:
+        inv_no = str(item.get("invoice_no") or "").strip()
+        if not inv_no or inv_no == "Unknown":
+            order.append(id(item)); merged[id(item)] = item
+            continue
+        key = (str(item.get("vendor_detected") or "").strip().lower(), inv_no.lower())
+        if key not in merged:
+            order.append(key); merged[key] = item
+            continue
+        try: better = float(item.get("amount_detected") or 0) > float(merged[key].get("amount_detected") or 0)
+        except (TypeError, ValueError): better = False
+        if better: merged[key] = {**merged[key], **{k: v for k, v in item.items() if v not in (None, "")}}
+    return [merged[k] for k in order]
+
+def real_extract_invoice_data(file_obj):
+    try:
+        if not check_google_key():
+            return [{"vendor_detected": "Error", "error_msg": "API Key missing", "amount_detected": 0, "filename": file_obj.name}]
+
+        # 1. 配置 & 模型选择
+        genai = load_genai()
+        genai.configure(api_key=google_api_key())
+        try:
+            model = genai.GenerativeModel('gemini-2.5-flash') 
+        except:
+            model = genai.GenerativeModel('gemini-2.0-flash')
         
-        # 4. 调用 AI
-        response = model.generate_content([
-            {'mime_type': 'application/pdf', 'data': file_bytes},
-            prompt_text
-        ])
-        
-        # 5. 解析结果
-        raw_text = response.text
-        match = re.search(r'\[.*\]', raw_text, re.DOTALL)
+        # 2. 读取文件并按页分组
+        # 上传对象 (BytesIO) 和 BlobFile 都有 getbuffer()：拿到的是原内容上的 memoryview，不复制整份文件
+        file_obj.seek(0)
+        file_bytes = file_obj.getbuffer() if hasattr(file_obj, "getbuffer") else file_obj.read()
+        groups = split_pdf_pages(file_bytes, stream=file_obj if hasattr(file_obj, "seek") else None)
         
-        final_results = []
+        # 3. 并行调用 AI (每组独立；失败的组单独重试，不影响其它组)
+        results, failed, partial = {}, {}, {}
+        pending = list(range(len(groups)))
+        for attempt in range(EXTRACT_GROUP_RETRIES + 1):
+            if not pending: break
+            with ThreadPoolExecutor(max_workers=min(EXTRACT_WORKERS, len(pending))) as pool:
+                futures = {
+                    i: pool.submit(contextvars.copy_context().run, _extract_page_group,
+                                   model, groups[i][1], groups[i][0], len(groups), file_obj.name)
+                    for i in pending
+                }
+            pending = []
+            for i, fut in futures.items():
+                try:
+                    results[i], note = fut.result()
+                    failed.pop(i, None)
+                    if note: partial[i] = note
+                except Exception as e:
+                    failed[i] = str(e)
+                    pending.append(i)
         
-        if match:
-            json_str = match.group(0)
-            try:
-                data_list = json.loads(json_str)
-                if isinstance(data_list, dict): data_list = [data_list]
-                    
-                for item in data_list:
-                    if not isinstance(item, dict): continue
-                    
-                    item['filename'] = file_obj.name
-                    
-                    # 容错与默认值填充
-                    if "amount_detected" not in item: item["amount_detected"] = 0.0
-                    if "invoice_no" not in item: item["invoice_no"] = "Unknown"
-                    if "vendor_detected" not in item: item["vendor_detected"] = "Unknown"
-                    if "invoice_date" not in item: item["invoice_date"] = str(date.today()) # 如果没读到日期，暂填今天
-                    if "description" not in item: item["description"] = "N/A"
-                    
-                    # 金额清洗
-                    if isinstance(item["amount_detected"], str):
-                        clean_amt = item["amount_detected"].replace('$','').replace(',','').strip()
-                        try: item["amount_detected"] = float(clean_amt)
-                        except: item["amount_detected"] = 0.0
-                    
-                    final_results.append(item)
-                    
-                return final_results
-                
-            except json.JSONDecodeError:
-                return [{"filename": file_obj.name, "vendor_detected": "Error", "error_msg": "JSON Parse Error", "amount_detected": 0}]
-        else:
-            return [{"filename": file_obj.name, "vendor_detected": "Error", "error_msg": "No JSON Array found", "amount_detected": 0}]
+        # 4. 合并结果 (按页序)，去重；字段已在解析时按 INVOICE_FIELDS 校验并填好默认值
+        final_results = merge_invoices([item for i in sorted(results) for item in results[i]])
+        for item in final_results:
+            item['filename'] = file_obj.name
+
+        # 重试后仍失败的页组单独报错，已识别的发票照常返回；
+        # 只恢复了部分发票的页组也附一行提示，提醒人工核对是否有遗漏
+        for i in sorted({**failed, **partial}):
+            msg = failed.get(i) or f"partial result: {partial[i]}"
+            final_results.append({"filename": file_obj.name, "vendor_detected": "Error", "amount_detected": 0,
+                                  "error_msg": f"{_pages_label(groups[i][0])}: {msg}" if len(groups) > 1 else msg})
+        return final_results
 
     except Exception as e:
         return [{"filename": file_obj.name, "vendor_detected": "Error", "error_msg": str(e), "amount_detected": 0}]
 
 
+# --- E2. 发票对账 (AI 识别结果 vs ERP Actual 成本) ---
+# 每个不同的 vendor 只查一次 (同一批发票里同一供应商往往有很多张)，各 vendor 的查询并发发出。
+def erp_actual_for_vendor(vendor):
+    """名称包含 vendor 的第一个 activity 的一条 Actual 成本金额；没有匹配返回 None"""
+    acts = supabase.table("dim_cost_activities").select("id").ilike("activity_name", f"%{vendor}%").execute().data
+    if not acts: return None
+    costs = supabase.table("fact_operational_costs").select("total_amount")\
+        .eq("activity_id", acts[0]['id']).eq("record_type", "Actual").limit(1).execute().data
+    return float(costs[0]['total_amount']) if costs else None
+
+def _lookup_erp_amounts(vendors):
+    """{vendor: (金额或 None, 异常或 None)}：单个 vendor 查询失败不影响其它 vendor"""
+    def lookup(vendor):
+        try: return erp_actual_for_vendor(vendor), None
+        except Exception as e: return None, e
+    return fetch_parallel({v: (lambda v=v: lookup(v)) for v in vendors}) if vendors else {}
+
+def reconcile_invoices(results):
+    """按 vendor 匹配 activity，再对比 Actual 成本，返回 Review 表格的行 (每张发票一行)"""
+    reconcile_data = []
+    duplicates = flag_duplicates(results)
+    erp = _lookup_erp_amounts(list(dict.fromkeys(item.get('vendor_detected') for item in results
+                                                 if item.get("vendor_detected") != "Error")))
+
+    for i, item in enumerate(results):
+        # Init Variables
+        match_status = "❌ Not Found"
+        db_amount = 0.0
+        diff = 0.0
+
+        if item.get("vendor_detected") == "Error":
+            match_status = "❌ AI Error"
+        else:
+            amount, err = erp[item.get('vendor_detected')]
+            if err is not None:
+                # 如果数据库请求失败，记录错误但不崩溃
+                match_status = "⚠️ Net Error"
+                print(f"Supabase connection error for {item.get('filename')}: {err}")
+            elif amount is not None:
+                db_amount = amount
+                diff = float(item['amount_detected']) - db_amount
+                if abs(diff) < 1.0: match_status = "✅ Match"
+                else: match_status = "⚠️ Variance"
+
+        reconcile_data.append({
+            "Select": False, "Index": i,
+            "File": item.get('filename'),
+            "Vendor": item.get('vendor_detected'),
+            "Date": item.get('invoice_date'),
+            "Desc": item.get('description'),
+            "Inv #": item.get('invoice_no', ''),
+            "Inv Amount": item.get('amount_detected', 0),
+            "ERP Amount": db_amount, "Diff": diff, "Status": match_status,
+            "Duplicate": duplicates[i]
+        })
+    return reconcile_data
+
+
+# --- E3. 重复发票检测 (新识别结果 vs invoice_archive) ---
+# 每个会话在 session_state 里保留一份档案索引 (只含比对需要的列)，首次使用时全量加载，
+# 之后按 id 水位增量追加 (本进程有归档写入时立即追加，否则每 DUP_REFRESH_SECONDS 检查一次)。
+#   exact   : 规整后的 vendor + invoice_no 相同
+#   near    : 金额相同 + vendor 相似 + 日期相近 (发票号识别错一位、供应商写法不同等)
+#   same PDF: 文件内容哈希与已归档文件相同 (归档路径以哈希前 16 位开头，见 views_bot.archive_file)
+DUP_INDEX_COLS = ["id", "invoice_no", "vendor", "invoice_date", "amount", "file_url"]
+DUP_VENDOR_SIMILARITY = 0.85
+DUP_DATE_WINDOW_DAYS = 7
+DUP_REFRESH_SECONDS = 300
+FILE_HASH_PREFIX = 16
+
+_VENDOR_SUFFIXES = re.compile(r"\b(ltd|limited|co|company|inc|nz|pty|llc)\b")
+
+def _norm_vendor(v):
+    v = re.sub(r"[^a-z0-9 ]", " ", str(v or "").lower())
+    return " ".join(_VENDOR_SUFFIXES.sub(" ", v).split())
+
+def _norm_invoice_no(v):
+    v = re.sub(r"[^A-Z0-9]", "", str(v or "").upper())
+    return "" if v == "UNKNOWN" else v
+
+def file_hash_of_url(file_url):
+    """归档文件 URL -> 内容哈希前缀 (旧的按时间命名的文件返回 None)"""
+    m = re.search(r"/([0-9a-f]{%d})_[^/]*$" % FILE_HASH_PREFIX, str(file_url or ""))
+    return m.group(1) if m else None
+
+class DuplicateIndex:
+    """invoice_archive 的内存索引，按精确键 / 金额 (分) / 文件哈希三种方式查找"""
+
+    def __init__(self):
+        self.exact, self.by_amount, self.by_hash, self.ids = {}, {}, {}, set()
+        self.last_id, self.version, self.loaded_at = 0, -1, 0.0
+
+    def add(self, row):
+        if row.get("id") is None or row["id"] in self.ids: return
+        inv_no, vendor = _norm_invoice_no(row.get("invoice_no")), _norm_vendor(row.get("vendor"))
+        entry = {**row, "_vendor": vendor, "_date": _parse_date(row.get("invoice_date"))}
+        if inv_no and vendor: self.exact.setdefault((vendor, inv_no), entry)
+        try: self.by_amount.setdefault(round(float(row.get("amount") or 0) * 100), []).append(entry)
+        except (TypeError, ValueError): pass
+        h = file_hash_of_url(row.get("file_url"))
+        if h: self.by_hash.setdefault(h, []).append(entry)
+        self.ids.add(row["id"])
+        self.last_id = max(self.last_id, int(row["id"]))
+
+    def refresh(self):
+        """只拉 id 大于水位的新档案 (分页)"""
+        version = get_data_version("invoice_archive")
+        if version == self.version and time.time() - self.loaded_at < DUP_REFRESH_SECONDS: return
+        while True:
+            rows = supabase.table("invoice_archive").select(",".join(DUP_INDEX_COLS)).gt("id", self.last_id)\
+                .order("id").limit(1000).execute().data
+            for r in rows: self.add(r)
+            if len(rows) < 1000: break
+        self.version, self.loaded_at = version, time.time()
+
+    def archived_file(self, file_hash):
+        """与该内容哈希相同的已归档条目"""
+        return self.by_hash.get(str(file_hash or "")[:FILE_HASH_PREFIX], [])
+
+    def check(self, item, file_hash=None):
+        """返回 (kind, 档案行) 列表，kind 为 exact / near / same PDF；没有重复返回 []"""
+        vendor, inv_no = _norm_vendor(item.get("vendor_detected")), _norm_invoice_no(item.get("invoice_no"))
+        hits = []
+        exact = self.exact.get((vendor, inv_no)) if vendor and inv_no else None
+        if exact: hits.append(("exact", exact))
+        amount = _parse_amount(item.get("amount_detected"))
+        inv_date = _parse_date(item.get("invoice_date"))
+        if amount:
+            for row in self.by_amount.get(round(amount * 100), []):
+                if row is exact: continue
+                if SequenceMatcher(None, vendor, row["_vendor"]).ratio() < DUP_VENDOR_SIMILARITY: continue
+                if inv_date and row["_date"] and abs((date.fromisoformat(inv_date) - date.fromisoformat(row["_date"])).days) > DUP_DATE_WINDOW_DAYS:
+                    continue
+                hits.append(("near", row))
+        hits += [("same PDF", row) for row in self.archived_file(file_hash) if all(row is not h[1] for h in hits)]
+        return hits
+
+def duplicate_index():
+    """当前会话的档案索引 (首次调用时加载，之后增量更新)"""
+    idx = st.session_state.setdefault("_dup_index", DuplicateIndex())
+    idx.refresh()
+    return idx
+
+def describe_duplicates(hits):
+    """[(kind, row)] -> 表格里显示的一句话"""
+    if not hits: return ""
+    kind, row = hits[0]
+    more = f" (+{len(hits) - 1})" if len(hits) > 1 else ""
+    return f"{kind}: {row.get('vendor')} #{row.get('invoice_no')} ${float(row.get('amount') or 0):,.2f} {row.get('invoice_date') or ''}".strip() + more
+
+def flag_duplicates(results):
+    """
+    对每条识别结果给出重复说明 (空字符串表示没有重复)：对比档案索引，以及同一批次里更早出现的同一张发票。
+    """
+    try: idx = duplicate_index()
+    except Exception as e:
+        print(f"Duplicate index error: {e}")
+        idx = DuplicateIndex()
+    flags, seen = [], {}
+    for item in results:
+        if item.get("vendor_detected") == "Error":
+            flags.append(""); continue
+        flag = describe_duplicates(idx.check(item, item.get("file_hash")))
+        key = (_norm_vendor(item.get("vendor_detected")), _norm_invoice_no(item.get("invoice_no")))
+        if not flag and key[1] and key in seen: flag = "repeated in batch" + (f": {seen[key]}" if seen[key] else "")
+        seen.setdefault(key, item.get("filename"))
+        flags.append(flag)
+    return flags
+
+
 # --- F 在 backend.py 添加这个调试函数
 
 def list_available_models():
-    genai.configure(api_key=st.secrets["google"]["api_key"])
+    genai = load_genai()
+    genai.configure(api_key=google_api_key())
     for m in genai.list_models():
         if 'generateContent' in m.supported_generation_methods:
             print(m.name) # 这会在 Streamlit 的后台 Logs 里打印出来的模型列表
@@ -193,7 +1389,7 @@ def get_gl_mapping(forest_id):
     if not supabase: return {}, {}
     
     try:
-        data = supabase.table("dim_gl_mappings").select("*").eq("forest_id", forest_id).execute().data
+        data = supabase.table("dim_gl_mappings").select("item_type,item_id,gl_code,gl_name").eq("forest_id", forest_id).execute().data
         
         cost_map = {}
         rev_map = {}
@@ -0,0 +1,105 @@
+"""
+GL Mapping 上传基准：旧的逐行 iterrows 实现 vs 向量化 build_gl_mapping_records，并校验两者结果一致。
+
+    python -m benchmarks.bench_gl_mapping --rows 10000
+"""
+import argparse
+import sys
+import time
+import warnings
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+warnings.filterwarnings("ignore")
+
+import backend
+import db_client
+import views_admin
+from benchmarks import seed
+from benchmarks.fake_supabase import FakeSupabase
+
+
+def reference_records(df, forests, activities, products):
+    """旧实现 (逐行 + 每行线性模糊扫描)，只用于对比"""
+    forest_map = {f['name']: f['id'] for f in forests}
+    act_map = {a['activity_name']: a['id'] for a in activities}
+    prod_map = {p['grade_code']: p['id'] for p in products}
+    records, errors = [], []
+    for i, row in df.iterrows():
+        fid = forest_map.get(row.get('Company'))
+        if not fid:
+            errors.append(i); continue
+        item_type, item_name, item_id = row['Type'], row['Item Name'], None
+        if item_type == 'Cost':
+            item_id = act_map.get(item_name)
+            if not item_id:
+                for k, v in act_map.items():
+                    if k in str(item_name) or str(item_name) in k:
+                        item_id = v; break
+        elif item_type == 'Revenue':
+            item_id = prod_map.get(item_name)
+        if not item_id:
+            errors.append(i); continue
+        records.append({"forest_id": fid, "item_type": item_type, "item_id": item_id,
+                        "gl_code": str(row['GL Code']), "gl_name": row['GL Name']})
+    return records, errors
+
+
+def reference_fuzzy(names, act_map):
+    """旧的模糊匹配：每个名称线性扫描 activity 列表，取第一个 `k in s or s in k`"""
+    return {name: next((v for k, v in act_map.items() if k in str(name) or str(name) in k), None) for name in names}
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=10_000)
+    ap.add_argument("--scale", default="100k", help="seed scale (controls number of forests)")
+    args = ap.parse_args(argv)
+
+    raw = FakeSupabase()
+    summary = seed.seed(raw, args.scale)
+    backend.supabase = db_client.DataClient(raw)
+    forests = backend.supabase.table("dim_forests").select("id,name").execute().data
+    acts = backend.supabase.table("dim_cost_activities").select("id,activity_name").execute().data
+    prods = backend.supabase.table("dim_products").select("id,grade_code").execute().data
+    df = seed.gl_upload_frame(summary, rows=args.rows)
+
+    t0 = time.perf_counter()
+    ref, ref_err = reference_records(df, forests, acts, prods)
+    t_ref = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    records, errors = views_admin.build_gl_mapping_records(df, forests, acts, prods)
+    t_vec = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    backend.bulk_upsert("dim_gl_mappings", records, "forest_id,item_type,item_id")
+    t_up = time.perf_counter() - t0
+
+    # 模糊匹配索引与旧的线性扫描结果逐个名称一致 (上传里未精确命中的 Cost 名称 + 已有 activity 名称的片段)
+    act_map = {a['activity_name']: a['id'] for a in acts}
+    names = set(df.loc[(df['Type'] == 'Cost') & ~df['Item Name'].isin(act_map), 'Item Name'].dropna().astype(str))
+    names |= {k[:n] for k in act_map for n in (2, 5)} | {f"{k} (extra)" for k in act_map}
+    t0 = time.perf_counter()
+    fuzzy = views_admin.match_activity_names(names, act_map)
+    t_idx = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    fuzzy_same = fuzzy == reference_fuzzy(names, act_map)
+    t_lin = time.perf_counter() - t0
+
+    # 旧实现不去重：按 (forest, type, item) 保留最后一条后应与新实现一致
+    last = {(r["forest_id"], r["item_type"], r["item_id"]): r for r in ref}
+    same = sorted(last.values(), key=lambda r: (r["forest_id"], r["item_type"], r["item_id"])) == \
+        sorted(records, key=lambda r: (r["forest_id"], r["item_type"], r["item_id"]))
+
+    print(f"rows: {len(df):,}  records: {len(records):,} (deduplicated from {len(ref):,})  errors: {len(errors)} (reference {len(ref_err)})")
+    print(f"reference iterrows : {t_ref * 1000:9.1f} ms")
+    print(f"vectorized         : {t_vec * 1000:9.1f} ms  ({t_ref / t_vec:.0f}x)")
+    print(f"chunked upsert     : {t_up * 1000:9.1f} ms  ({backend.UPSERT_CHUNK_SIZE} rows/request)")
+    print(f"fuzzy names        : {len(names):,}  index {t_idx * 1000:.1f} ms vs linear {t_lin * 1000:.1f} ms, match: {fuzzy_same}")
+    print(f"results match      : {same and len(errors) == len(ref_err)}")
+    return same and fuzzy_same
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
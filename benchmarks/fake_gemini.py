@@ -0,0 +1,70 @@
+import hashlib
+import json
+import time
+import types
+
+# --- google.generativeai 的替身 ---
+# 每次 generate_content 固定等待 latency_s 秒 (模拟模型耗时)，返回 invoices_per_file 张发票的 JSON 数组。
+# stream=True 时按 chunk_chars 切成多个分片；带 JSON 模式的 generation_config 时不加 ``` 代码块。
+# 发票号 / 供应商 / 金额由传入 PDF 内容的哈希决定：不同文件 (不同页组) 得到不同发票，
+# 内容完全相同的文件得到相同发票 (和真实模型一样会被标成重复)，与调用顺序、模型实例无关。
+# install(backend) 会替换 backend.load_genai / check_google_key / google_api_key，
+# 这样 real_extract_invoice_data 不需要 secrets.toml 也能跑。
+
+DEFAULT_VENDORS = ["Log Transport", "Roading", "Pruning", "Aerial Spraying", "Harvest Management"]
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+def content_seed(contents):
+    """PDF 部分 ({'mime_type', 'data'}) 内容的 sha256 -> int"""
+    h = hashlib.sha256()
+    for part in contents:
+        if isinstance(part, dict): h.update(bytes(part.get("data", b"")))
+    return int.from_bytes(h.digest()[:8], "big")
+
+
+class FakeModel:
+    def __init__(self, model_name, latency_s=0.0, invoices_per_file=3, vendors=DEFAULT_VENDORS, chunk_chars=200):
+        self.model_name = model_name
+        self.latency_s = latency_s
+        self.invoices_per_file = invoices_per_file
+        self.vendors = vendors
+        self.chunk_chars = chunk_chars
+        self.calls = 0
+
+    def generate_content(self, contents, generation_config=None, stream=False, **kwargs):
+        if self.latency_s: time.sleep(self.latency_s)
+        self.calls += 1
+        seed = content_seed(contents)
+        data = [{
+            "vendor_detected": self.vendors[(seed + i) % len(self.vendors)],
+            "invoice_no": f"INV-{seed % 100000:05d}-{i}",
+            "invoice_date": "2025-01-31",
+            "amount_detected": round(1000 + 137.5 * i + seed % 1000, 2),
+            "description": "Synthetic benchmark invoice",
+        } for i in range(self.invoices_per_file)]
+        text = json.dumps(data)
+        if (generation_config or {}).get("response_mime_type") != "application/json":
+            text = "```json\n" + text + "\n```"
+        if not stream: return FakeResponse(text)
+        return [FakeResponse(text[i:i + self.chunk_chars]) for i in range(0, len(text), self.chunk_chars)]
+
+
+def make_module(latency_s=0.0, invoices_per_file=3):
+    genai = types.SimpleNamespace()
+    genai.configure = lambda **kwargs: None
+    genai.GenerativeModel = lambda name, **kwargs: FakeModel(name, latency_s, invoices_per_file)
+    genai.list_models = lambda: [types.SimpleNamespace(name="models/gemini-2.5-flash", supported_generation_methods=["generateContent"])]
+    return genai
+
+
+def install(backend, latency_s=0.0, invoices_per_file=3):
+    genai = make_module(latency_s, invoices_per_file)
+    backend.load_genai = lambda: genai
+    backend.check_google_key = lambda: True
+    backend.google_api_key = lambda: "fake-key"
+    return genai
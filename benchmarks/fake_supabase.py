@@ -0,0 +1,270 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+# --- 本地 Supabase 替身 (SQLite, 进程内) ---
+# 实现 app 用到的 postgrest 查询构造器子集：
+#   table().select("*, dim_products(grade_code)").eq/neq/gt/gte/lt/lte/in_/ilike/like/or_/order/limit
+#   .upsert(records, on_conflict=...) / .insert / .update / .delete / .execute().data
+#   storage.from_(bucket).upload(path, bytes, opts) / get_public_url(path)
+# 可选 latency_s 模拟每次请求的网络往返时间。
+
+# 事实表的 updated_at：插入时取默认值，每次 UPDATE / upsert 更新时由触发器刷新 (对应线上的 moddatetime 触发器)
+UPDATED_AT = "strftime('%Y-%m-%dT%H:%M:%f', 'now')"
+UPDATED_AT_DDL = f"updated_at TEXT DEFAULT ({UPDATED_AT})"
+
+SCHEMA = {
+    "dim_forests": ("id INTEGER PRIMARY KEY, name TEXT", None),
+    "dim_products": ("id INTEGER PRIMARY KEY, grade_code TEXT", None),
+    "dim_cost_activities": ("id INTEGER PRIMARY KEY, activity_name TEXT, is_lump_sum INTEGER", None),
+    "dim_gl_mappings": ("id INTEGER PRIMARY KEY, forest_id INTEGER, item_type TEXT, item_id INTEGER, gl_code TEXT, gl_name TEXT",
+                        "forest_id,item_type,item_id"),
+    "fact_production_volume": ("id INTEGER PRIMARY KEY, forest_id INTEGER, grade_id INTEGER, month TEXT, record_type TEXT, "
+                               "vol_tonnes REAL, vol_jas REAL, price_jas REAL, amount REAL, created_at TEXT, " + UPDATED_AT_DDL,
+                               "forest_id,grade_id,month,record_type"),
+    "fact_operational_costs": ("id INTEGER PRIMARY KEY, forest_id INTEGER, activity_id INTEGER, month TEXT, record_type TEXT, "
+                               "quantity REAL, unit_rate REAL, total_amount REAL, created_at TEXT, " + UPDATED_AT_DDL,
+                               "forest_id,activity_id,month,record_type"),
+    "actual_sales_transactions": ("id INTEGER PRIMARY KEY, forest_id INTEGER, date TEXT, ticket_number TEXT, compartment TEXT, "
+                                  "sale_type TEXT, grade_id INTEGER, customer TEXT, market TEXT, net_tonnes REAL, jas REAL, "
+                                  "price REAL, levy_deduction REAL, total_value REAL, created_at TEXT, " + UPDATED_AT_DDL, None),
+    "invoice_archive": ("id INTEGER PRIMARY KEY, invoice_no TEXT, vendor TEXT, invoice_date TEXT, description TEXT, amount REAL, "
+                        "file_name TEXT, file_url TEXT, status TEXT, created_at TEXT", None),
+    "closed_periods": ("id INTEGER PRIMARY KEY, forest_id INTEGER, month TEXT, closed_at TEXT, statement TEXT", "forest_id,month"),
+}
+
+# 嵌入关系: select("*, dim_products(grade_code)") -> 通过外键列关联
+EMBEDS = {"dim_products": "grade_id", "dim_cost_activities": "activity_id", "dim_forests": "forest_id"}
+
+_OPS = {"eq": "=", "neq": "!=", "gt": ">", "gte": ">=", "lt": "<", "lte": "<=", "like": "LIKE", "ilike": "LIKE"}
+
+
+class APIError(Exception):
+    def __init__(self, message, code="400"):
+        super().__init__(message)
+        self.code = code
+
+
+class Response:
+    def __init__(self, data):
+        self.data = data
+        self.count = len(data) if isinstance(data, list) else None
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _native(v):
+    """numpy 标量 -> Python 原生类型 (sqlite3 不接受 numpy.int64)；dict / list (jsonb 列) 存为 JSON 文本"""
+    if isinstance(v, (dict, list)): return json.dumps(v)
+    return v.item() if hasattr(v, "item") else v
+
+
+class FakeQuery:
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self.columns = "*"
+        self.where = []
+        self.params = []
+        self.order_by = []
+        self.limit_n = None
+        self.action = "select"
+        self.payload = None
+        self.on_conflict = None
+
+    # --- 读取 ---
+    def select(self, columns="*", **kwargs):
+        self.columns = columns
+        return self
+
+    def _filter(self, op, column, value):
+        if op in ("like", "ilike"): value = str(value).replace("*", "%")
+        self.where.append(f"{column} {_OPS[op]} ?")
+        self.params.append(_native(value))
+        return self
+
+    def eq(self, column, value): return self._filter("eq", column, value)
+    def neq(self, column, value): return self._filter("neq", column, value)
+    def gt(self, column, value): return self._filter("gt", column, value)
+    def gte(self, column, value): return self._filter("gte", column, value)
+    def lt(self, column, value): return self._filter("lt", column, value)
+    def lte(self, column, value): return self._filter("lte", column, value)
+    def like(self, column, value): return self._filter("like", column, value)
+    def ilike(self, column, value): return self._filter("ilike", column, value)
+
+    def in_(self, column, values):
+        values = list(values)
+        if not values:
+            self.where.append("0")
+            return self
+        self.where.append(f"{column} IN ({','.join('?' * len(values))})")
+        self.params.extend(_native(v) for v in values)
+        return self
+
+    def or_(self, filters):
+        parts = []
+        for f in filters.split(","):
+            column, op, value = f.split(".", 2)
+            if op in ("like", "ilike"): value = value.replace("*", "%")
+            parts.append(f"{column} {_OPS[op]} ?")
+            self.params.append(value)
+        self.where.append("(" + " OR ".join(parts) + ")")
+        return self
+
+    def order(self, column, desc=False, **kwargs):
+        self.order_by.append(f"{column} {'DESC' if desc else 'ASC'}")
+        return self
+
+    def limit(self, n, **kwargs):
+        self.limit_n = int(n)
+        return self
+
+    # --- 写入 ---
+    def upsert(self, records, on_conflict=None, **kwargs):
+        self.action, self.payload, self.on_conflict = "upsert", records, on_conflict
+        return self
+
+    def insert(self, records, **kwargs):
+        self.action, self.payload = "insert", records
+        return self
+
+    def update(self, values, **kwargs):
+        self.action, self.payload = "update", values
+        return self
+
+    def delete(self, **kwargs):
+        self.action = "delete"
+        return self
+
+    def execute(self):
+        if self.db.latency_s: time.sleep(self.db.latency_s)
+        with self.db.lock:
+            self.db.calls += 1
+            if self.action == "select": return Response(self._run_select())
+            if self.action in ("upsert", "insert"): return Response(self._run_write())
+            if self.action == "update": return Response(self._run_update())
+            return Response(self._run_delete())
+
+    def _where_sql(self):
+        return (" WHERE " + " AND ".join(self.where)) if self.where else ""
+
+    def _run_select(self):
+        base_cols, embeds = [], []
+        for part in re.findall(r'[\w\*]+(?:\([^)]*\))?', self.columns):
+            m = re.match(r'(\w+)\(([^)]*)\)', part)
+            if m: embeds.append((m.group(1), [c.strip() for c in m.group(2).split(",")]))
+            else: base_cols.append(part)
+        cols = ", ".join(base_cols) if base_cols else "*"
+        sql = f"SELECT {cols} FROM {self.table}{self._where_sql()}"
+        if self.order_by: sql += " ORDER BY " + ", ".join(self.order_by)
+        if self.limit_n is not None: sql += f" LIMIT {self.limit_n}"
+        cur = self.db.conn.execute(sql, self.params)
+        names = [d[0] for d in cur.description]
+        rows = [dict(zip(names, r)) for r in cur.fetchall()]
+
+        for rel, rel_cols in embeds:
+            fk = EMBEDS[rel]
+            ids = list({r.get(fk) for r in rows if r.get(fk) is not None})
+            lookup = {}
+            for i in range(0, len(ids), 900):
+                chunk = ids[i:i + 900]
+                cur = self.db.conn.execute(f"SELECT id, {', '.join(rel_cols)} FROM {rel} WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+                for rec in cur.fetchall(): lookup[rec[0]] = dict(zip(rel_cols, rec[1:]))
+            for r in rows: r[rel] = lookup.get(r.get(fk))
+        return rows
+
+    def _run_write(self):
+        records = self.payload if isinstance(self.payload, list) else [self.payload]
+        if not records: return []
+        conflict = self.on_conflict
+        if self.action == "upsert" and not conflict and all("id" in r for r in records): conflict = "id"
+        # 同一批次里的列集合可能不同，按列集合分组写入
+        groups = {}
+        for r in records: groups.setdefault(tuple(r.keys()), []).append(r)
+        for keys, recs in groups.items():
+            cols = list(keys) + (["created_at"] if "created_at" not in keys and "created_at" in self.db.columns[self.table] else [])
+            sql = f"INSERT INTO {self.table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})"
+            if self.action == "upsert" and conflict:
+                key_cols = [c.strip() for c in conflict.split(",")]
+                updates = [c for c in keys if c not in key_cols]
+                sql += f" ON CONFLICT({conflict}) DO " + ("UPDATE SET " + ", ".join(f"{c}=excluded.{c}" for c in updates) if updates else "NOTHING")
+            now = _now()
+            values = [tuple(_native(r[k]) for k in keys) + ((now,) if len(cols) > len(keys) else ()) for r in recs]
+            try:
+                self.db.conn.executemany(sql, values)
+            except sqlite3.Error as e:
+                raise APIError(str(e)) from e
+        self.db.conn.commit()
+        return records
+
+    def _run_update(self):
+        sets = ", ".join(f"{c} = ?" for c in self.payload)
+        self.db.conn.execute(f"UPDATE {self.table} SET {sets}{self._where_sql()}", [_native(v) for v in self.payload.values()] + self.params)
+        self.db.conn.commit()
+        return [self.payload]
+
+    def _run_delete(self):
+        self.db.conn.execute(f"DELETE FROM {self.table}{self._where_sql()}", self.params)
+        self.db.conn.commit()
+        return []
+
+
+class FakeBucket:
+    def __init__(self, store, bucket):
+        self.store, self.bucket = store, bucket
+
+    def upload(self, path, data, file_options=None):
+        if isinstance(data, str): data = Path(data).read_bytes()  # storage3 也接受本地文件路径
+        self.store[(self.bucket, path)] = bytes(data)
+        return {"Key": f"{self.bucket}/{path}"}
+
+    def get_public_url(self, path):
+        return f"memory://{self.bucket}/{path}"
+
+
+class FakeStorage:
+    def __init__(self):
+        self.objects = {}
+
+    def from_(self, bucket):
+        return FakeBucket(self.objects, bucket)
+
+
+class FakeSupabase:
+    """create_client() 的替身；db_path=':memory:' 时数据只在进程内"""
+
+    def __init__(self, db_path=":memory:", latency_s=0.0):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=MEMORY")
+        self.conn.execute("PRAGMA synchronous=OFF")
+        self.lock = threading.RLock()
+        self.latency_s = latency_s
+        self.calls = 0
+        self.columns = {}
+        self.storage = FakeStorage()
+        for table, (ddl, unique) in SCHEMA.items():
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({ddl})")
+            if unique: self.conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS ux_{table} ON {table} ({unique})")
+            self.columns[table] = [r[1] for r in self.conn.execute(f"PRAGMA table_info({table})")]
+            if "updated_at" in self.columns[table]:
+                self.conn.execute(f"""CREATE TRIGGER IF NOT EXISTS tu_{table} AFTER UPDATE ON {table}
+                                      FOR EACH ROW WHEN NEW.updated_at IS OLD.updated_at
+                                      BEGIN UPDATE {table} SET updated_at = {UPDATED_AT} WHERE id = NEW.id; END""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ix_sales_forest_date ON actual_sales_transactions (forest_id, date)")
+        self.conn.commit()
+
+    def table(self, name):
+        if name not in SCHEMA: raise APIError(f"relation \"{name}\" does not exist", code="42P01")
+        return FakeQuery(self, name)
+
+    def bulk_load(self, table, rows, columns):
+        """种子数据直接 executemany，绕过查询构造器"""
+        with self.lock:
+            self.conn.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", rows)
+            self.conn.commit()
@@ -0,0 +1,158 @@
+"""
+离线性能基准：不需要 Supabase / Gemini。
+
+    python -m benchmarks.run_benchmarks --scales 1k,100k --repeat 5
+    python -m benchmarks.run_benchmarks --scales 1m --db-latency 0.02 --ai-latency 1.5 --json bench.json
+
+每个场景先计时跑 --repeat 次 (取中位数)，再单独用 tracemalloc 跑一次测峰值内存，
+避免 tracemalloc 的开销混进耗时。数据库与 AI 延迟默认为 0，只测本地 CPU 开销；
+加上 --db-latency 可以看出 N+1 查询的代价。
+"""
+import argparse
+import io
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+import warnings
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+warnings.filterwarnings("ignore")
+
+import pandas as pd
+
+import backend
+import db_client
+import query_profiler
+import views_admin
+import views_dashboard
+from benchmarks import fake_gemini, seed
+from benchmarks.fake_supabase import FakeSupabase
+
+VOL_COLS = ['vol_tonnes', 'vol_jas', 'price_jas', 'amount']
+COST_COLS = ['quantity', 'unit_rate', 'total_amount']
+
+
+class FakeUpload(io.BytesIO):
+    """st.file_uploader 返回对象的替身 (有 .name)"""
+
+    def __init__(self, name, data=None):
+        super().__init__(data if data is not None else f"%PDF-1.4 synthetic {name}".encode())
+        self.name = name
+
+
+def install_fakes(scale, db_latency, ai_latency):
+    raw = FakeSupabase()
+    summary = seed.seed(raw, scale)
+    raw.latency_s = db_latency  # 种子写入不计延迟
+    backend.supabase = db_client.DataClient(raw)
+    fake_gemini.install(backend, latency_s=ai_latency)
+    return raw, summary
+
+
+def measure(fn, repeat):
+    times, result = [], None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, times, peak
+
+
+def scenarios(summary):
+    year = summary["year"]
+    fid = 1
+    target_date = f"{year}-01-01"
+    df_budget_vol = backend.get_monthly_data("fact_production_volume", "dim_products", "grade_id", "grade_code",
+                                             fid, target_date, "Budget", VOL_COLS)
+    _, _, df_sales, df_costs = views_dashboard.load_invoice_data(fid, year, 1)
+    invoices = [FakeUpload(f"bundle_{i:03d}.pdf") for i in range(10)]
+    gl_frame = seed.gl_upload_frame(summary)
+    forests = backend.supabase.table("dim_forests").select("*").execute().data
+    acts = backend.supabase.table("dim_cost_activities").select("*").execute().data
+    prods = backend.supabase.table("dim_products").select("*").execute().data
+
+    def extract_and_reconcile():
+        results = [r for f in invoices for r in backend.real_extract_invoice_data(f)]
+        return backend.reconcile_invoices(results)
+
+    def gl_upload():
+        records, errors = views_admin.build_gl_mapping_records(gl_frame, forests, acts, prods)
+        backend.bulk_upsert("dim_gl_mappings", records, "forest_id,item_type,item_id")
+        return records
+
+    # (名称, 函数, 每次调用处理的 "行数"，用于计算吞吐)
+    return [
+        ("get_monthly_data", lambda: backend.get_monthly_data("fact_operational_costs", "dim_cost_activities", "activity_id",
+                                                              "activity_name", fid, target_date, "Actual", COST_COLS), None),
+        ("save_monthly_data", lambda: backend.save_monthly_data(df_budget_vol, "fact_production_volume", "grade_id",
+                                                                fid, target_date, "Budget"), len(df_budget_vol)),
+        ("calculate_invoice_context", lambda: views_dashboard.calculate_invoice_context(df_sales, df_costs, 8.0),
+         len(df_sales) + len(df_costs)),
+        ("analysis_page_load", lambda: views_dashboard.load_invoice_data(fid, year, 1), None),
+        ("reconcile_10_pdfs", extract_and_reconcile, None),
+        ("admin_gl_upload_10k", gl_upload, len(gl_frame)),
+    ]
+
+
+def rows_of(result):
+    if isinstance(result, pd.DataFrame): return len(result)
+    if isinstance(result, (list, tuple)):
+        if result and isinstance(result[-1], pd.DataFrame): return sum(len(x) for x in result if isinstance(x, pd.DataFrame))
+        return len(result)
+    return 1
+
+
+def run_scale(scale, repeat, db_latency, ai_latency):
+    t0 = time.perf_counter()
+    raw, summary = install_fakes(scale, db_latency, ai_latency)
+    seed_s = time.perf_counter() - t0
+    print(f"\n== scale {scale}: {summary['facts']:,} facts, {summary['forests']} forests x {summary['years']} years, "
+          f"{summary['sales']:,} sales (seeded in {seed_s:.1f}s) ==")
+    print(f"{'benchmark':<28}{'median ms':>12}{'min ms':>10}{'rows/s':>14}{'peak MB':>10}{'queries':>9}")
+
+    out = []
+    for name, fn, n_rows in scenarios(summary):
+        trace = query_profiler.start_rerun(name)
+        result, times, peak = measure(fn, repeat)
+        query_profiler.finish_rerun(trace, [])
+        med = statistics.median(times)
+        rows = n_rows if n_rows is not None else rows_of(result)
+        queries = sum(1 for e in trace["events"] if e["kind"] == "db") // (repeat + 1)
+        row = {"scale": scale, "benchmark": name, "median_ms": med * 1000, "min_ms": min(times) * 1000,
+               "rows": rows, "rows_per_s": rows / med if med else None, "peak_mb": peak / 2 ** 20, "queries": queries}
+        out.append(row)
+        print(f"{name:<28}{row['median_ms']:>12.2f}{row['min_ms']:>10.2f}{row['rows_per_s'] or 0:>14,.0f}"
+              f"{row['peak_mb']:>10.2f}{queries:>9}")
+    raw.conn.close()
+    return out
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Offline benchmarks against an in-process Supabase / Gemini stand-in")
+    ap.add_argument("--scales", default="1k,100k", help="comma separated: 1k,100k,1m or a fact row count")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--db-latency", type=float, default=0.0, help="seconds added to every query round trip")
+    ap.add_argument("--ai-latency", type=float, default=0.0, help="seconds per fake Gemini call")
+    ap.add_argument("--json", help="write results to this file")
+    args = ap.parse_args(argv)
+
+    results = []
+    for scale in args.scales.split(","):
+        scale = scale.strip().lower()
+        results += run_scale(scale if scale in seed.SCALES else int(scale), args.repeat, args.db_latency, args.ai_latency)
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+        print(f"\nwrote {args.json}")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import random
+from datetime import date
+
+# --- 合成数据 ---
+# 规模以 fact 行数计 (fact_production_volume + fact_operational_costs 合计)：
+# 维度表大小固定 (22 个 Grade, 26 个 Activity)，通过增加林地数和年份数来放大事实表。
+
+SCALES = {"1k": 1_000, "100k": 100_000, "1m": 1_000_000}
+
+GRADES = ["A", "AS", "K", "KS", "KI", "KIS", "P40", "S30", "S20", "L1", "L2", "L3",
+          "Pulp", "Chip", "Domestic S1", "Domestic S2", "Domestic L", "Domestic P", "PEELER", "J", "JS", "Export Other"]
+ACTIVITIES = ["Log and Load", "Log Transport", "Roading", "Pruning", "Thinning", "Aerial Spraying", "Releasing",
+              "Planting", "Seedlings", "Fire Insurance", "Rates", "Harvest Management", "Forest Management",
+              "Engineering", "Road Maintenance", "Culverts", "Boundary Fencing", "Pest Control", "Weed Control",
+              "Mapping", "Inventory", "Consents", "Legal", "Audit", "Other infrastructure", "Security"]
+LUMP_SUM = {"Fire Insurance", "Rates", "Legal", "Audit", "Consents"}
+SALE_TYPES = ["Purchase", "Agency", "Purchase - Export", "Domestic"]
+
+SEED_YEAR = 2025
+
+
+def _months_for(n_years):
+    return [date(SEED_YEAR - y, m, 1).isoformat() for y in range(n_years) for m in range(1, 13)]
+
+
+def plan(scale):
+    """返回 (n_forests, n_years)，使 2 种 record_type × 12 个月 × (grades + activities) × forests × years ≈ scale"""
+    per_forest_year = 2 * 12 * (len(GRADES) + len(ACTIVITIES))
+    cells = max(1, round(scale / per_forest_year))
+    n_years = min(cells, 5)
+    n_forests = max(1, round(cells / n_years))
+    return n_forests, n_years
+
+
+def seed(db, scale="1k", sales_per_forest_month=40, rnd=None):
+    """往 FakeSupabase 写入维度表和事实表，返回种子摘要"""
+    rnd = rnd or random.Random(42)
+    target = SCALES[scale] if isinstance(scale, str) else int(scale)
+    n_forests, n_years = plan(target)
+    months = _months_for(n_years)
+
+    db.bulk_load("dim_forests", [(i + 1, f"Forest {i + 1:03d}") for i in range(n_forests)], ["id", "name"])
+    db.bulk_load("dim_products", [(i + 1, g) for i, g in enumerate(GRADES)], ["id", "grade_code"])
+    db.bulk_load("dim_cost_activities", [(i + 1, a, int(a in LUMP_SUM)) for i, a in enumerate(ACTIVITIES)],
+                 ["id", "activity_name", "is_lump_sum"])
+
+    vol_rows, cost_rows = [], []
+    for fid in range(1, n_forests + 1):
+        for month in months:
+            for rt in ("Budget", "Actual"):
+                for gid in range(1, len(GRADES) + 1):
+                    t = rnd.uniform(50, 3000); price = rnd.uniform(80, 180)
+                    vol_rows.append((fid, gid, month, rt, t, t * 0.9, price, t * 0.9 * price))
+                for aid in range(1, len(ACTIVITIES) + 1):
+                    q = rnd.uniform(10, 2000); rate = rnd.uniform(5, 60)
+                    cost_rows.append((fid, aid, month, rt, q, rate, q * rate))
+            if len(vol_rows) > 50_000:
+                db.bulk_load("fact_production_volume", vol_rows, ["forest_id", "grade_id", "month", "record_type", "vol_tonnes", "vol_jas", "price_jas", "amount"])
+                db.bulk_load("fact_operational_costs", cost_rows, ["forest_id", "activity_id", "month", "record_type", "quantity", "unit_rate", "total_amount"])
+                vol_rows, cost_rows = [], []
+    db.bulk_load("fact_production_volume", vol_rows, ["forest_id", "grade_id", "month", "record_type", "vol_tonnes", "vol_jas", "price_jas", "amount"])
+    db.bulk_load("fact_operational_costs", cost_rows, ["forest_id", "activity_id", "month", "record_type", "quantity", "unit_rate", "total_amount"])
+
+    sales = []
+    for fid in range(1, n_forests + 1):
+        for month in months[:12]:
+            y, m = int(month[:4]), int(month[5:7])
+            for k in range(sales_per_forest_month):
+                t = rnd.uniform(20, 32); price = rnd.uniform(90, 170)
+                sales.append((fid, date(y, m, 1 + k % 28).isoformat(), f"T{fid:03d}{m:02d}{k:04d}", f"C{k % 7}",
+                              rnd.choice(SALE_TYPES), rnd.randint(1, len(GRADES)), "FCO",
+                              "Domestic" if k % 5 == 0 else "Export", t, t * 0.9, price, t * 0.3, t * 0.9 * price))
+    db.bulk_load("actual_sales_transactions", sales,
+                 ["forest_id", "date", "ticket_number", "compartment", "sale_type", "grade_id", "customer", "market",
+                  "net_tonnes", "jas", "price", "levy_deduction", "total_value"])
+
+    gl = [(fid, "Cost", aid, f"6{aid:03d}", f"{name} expense") for fid in range(1, n_forests + 1) for aid, name in enumerate(ACTIVITIES, 1)]
+    gl += [(fid, "Revenue", gid, f"4{gid:03d}", f"{name} sales") for fid in range(1, n_forests + 1) for gid, name in enumerate(GRADES, 1)]
+    db.bulk_load("dim_gl_mappings", gl, ["forest_id", "item_type", "item_id", "gl_code", "gl_name"])
+
+    facts = n_forests * len(months) * 2 * (len(GRADES) + len(ACTIVITIES))
+    return {"scale": scale, "forests": n_forests, "years": n_years, "facts": facts, "sales": len(sales), "gl_mappings": len(gl),
+            "year": SEED_YEAR, "forest_names": [f"Forest {i + 1:03d}" for i in range(n_forests)]}
+
+
+def gl_upload_frame(summary, rows=10_000, rnd=None):
+    """模拟 Admin 上传的 GL Mapping 文件 (含少量拼写不一致，走模糊匹配和报错分支)"""
+    import pandas as pd
+    rnd = rnd or random.Random(7)
+    out = []
+    for i in range(rows):
+        is_cost = i % 2 == 0
+        name = rnd.choice(ACTIVITIES) if is_cost else rnd.choice(GRADES)
+        if is_cost and i % 10 == 0: name = f"{name} (contract)"
+        if i % 97 == 0: name = "Unknown Item"
+        out.append({"Company": rnd.choice(summary["forest_names"]), "Type": "Cost" if is_cost else "Revenue",
+                    "Item Name": name, "GL Code": 5000 + i % 900, "GL Name": f"GL {name}"})
+    return pd.DataFrame(out)
@@ -0,0 +1,159 @@
+import hashlib
+import mmap
+import os
+import sqlite3
+import time
+import uuid
+from pathlib import Path
+
+# --- 上传文件的落盘存储 (按内容哈希寻址，引用计数) ---
+# 上传的 PDF 边读边算 sha256 边写盘 (一遍读取)，之后只在 session / 任务队列里传递哈希 (handle)：
+#   <FCO_BLOB_DIR>/ab/abcdef....bin
+# 同样内容的文件只存一份；每个引用方 (任务队列里的一个文件) 持有一个引用，release 到 0 时删除文件。
+# 读取走内存映射 (BlobFile.getbuffer() 是映射上的 memoryview)，不把整份文件复制进 Python 堆；归档上传直接传文件路径。
+
+BLOB_DIR = Path(os.environ.get("FCO_BLOB_DIR", ".fco_blobs"))
+READ_CHUNK = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+_schema_ready = set()
+
+
+def _connect():
+    BLOB_DIR.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(BLOB_DIR / "index.sqlite", timeout=30, isolation_level=None)
+    if str(BLOB_DIR) not in _schema_ready:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.executescript(SCHEMA)
+        _schema_ready.add(str(BLOB_DIR))
+    return conn
+
+
+def path(digest):
+    return BLOB_DIR / digest[:2] / f"{digest}.bin"
+
+
+def put(src, digest=None):
+    """
+    写入一个 blob 并持有一个引用，返回 (digest, size)。
+    src 为 bytes 或文件对象 (按块读取，边读边算哈希边写临时文件，不在内存里拼整份内容)。
+    已用 content_hash 算过哈希时传入 digest，只写盘不再重复计算。
+    """
+    BLOB_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = BLOB_DIR / f"_{uuid.uuid4().hex}.tmp"
+    h, size = hashlib.sha256(), 0
+    try:
+        with open(tmp, "wb") as out:
+            if isinstance(src, (bytes, bytearray, memoryview)):
+                if digest is None: h.update(src)
+                out.write(src); size = len(src)
+            else:
+                src.seek(0)
+                for chunk in iter(lambda: src.read(READ_CHUNK), b""):
+                    if digest is None: h.update(chunk)
+                    out.write(chunk); size += len(chunk)
+        digest = digest or h.hexdigest()
+        conn = _connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            target = path(digest)
+            if not target.exists():  # 同样内容已存在时丢弃临时文件，只加引用
+                target.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(tmp, target)
+            conn.execute("""INSERT INTO blobs (digest, size, refs, created_at) VALUES (?, ?, 1, ?)
+                            ON CONFLICT (digest) DO UPDATE SET refs = refs + 1""", (digest, size, time.time()))
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return digest, size
+    finally:
+        if tmp.exists(): tmp.unlink()
+
+
+def content_hash(src):
+    """只计算 sha256 (不写盘)，结果与 put() 返回的 digest 相同"""
+    h = hashlib.sha256()
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        h.update(src)
+    else:
+        src.seek(0)
+        for chunk in iter(lambda: src.read(READ_CHUNK), b""): h.update(chunk)
+        src.seek(0)
+    return h.hexdigest()
+
+
+def release(digest):
+    """释放一个引用；引用数归零时删除文件"""
+    if not digest: return
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("UPDATE blobs SET refs = refs - 1 WHERE digest = ?", (digest,))
+        row = conn.execute("SELECT refs FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        if row is not None and row[0] <= 0:
+            conn.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+            if path(digest).exists(): path(digest).unlink()
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+def exists(digest):
+    return bool(digest) and path(digest).exists()
+
+
+class BlobFile:
+    """
+    只读、内存映射的 blob，带 .name，可以当作上传文件对象传给 real_extract_invoice_data。
+    getbuffer() 返回映射上的 memoryview (与 io.BytesIO.getbuffer 一致)，不复制内容；read() 会返回 bytes 副本。
+    """
+
+    def __init__(self, digest, name):
+        self.name, self.digest = name, digest
+        self._f = open(path(digest), "rb")
+        size = os.fstat(self._f.fileno()).st_size
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self._view = None
+
+    def getbuffer(self):
+        if self._mm is None: return memoryview(b"")
+        if self._view is None: self._view = memoryview(self._mm)
+        return self._view
+
+    def read(self, n=-1):
+        return self._mm.read(n) if self._mm is not None else b""
+
+    def seek(self, pos, whence=0):
+        return self._mm.seek(pos, whence) if self._mm is not None else 0
+
+    def tell(self):
+        return self._mm.tell() if self._mm is not None else 0
+
+    def close(self):
+        if self._view is not None: self._view.release()  # 有导出的 memoryview 时 mmap 不能关闭
+        if self._mm is not None: self._mm.close()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def stats():
+    """{"blobs", "bytes", "refs"}，供 Admin / 调试查看"""
+    conn = _connect()
+    try:
+        n, size, refs = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(refs), 0) FROM blobs").fetchone()
+    finally:
+        conn.close()
+    return {"blobs": n, "bytes": size, "refs": refs}
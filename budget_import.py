@@ -0,0 +1,267 @@
+import re
+import time
+from datetime import date, datetime
+
+import pandas as pd
+import backend
+
+# --- FCO Budget 工作簿导入 ---
+# 对应 "FCO Budget 2025 New.xlsx" 中每个 "<Forest> Budget" 工作表的固定布局:
+#   PRODUCTION & RATE -> 每月采伐吨数 / 采伐单价
+#   REVENUE           -> 每个 Grade 的配比、换算率、单价与月度收入
+#   COSTS             -> Log and Load (采伐), Log Transport (按 Grade 运输), Non-docket costs (其他作业)
+# 只读 + 流式逐行读取 (openpyxl read_only)，不会把整本工作簿载入内存。
+# 12 个月全为 0 的行 (空白模板、未填写的 Grade / 作业) 不写入，避免用 0 覆盖数据库里已有的 Budget。
+
+SHEET_SUFFIX = " Budget"
+FIRST_MONTH_COL = 9  # J 列 (0-based)
+TRANSPORT_ACTIVITY_NAMES = ["Log Transport", "Transport", "Cartage"]
+LOGGING_ACTIVITY_NAMES = ["Log and Load", "Logging"]
+
+
+def normalize_name(value):
+    """统一大小写和标点，作为索引 key ('Mount Erin (T&M)' -> 'mounterintm')"""
+    return re.sub(r'[^a-z0-9]', '', str(value).lower())
+
+
+def _strip_paren(value):
+    return re.sub(r'\(.*?\)', '', str(value)).strip()
+
+
+def build_index(records, *name_cols):
+    """把维度表建成 {normalized name: id} 字典，多个候选列按顺序写入，先到先得"""
+    index = {}
+    for col in name_cols:
+        for rec in records:
+            name = rec.get(col)
+            if name is None or name == "": continue
+            index.setdefault(normalize_name(name), rec['id'])
+    return index
+
+
+def lookup(index, *candidates):
+    for c in candidates:
+        if c is None: continue
+        hit = index.get(normalize_name(c))
+        if hit is not None: return hit
+    return None
+
+
+def _num(value):
+    """Excel 里的 '#DIV/0!'、空单元格等统一视为 0"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool): return float(value)
+    return 0.0
+
+
+def _is_month_header(value):
+    return isinstance(value, (datetime, date)) or (isinstance(value, (int, float)) and 40000 < value < 60000)
+
+
+def parse_budget_sheet(rows):
+    """
+    逐行解析一个 Budget 工作表 (rows 为 values_only 的 tuple 迭代器)。
+    返回 {'year', 'forest', 'tonnes', 'volume': [...], 'costs': [...]}，
+    其中 volume/costs 为每个来源行一个 dict，月度数值为长度 12 的列表。
+    """
+    sheet = {'year': None, 'forest': None, 'tonnes': [0.0] * 12, 'rate': [0.0] * 12, 'volume': [], 'costs': []}
+    month_col = FIRST_MONTH_COL
+    section = None
+    transport = [0.0] * 12
+
+    for row_no, row in enumerate(rows, start=1):
+        row = tuple(row) + (None,) * max(0, 24 - len(row))
+        b, c, d, g, h = row[1], row[2], row[3], row[6], row[7]
+        label = str(b).strip() if b is not None else ""
+
+        if row_no == 1 and isinstance(c, (int, float)): sheet['year'] = int(c)
+        if row_no == 2 and label: sheet['forest'] = label
+
+        # 月份表头 (J..U 为 12 个日期)，顺便校准起始列
+        if section is None and label == "PRODUCTION & RATE":
+            for i in range(8, len(row) - 11):
+                if all(_is_month_header(v) for v in row[i:i + 12]):
+                    month_col = i; break
+            section = "production"; continue
+
+        months = [_num(v) for v in row[month_col:month_col + 12]]
+
+        if label == "REVENUE": section = "revenue"; continue
+        if label == "COSTS": section = "logging"; continue
+        if label == "Log Transport": section = "transport"; continue
+        if label == "Non-docket costs": section = "nondocket"; continue
+        if label in ("Total non-docket costs", "Engineering", "Summary"):
+            section = "done" if label != "Total non-docket costs" else None
+            continue
+        if label in ("Grade", "Operation"): continue
+
+        if section == "production":
+            if str(g).strip() == "Total" and str(h).strip() == "Tonnes Harvested": sheet['tonnes'] = months
+            elif str(g).strip() == "Average" and str(h).strip() == "Harvesting Rate": sheet['rate'] = months
+
+        elif section == "revenue":
+            if label in ("Export Sales", "Domestic Sales", "TOTAL"): section = None; continue
+            if not label: continue
+            mix, conv, price = _num(c), _num(d) or 1.0, _num(g)
+            tonnes = [t * mix for t in sheet['tonnes']]
+            sheet['volume'].append({
+                'row': row_no, 'grade': label,
+                'vol_tonnes': tonnes, 'vol_jas': [t * conv for t in tonnes],
+                'price_jas': [price] * 12, 'amount': months,
+            })
+
+        elif section == "logging":
+            # "Log and Load" 下方第一条无标签的数值行即为采伐成本
+            if not label and isinstance(h, (int, float)):
+                sheet['costs'].append({
+                    'row': row_no, 'names': LOGGING_ACTIVITY_NAMES, 'op_code': "300/01", 'section': 'Log and Load',
+                    'quantity': list(sheet['tonnes']), 'total_amount': months,
+                })
+                section = None
+
+        elif section == "transport":
+            if label:
+                transport = [a + m for a, m in zip(transport, months)]
+            elif isinstance(h, (int, float)):
+                sheet['costs'].append({
+                    'row': row_no, 'names': TRANSPORT_ACTIVITY_NAMES, 'op_code': str(c or "300/02"), 'section': 'Log Transport',
+                    'quantity': list(sheet['tonnes']), 'total_amount': transport,
+                })
+                section = None
+
+        elif section == "nondocket" and label:
+            rate = _num(g)
+            sheet['costs'].append({
+                'row': row_no, 'names': [label], 'op_code': str(c) if c is not None else None, 'section': str(d or ''),
+                'unit_rate': rate, 'total_amount': months,
+            })
+
+    return sheet
+
+
+def read_budget_workbook(file, only_sheets=None):
+    """流式遍历工作簿中所有 '<Forest> Budget' 表，逐个 yield (sheet_name, parsed)"""
+    from openpyxl import load_workbook  # 只在导入时才需要
+
+    wb = load_workbook(file, read_only=True, data_only=True)
+    try:
+        for name in wb.sheetnames:
+            if not name.endswith(SHEET_SUFFIX): continue
+            if only_sheets and name not in only_sheets: continue
+            yield name, parse_budget_sheet(wb[name].iter_rows(values_only=True))
+    finally:
+        wb.close()
+
+
+VOLUME_MONTH_KEYS = ('vol_tonnes', 'vol_jas', 'amount')
+COST_MONTH_KEYS = ('quantity', 'total_amount')
+
+
+def is_empty_line(line, keys):
+    """该行所有月度数值都是 0 (单价不算：模板里常有单价但没有数量)"""
+    return all(not v for k in keys if k in line for v in line[k])
+
+
+def _volume_records(line, forest_id, year):
+    return [{
+        "forest_id": forest_id, "grade_id": line['grade_id'], "month": f"{year}-{m + 1:02d}-01", "record_type": "Budget",
+        "vol_tonnes": line['vol_tonnes'][m], "vol_jas": line['vol_jas'][m],
+        "price_jas": line['price_jas'][m], "amount": line['amount'][m],
+    } for m in range(12)]
+
+
+def _cost_frame(lines):
+    """同一 activity 可能来自多行 (例如两个 'Other infrastructure')，按 (activity, month) 合并，避免一次 upsert 命中同一行两次"""
+    rows = []
+    for line in lines:
+        for m in range(12):
+            total = line['total_amount'][m]
+            if 'quantity' in line:
+                qty = line['quantity'][m]
+            else:
+                rate = line.get('unit_rate', 0.0)
+                qty = total / rate if rate else (1.0 if total else 0.0)
+            rows.append((line['activity_id'], m + 1, qty, total))
+    df = pd.DataFrame(rows, columns=['activity_id', 'month_no', 'quantity', 'total_amount'])
+    df = df.groupby(['activity_id', 'month_no'], as_index=False)[['quantity', 'total_amount']].sum()
+    df['unit_rate'] = (df['total_amount'] / df['quantity']).where(df['quantity'] != 0, 0.0)
+    return df
+
+
+def import_budget_workbook(file, dry_run=False, only_sheets=None):
+    """
+    导入整本 Budget 工作簿，写入全年的 Budget 行 (fact_production_volume / fact_operational_costs)。
+    返回报告 dict: 每张表的写入行数、跳过的全 0 行数、未匹配行、各阶段耗时 (秒)。
+    """
+    report = {"sheets": [], "unmatched": [], "timings": {}, "volume_rows": 0, "cost_rows": 0, "empty_lines": 0}
+    if not backend.supabase: return report
+
+    t0 = time.perf_counter()
+    forests = backend.supabase.table("dim_forests").select("id,name").execute().data
+    products = backend.supabase.table("dim_products").select("id,grade_code").execute().data
+    # op_code / code 是可选列，activities 仍取全部列
+    activities = backend.supabase.table("dim_cost_activities").select("*").execute().data
+    forest_idx = build_index(forests, 'name')
+    grade_idx = build_index(products, 'grade_code')
+    act_idx = build_index(activities, 'activity_name')
+    code_col = next((c for c in ('op_code', 'code') if activities and c in activities[0]), None)
+    code_idx = build_index(activities, code_col) if code_col else {}
+    report["timings"]["load_dimensions"] = time.perf_counter() - t0
+
+    parse_time = 0.0; write_time = 0.0
+    t_parse = time.perf_counter()
+    for sheet_name, sheet in read_budget_workbook(file, only_sheets):
+        parse_time += time.perf_counter() - t_parse
+
+        forest_label = sheet['forest'] or sheet_name[:-len(SHEET_SUFFIX)]
+        forest_id = lookup(forest_idx, forest_label, _strip_paren(forest_label), sheet_name[:-len(SHEET_SUFFIX)])
+        year = sheet['year']
+        if forest_id is None or year is None:
+            report["unmatched"].append({"sheet": sheet_name, "section": "Sheet", "row": None, "item": forest_label,
+                                        "reason": "Forest not found" if forest_id is None else "Year missing (C1)"})
+            t_parse = time.perf_counter(); continue
+
+        vol_lines, cost_lines, empty = [], [], 0
+        for line in sheet['volume']:
+            if is_empty_line(line, VOLUME_MONTH_KEYS): empty += 1; continue
+            gid = lookup(grade_idx, line['grade'])
+            if gid is None:
+                report["unmatched"].append({"sheet": sheet_name, "section": "Revenue", "row": line['row'], "item": line['grade'], "reason": "Grade not in dim_products"})
+                continue
+            line['grade_id'] = gid
+            vol_lines.append(line)
+
+        for line in sheet['costs']:
+            if is_empty_line(line, COST_MONTH_KEYS): empty += 1; continue
+            aid = lookup(act_idx, *line['names']) or (code_idx.get(normalize_name(line['op_code'])) if line.get('op_code') else None)
+            if aid is None:
+                report["unmatched"].append({"sheet": sheet_name, "section": line['section'], "row": line['row'], "item": line['names'][0], "reason": "Activity not in dim_cost_activities"})
+                continue
+            line['activity_id'] = aid
+            cost_lines.append(line)
+
+        vol_records = [r for line in vol_lines for r in _volume_records(line, forest_id, year)]
+        cost_records = []
+        if cost_lines:
+            df_cost = _cost_frame(cost_lines)
+            cost_records = [{
+                "forest_id": forest_id, "activity_id": backend.to_native(aid), "month": f"{year}-{int(m):02d}-01", "record_type": "Budget",
+                "quantity": float(q), "unit_rate": float(r), "total_amount": float(t),
+            } for aid, m, q, t, r in df_cost[['activity_id', 'month_no', 'quantity', 'total_amount', 'unit_rate']].itertuples(index=False)]
+
+        t_write = time.perf_counter()
+        if not dry_run:
+            if vol_records: backend.bulk_upsert("fact_production_volume", vol_records, "forest_id,grade_id,month,record_type")
+            if cost_records: backend.bulk_upsert("fact_operational_costs", cost_records, "forest_id,activity_id,month,record_type")
+        write_time += time.perf_counter() - t_write
+
+        report["volume_rows"] += len(vol_records)
+        report["cost_rows"] += len(cost_records)
+        report["empty_lines"] += empty
+        report["sheets"].append({"sheet": sheet_name, "forest_id": forest_id, "year": year,
+                                 "volume_rows": len(vol_records), "cost_rows": len(cost_records), "empty_lines": empty})
+        t_parse = time.perf_counter()
+
+    report["timings"]["parse_workbook"] = parse_time
+    report["timings"]["upsert"] = write_time
+    report["timings"]["total"] = time.perf_counter() - t0
+    return report
@@ -0,0 +1,192 @@
+import random
+import threading
+import time
+
+import httpx
+from supabase import create_client
+
+import query_profiler
+
+# --- 统一的数据访问客户端 ---
+# 所有页面 (backend.supabase) 和独立脚本共用一个 Supabase 客户端：
+#   - httpx 连接池 (keep-alive, 最大连接数) 在多个会话之间复用
+#   - 每次请求都有超时
+#   - 幂等请求 (select，以及带 on_conflict 或每行都带主键 id 的 upsert) 遇到网络抖动、5xx、429 自动重试，
+#     指数退避 + 随机抖动；不带冲突键的 upsert 等同于 insert，超时后服务器可能已经写入，重试会产生重复行，不重试
+#   - 连续失败达到阈值后熔断一段时间，直接快速失败，不再让每个页面都卡在超时上；
+#     冷却结束后只放行一个试探请求 (half-open)，成功才恢复，失败继续熔断
+# 用法与原生客户端一致: client.table("x").select("*").eq(...).execute()
+# 每次 execute() 都会记录到 query_profiler (表名、过滤条件、行数、字节、耗时)。
+
+POOL_MAX_CONNECTIONS = 20
+POOL_MAX_KEEPALIVE = 10
+POOL_KEEPALIVE_EXPIRY = 30.0
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 20.0
+
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.25
+BACKOFF_MAX = 4.0
+
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30.0
+
+TRANSIENT_STATUS = {"408", "425", "429", "500", "502", "503", "504"}
+NON_IDEMPOTENT = {"insert", "update", "delete", "rpc"}
+
+
+class CircuitOpenError(RuntimeError):
+    """熔断期间直接抛出，调用方按普通数据库错误处理即可"""
+
+
+def is_transient(exc):
+    """网络层错误或 5xx/429 视为暂时性错误，可以重试"""
+    if isinstance(exc, (httpx.TransportError, httpx.TimeoutException)): return True
+    code = str(getattr(exc, "code", "") or getattr(getattr(exc, "response", None), "status_code", ""))
+    return code in TRANSIENT_STATUS
+
+
+def upsert_is_idempotent(args, kwargs):
+    """upsert 只有在能按冲突键覆盖时才可以安全重试：显式 on_conflict，或每一行都带主键 id"""
+    if kwargs.get("on_conflict"): return True
+    rows = args[0] if args else kwargs.get("json")
+    rows = rows if isinstance(rows, list) else [rows]
+    return bool(rows) and all(isinstance(r, dict) and r.get("id") is not None for r in rows)
+
+
+def backoff_delay(attempt):
+    """Full jitter: 在 [0, min(max, base * 2^attempt)] 之间随机等待，避免多个会话同时重试"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None: return True
+            # 冷却结束后只放行一个试探请求 (half-open)，其它并发请求在试探结束前继续快速失败
+            if not self.probing and time.monotonic() - self.opened_at >= self.cooldown:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+
+class QueryProxy:
+    """包装 postgrest 查询构造器：链式调用照常转发，execute() 时套用重试/熔断策略"""
+
+    def __init__(self, client, table, builder, idempotent=True, calls=()):
+        self._client = client
+        self._table = table
+        self._builder = builder
+        self._idempotent = idempotent
+        self._calls = calls
+
+    def __getattr__(self, name):
+        attr = getattr(self._builder, name)
+        if not callable(attr): return attr
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if hasattr(result, "execute"):
+                # 写入类调用只记录方法名，不把整批 payload 放进 profile
+                logged = args if name not in ("insert", "upsert", "update") else (f"{len(args[0]) if args and isinstance(args[0], list) else 1} rows",)
+                idempotent = self._idempotent and name not in NON_IDEMPOTENT and (name != "upsert" or upsert_is_idempotent(args, kwargs))
+                return QueryProxy(self._client, self._table, result, idempotent, self._calls + ((name, logged),))
+            return result
+        return call
+
+    # postgrest 的 .not_ 是属性而不是方法
+    @property
+    def not_(self):
+        return QueryProxy(self._client, self._table, self._builder.not_, self._idempotent, self._calls + (("not", ()),))
+
+    def execute(self):
+        t0 = time.perf_counter()
+        rows, nbytes, error = 0, 0, None
+        try:
+            res = self._client.run(self._builder.execute, idempotent=self._idempotent)
+            data = getattr(res, "data", None)
+            rows = len(data) if isinstance(data, list) else (1 if data else 0)
+            nbytes = query_profiler.estimate_bytes(data)
+            return res
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            query_profiler.record("db", self._table, query_profiler.describe_calls(self._calls), rows, nbytes,
+                                  time.perf_counter() - t0, error, query_profiler.call_shape(self._calls))
+
+
+class DataClient:
+    def __init__(self, raw_client, breaker=None, max_retries=MAX_RETRIES):
+        self.raw = raw_client
+        self.breaker = breaker or CircuitBreaker()
+        self.max_retries = max_retries
+
+    def table(self, name):
+        return QueryProxy(self, name, self.raw.table(name))
+
+    def __getattr__(self, name):
+        # storage / auth 等直接使用原生客户端 (上传不是幂等的，不自动重试)
+        return getattr(self.raw, name)
+
+    def run(self, fn, idempotent=True):
+        attempts = self.max_retries + 1 if idempotent else 1
+        for attempt in range(attempts):
+            if not self.breaker.allow():
+                raise CircuitOpenError("Supabase circuit open: too many consecutive failures, retrying later")
+            try:
+                result = fn()
+                self.breaker.record_success()
+                return result
+            except Exception as e:
+                if not is_transient(e):
+                    # 服务器正常返回了错误 (4xx 等)：连接是好的，不计入熔断，也结束 half-open 试探
+                    self.breaker.record_success()
+                    raise
+                self.breaker.record_failure()
+                if attempt == attempts - 1: raise
+                time.sleep(backoff_delay(attempt))
+
+
+def build_http_client():
+    return httpx.Client(
+        limits=httpx.Limits(max_connections=POOL_MAX_CONNECTIONS, max_keepalive_connections=POOL_MAX_KEEPALIVE,
+                            keepalive_expiry=POOL_KEEPALIVE_EXPIRY),
+        timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+        http2=False,
+    )
+
+
+def create_data_client(url, key):
+    """创建带连接池的 Supabase 客户端；旧版 supabase-py 不支持 httpx_client 时退回只设置超时"""
+    from supabase import ClientOptions
+    try:
+        options = ClientOptions(httpx_client=build_http_client(), postgrest_client_timeout=READ_TIMEOUT)
+    except TypeError:
+        options = ClientOptions(postgrest_client_timeout=READ_TIMEOUT)
+    return DataClient(create_client(url, key, options=options))
@@ -0,0 +1,302 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import backend
+import blob_store
+
+# --- 发票识别后台任务队列 (SQLite 持久化) ---
+# 上传的 PDF 先落盘到 blob_store (按内容哈希)，队列 (jobs + job_files 两张表) 里只记哈希；
+# 进程内的 worker 线程逐个文件领取、内存映射读取后调用 backend.real_extract_invoice_data，结果 (JSON) 写回同一行。
+# 归档上传后释放该文件的 blob 引用，只保留存储 URL。页面只负责提交和轮询状态，
+# 点击其它控件、切换页面、刷新浏览器都不会打断识别；同一个 Streamlit 进程里的所有用户共享这组 worker。
+# worker 崩溃或进程重启后，超过租约时间仍是 running 的文件会被重新排队 (最多 MAX_ATTEMPTS 次)。
+#   文件状态: queued -> running -> done | failed | cancelled
+
+JOBS_DB = Path(os.environ.get("FCO_JOBS_DB", ".fco_jobs.sqlite"))
+WORKER_COUNT = 2
+MAX_ATTEMPTS = 3
+LEASE_SECONDS = 900       # running 超过这个时间视为 worker 已经死掉
+POLL_SECONDS = 1.0
+KEEP_DAYS = 14            # 完成的任务保留天数，之后连同 PDF 一起清理
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    owner TEXT,
+    created_at REAL NOT NULL,
+    n_files INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_files (
+    job_id TEXT NOT NULL REFERENCES jobs(id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    file_name TEXT NOT NULL,
+    blob TEXT,
+    size INTEGER,
+    file_url TEXT,
+    status TEXT NOT NULL DEFAULT 'queued',
+    results TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    claimed_at REAL,
+    finished_at REAL,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS ix_job_files_status ON job_files (status, claimed_at);
+CREATE INDEX IF NOT EXISTS ix_jobs_owner ON jobs (owner, created_at);
+"""
+
+FINAL_STATUSES = ("done", "failed", "cancelled")
+
+_workers = []
+_workers_lock = threading.Lock()
+_stop = threading.Event()
+_schema_ready = set()
+
+
+def _connect():
+    """每次操作新开连接 (sqlite3 连接不能跨线程共享)；WAL 模式下读写互不阻塞"""
+    JOBS_DB.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(JOBS_DB, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA foreign_keys = ON")
+    if str(JOBS_DB) not in _schema_ready:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.executescript(SCHEMA)
+        _schema_ready.add(str(JOBS_DB))
+    return conn
+
+
+# --- 提交 / 查询 (页面调用) ---
+def submit(files, owner=None, workers=WORKER_COUNT):
+    """
+    提交一批 PDF，返回 job_id。files 为上传文件对象 (有 .name / .read())、(name, bytes / 文件对象)
+    或 (name, 文件对象, 已算好的 sha256)——页面查重时已经算过哈希的文件不再重复计算。
+    PDF 内容在这里就按块写进 blob_store，之后页面 rerun、上传控件被清空都不影响处理。
+    """
+    rows = []
+    try:
+        for f in files:
+            name, src, digest = (f + (None,))[:3] if isinstance(f, tuple) else (f.name, f, None)
+            rows.append((name, *blob_store.put(src, digest)))
+        job_id = uuid.uuid4().hex[:12]
+        conn = _connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT INTO jobs (id, owner, created_at, n_files) VALUES (?, ?, ?, ?)",
+                         (job_id, owner, time.time(), len(rows)))
+            conn.executemany("INSERT INTO job_files (job_id, idx, file_name, blob, size) VALUES (?, ?, ?, ?, ?)",
+                             [(job_id, i, name, digest, size) for i, (name, digest, size) in enumerate(rows)])
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+    except Exception:
+        for _, digest, _ in rows: blob_store.release(digest)
+        raise
+    start_workers(workers)
+    return job_id
+
+
+def job_status(job_id, owner=None):
+    """
+    {"job_id", "created_at", "owner", "total", "queued", "running", "done", "failed", "cancelled", "finished", "current"}；
+    任务不存在返回 None。给了 owner 时只返回该用户提交的任务 (别人的 job id 也当作不存在)
+    """
+    conn = _connect()
+    try:
+        job = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if job is None or (owner is not None and job["owner"] != owner): return None
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM job_files WHERE job_id = ? GROUP BY status", (job_id,)).fetchall())
+        running = [r[0] for r in conn.execute("SELECT file_name FROM job_files WHERE job_id = ? AND status = 'running' ORDER BY idx", (job_id,))]
+    finally:
+        conn.close()
+    out = {"job_id": job_id, "created_at": job["created_at"], "owner": job["owner"], "total": job["n_files"], "current": running}
+    for s in ("queued", "running") + FINAL_STATUSES: out[s] = counts.get(s, 0)
+    out["finished"] = out["queued"] + out["running"] == 0
+    return out
+
+
+def list_jobs(owner, limit=20):
+    """该用户最近的任务，供页面选择重新打开"""
+    conn = _connect()
+    try:
+        ids = [r[0] for r in conn.execute("SELECT id FROM jobs WHERE owner = ? ORDER BY created_at DESC LIMIT ?", (owner, limit))]
+    finally:
+        conn.close()
+    return [s for s in (job_status(i) for i in ids) if s]
+
+
+def job_results(job_id):
+    """
+    已完成文件的识别结果 (按上传顺序展开成发票行)，每行带 job_id / file_idx / file_hash，归档时用 file_ref 找到原 PDF。
+    处理失败的文件返回一行 vendor_detected = "Error"，与 real_extract_invoice_data 的错误行格式一致。
+    """
+    conn = _connect()
+    try:
+        rows = conn.execute("SELECT idx, file_name, blob, status, results, error FROM job_files WHERE job_id = ? AND status IN ('done', 'failed') ORDER BY idx",
+                            (job_id,)).fetchall()
+    finally:
+        conn.close()
+    out = []
+    for r in rows:
+        items = json.loads(r["results"]) if r["status"] == "done" else \
+            [{"filename": r["file_name"], "vendor_detected": "Error", "error_msg": r["error"], "amount_detected": 0}]
+        for item in items:
+            item["job_id"], item["file_idx"], item["file_hash"] = job_id, r["idx"], r["blob"]
+            out.append(item)
+    return out
+
+
+def file_timings(job_id):
+    """每个文件的 {"file_name", "status", "size", "attempts", "seconds"} (seconds 为最后一次领取到结束的耗时)"""
+    conn = _connect()
+    try:
+        rows = conn.execute("""SELECT file_name, status, size, attempts, finished_at - claimed_at AS seconds
+                               FROM job_files WHERE job_id = ? ORDER BY idx""", (job_id,)).fetchall()
+    finally:
+        conn.close()
+    return [dict(r) for r in rows]
+
+
+def file_ref(job_id, idx):
+    """{"file_name", "blob", "file_url"}：归档时已上传过的文件直接用 file_url，否则从 blob 路径上传"""
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT file_name, blob, file_url FROM job_files WHERE job_id = ? AND idx = ?", (job_id, idx)).fetchone()
+    finally:
+        conn.close()
+    return dict(row) if row else None
+
+
+def mark_archived(job_id, idx, file_url):
+    """
+    文件已上传到存储：记下 URL 并释放本地 blob 引用 (同一文件再次归档时复用 URL)。
+    blob 列保留哈希 (重复检测要用)，file_url 非空即表示引用已释放。
+    """
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT blob FROM job_files WHERE job_id = ? AND idx = ? AND file_url IS NULL", (job_id, idx)).fetchone()
+        conn.execute("UPDATE job_files SET file_url = ? WHERE job_id = ? AND idx = ?", (file_url, job_id, idx))
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    if row and row[0]: blob_store.release(row[0])
+
+
+def cancel(job_id):
+    """取消还没开始的文件；正在处理的文件会跑完"""
+    conn = _connect()
+    try:
+        conn.execute("UPDATE job_files SET status = 'cancelled', finished_at = ? WHERE job_id = ? AND status = 'queued'",
+                     (time.time(), job_id))
+    finally:
+        conn.close()
+
+
+def purge(keep_days=KEEP_DAYS):
+    """删除 keep_days 天前创建且已全部结束的任务，并释放它们的 blob 引用"""
+    cutoff = time.time() - keep_days * 86400
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        ids = [r[0] for r in conn.execute("""SELECT id FROM jobs WHERE created_at < ? AND NOT EXISTS (
+                  SELECT 1 FROM job_files f WHERE f.job_id = jobs.id AND f.status IN ('queued', 'running'))""", (cutoff,))]
+        marks = ",".join("?" * len(ids))
+        blobs = [r[0] for r in conn.execute(f"SELECT blob FROM job_files WHERE job_id IN ({marks}) AND file_url IS NULL", ids)]
+        conn.execute(f"DELETE FROM jobs WHERE id IN ({marks})", ids)
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    for digest in blobs: blob_store.release(digest)
+
+
+# --- worker ---
+def claim_next():
+    """原子地领取最早排队的一个文件 (同时回收租约过期的 running 文件)；没有任务返回 None"""
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("""UPDATE job_files SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,
+                               error = CASE WHEN attempts >= ? THEN 'worker stopped while processing' ELSE error END,
+                               finished_at = CASE WHEN attempts >= ? THEN ? ELSE finished_at END
+                        WHERE status = 'running' AND claimed_at < ?""",
+                     (MAX_ATTEMPTS, MAX_ATTEMPTS, MAX_ATTEMPTS, now, now - LEASE_SECONDS))
+        row = conn.execute("""SELECT f.job_id, f.idx, f.file_name, f.blob FROM job_files f JOIN jobs j ON j.id = f.job_id
+                              WHERE f.status = 'queued' ORDER BY j.created_at, f.idx LIMIT 1""").fetchone()
+        if row is not None:
+            conn.execute("UPDATE job_files SET status = 'running', claimed_at = ?, attempts = attempts + 1 WHERE job_id = ? AND idx = ?",
+                         (now, row["job_id"], row["idx"]))
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return None if row is None else (row["job_id"], row["idx"], row["file_name"], row["blob"])
+
+
+def _finish(job_id, idx, status, results=None, error=None):
+    conn = _connect()
+    try:
+        conn.execute("UPDATE job_files SET status = ?, results = ?, error = ?, finished_at = ? WHERE job_id = ? AND idx = ? AND status = 'running'",
+                     (status, None if results is None else json.dumps(results, default=str), error, time.time(), job_id, idx))
+    finally:
+        conn.close()
+
+
+def process_one():
+    """处理队列里的一个文件；队列为空返回 False"""
+    item = claim_next()
+    if item is None: return False
+    job_id, idx, name, digest = item
+    if not blob_store.exists(digest):
+        _finish(job_id, idx, "failed", error="uploaded file is no longer available")
+        return True
+    try:
+        with blob_store.BlobFile(digest, name) as f:
+            results = backend.real_extract_invoice_data(f)
+        _finish(job_id, idx, "done", results=results)
+    except Exception as e:
+        # real_extract_invoice_data 自己会把识别错误变成 Error 行，这里只剩意外异常：重新排队，次数用完才算失败
+        print(f"Invoice job {job_id}/{idx} error: {e}")
+        conn = _connect()
+        try:
+            conn.execute("""UPDATE job_files SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,
+                                   error = ?, finished_at = ? WHERE job_id = ? AND idx = ?""",
+                         (MAX_ATTEMPTS, str(e), time.time(), job_id, idx))
+        finally:
+            conn.close()
+    return True
+
+
+def _worker_loop():
+    while not _stop.is_set():
+        try:
+            if not process_one(): _stop.wait(POLL_SECONDS)
+        except Exception as e:  # 数据库被锁等，稍后再试，不让线程退出
+            print(f"Invoice worker error: {e}")
+            _stop.wait(POLL_SECONDS)
+
+
+def start_workers(n=WORKER_COUNT):
+    """启动 worker 线程 (进程内只启动一次，所有会话共享)；顺带清理过期任务"""
+    with _workers_lock:
+        alive = [t for t in _workers if t.is_alive()]
+        if len(alive) >= n: return
+        if not alive:
+            _stop.clear()
+            try: purge()
+            except Exception as e: print(f"Invoice job purge error: {e}")
+        for i in range(len(alive), n):
+            t = threading.Thread(target=_worker_loop, name=f"invoice-worker-{i}", daemon=True)
+            t.start()
+            alive.append(t)
+        _workers[:] = alive
+
+
+def stop_workers(timeout=None):
+    _stop.set()
+    for t in list(_workers): t.join(timeout)
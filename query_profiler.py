@@ -0,0 +1,109 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# --- 查询 / AI 调用埋点 ---
+# 每次 Streamlit rerun 开始时 start_rerun()，结束时 finish_rerun()；
+# 期间所有 Supabase 查询 (db_client) 和 Gemini 调用 (backend) 都会记录到当前 rerun 的 trace 里：
+# 表名、过滤条件、返回行数、估算字节数、耗时、错误。
+# 设置环境变量 FCO_PROFILE_LOG=/path/to/file.jsonl 时，每个 rerun 追加一行 JSON。
+
+HISTORY_SIZE = 30
+N_PLUS_ONE_THRESHOLD = 3
+BYTES_SAMPLE_ROWS = 200
+
+_current = contextvars.ContextVar("fco_rerun_trace", default=None)
+
+
+def start_rerun(page):
+    trace = {"page": page, "started": time.time(), "events": [], "total_s": 0.0, "_lock": threading.Lock()}
+    _current.set(trace)
+    return trace
+
+
+def finish_rerun(trace, history):
+    """把 trace 汇总后放入会话历史 (history 为 list, 一般是 st.session_state 里的)"""
+    trace["total_s"] = time.time() - trace["started"]
+    trace.pop("_lock", None)
+    _current.set(None)
+    history.append(trace)
+    del history[:-HISTORY_SIZE]
+
+    log_path = os.environ.get("FCO_PROFILE_LOG")
+    if log_path:
+        try:
+            with open(log_path, "a", encoding="utf-8") as f: f.write(json.dumps(trace, default=str) + "\n")
+        except OSError as e:
+            print(f"Profile log error: {e}")
+    return trace
+
+
+def estimate_bytes(data):
+    """按前 N 行的 JSON 大小估算整体返回体积，避免对大结果集完整序列化"""
+    if not data: return 0
+    if not isinstance(data, list): return len(json.dumps(data, default=str))
+    sample = data[:BYTES_SAMPLE_ROWS]
+    size = len(json.dumps(sample, default=str))
+    return int(size * len(data) / len(sample))
+
+
+def record(kind, target, detail="", rows=0, nbytes=0, latency_s=0.0, error=None, shape=""):
+    trace = _current.get()
+    if trace is None: return
+    event = {"kind": kind, "target": target, "detail": detail, "shape": shape, "rows": rows, "bytes": nbytes,
+             "latency_ms": latency_s * 1000, "error": error, "at": time.time() - trace["started"]}
+    lock = trace.get("_lock")
+    if lock:
+        with lock: trace["events"].append(event)
+    else:
+        trace["events"].append(event)
+
+
+@contextmanager
+def track(kind, target, detail=""):
+    """with track("ai", "gemini-2.5-flash", file_name) as ev: ... ; 可在块内设置 ev['rows'] / ev['bytes']"""
+    ev = {"rows": 0, "bytes": 0}
+    t0 = time.perf_counter()
+    error = None
+    try:
+        yield ev
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        record(kind, target, detail, ev["rows"], ev["bytes"], time.perf_counter() - t0, error)
+
+
+def describe_calls(calls):
+    """[('select', ('*',)), ('eq', ('forest_id', 1))] -> "select(*) eq(forest_id, 1)" """
+    return " ".join(f"{name}({', '.join(str(a) for a in args)})" for name, args in calls)
+
+
+def call_shape(calls):
+    """去掉参数值只保留结构，用于识别 N+1：同一形状的查询在一个 rerun 里重复多次"""
+    return " ".join(f"{name}({args[0]})" if args and name != "select" else name for name, args in calls)
+
+
+def summarize(trace):
+    events = trace.get("events", [])
+    db = [e for e in events if e["kind"] == "db"]
+    ai = [e for e in events if e["kind"] == "ai"]
+    return {
+        "page": trace.get("page"), "total_ms": trace.get("total_s", 0) * 1000,
+        "db_calls": len(db), "db_ms": sum(e["latency_ms"] for e in db),
+        "db_rows": sum(e["rows"] for e in db), "db_bytes": sum(e["bytes"] for e in db),
+        "ai_calls": len(ai), "ai_ms": sum(e["latency_ms"] for e in ai),
+        "errors": sum(1 for e in events if e["error"]),
+    }
+
+
+def find_n_plus_one(trace, threshold=N_PLUS_ONE_THRESHOLD):
+    counts = {}
+    for e in trace.get("events", []):
+        if e["kind"] != "db": continue
+        key = (e["target"], e["shape"])
+        counts[key] = counts.get(key, 0) + 1
+    return [{"table": t, "shape": s, "count": c} for (t, s), c in counts.items() if c >= threshold]
@@ -0,0 +1,322 @@
+import json
+import os
+import sys
+import time
+from datetime import date, datetime, timezone
+from pathlib import Path
+
+import pandas as pd
+import streamlit as st
+import backend
+
+# --- 本地列式快照 (Parquet) ---
+# 把事实表同步到本地 Parquet，按 forest_id / year 分区 (hive 目录结构)：
+#   <FCO_SNAPSHOT_DIR>/fact_operational_costs/forest_id=3/year=2025/part-0.parquet
+# 增量依据是数据库的 updated_at 水位 (manifest.json 记录每张表同步时的最大 updated_at)：
+# 插入、upsert、直接改库都会刷新 updated_at，不论来自哪个进程、发生在重启前还是后；
+# 同步时把水位之后改过的 (forest, year) 分区整块重拉；删除的行 updated_at 看不到，同步时再按分区比对 id 集合找出来。
+# 读取时内存映射 + 分区/列统计下推过滤；当前未结账月份 (本月及以后) 始终走实时查询，
+# 上次同步后改过的分区在重新同步前也走实时查询。"改过哪些分区" 按数据版本缓存 CHANGE_CHECK_TTL 秒，
+# 本应用的写入 (bump 数据版本) 立即生效，直接改库最多延迟这么久，页面 rerun 不再每次都查一次源表。
+# 事实表需要 updated_at 列 (Supabase 自带 moddatetime 扩展)：
+#   alter table fact_operational_costs add column updated_at timestamptz not null default now();
+#   create trigger set_updated_at before update on fact_operational_costs
+#     for each row execute procedure moddatetime (updated_at);
+#   -- fact_production_volume / actual_sales_transactions 同理
+#
+#   python snapshot.py sync [--full]     # 命令行同步 (可放到 cron)
+
+SNAPSHOT_DIR = Path(os.environ.get("FCO_SNAPSHOT_DIR", ".fco_snapshot"))
+PAGE_SIZE = 1000  # PostgREST 默认单次最多返回 1000 行
+
+# 表 -> 日期列 (用于计算 year 分区和本月实时回退)
+SNAPSHOT_TABLES = {
+    "fact_production_volume": "month",
+    "fact_operational_costs": "month",
+    "actual_sales_transactions": "date",
+}
+UPDATED_COL = "updated_at"
+CHANGE_CHECK_TTL = 60  # 秒
+
+
+def _arrow():
+    """pyarrow 是可选依赖；没有安装时快照不可用，所有读取走实时查询"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        return pa, pq
+    except ImportError:
+        return None, None
+
+
+def available():
+    return _arrow()[0] is not None
+
+
+def table_dir(table):
+    return SNAPSHOT_DIR / table
+
+
+def partition_path(table, forest_id, year):
+    return table_dir(table) / f"forest_id={forest_id}" / f"year={year}" / "part-0.parquet"
+
+
+def load_manifest():
+    try: return json.loads((SNAPSHOT_DIR / "manifest.json").read_text())
+    except (OSError, ValueError): return {}
+
+
+def save_manifest(manifest):
+    SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = SNAPSHOT_DIR / "manifest.json.tmp"
+    tmp.write_text(json.dumps(manifest, indent=2))
+    os.replace(tmp, SNAPSHOT_DIR / "manifest.json")
+
+
+def is_ready(table):
+    """旧版 manifest (没有 updated_at 水位) 不可用，需要重新同步"""
+    return table in SNAPSHOT_TABLES and available() and "updated_watermark" in load_manifest().get(table, {})
+
+
+def open_month():
+    """当前未结账月份的第一天 (字符串)，该月及以后的数据只走实时查询"""
+    return date.today().replace(day=1).isoformat()
+
+
+def _changed_rows(table, since, build=lambda q: q):
+    """updated_at 晚于 since 的行 (只取 id / forest_id / 日期列)，按 id 分页；since 为 None 时为全部行"""
+    date_col = SNAPSHOT_TABLES[table]
+    rows, last_id = [], 0
+    while True:
+        q = build(backend.supabase.table(table).select(f"id,forest_id,{date_col}"))
+        if since is not None: q = q.gt(UPDATED_COL, since)
+        page = q.gt("id", last_id).order("id").limit(PAGE_SIZE).execute().data
+        rows += page
+        if len(page) < PAGE_SIZE: return rows
+        last_id = page[-1]["id"]
+
+
+def _max_updated(table):
+    rows = backend.supabase.table(table).select(UPDATED_COL).order(UPDATED_COL, desc=True).limit(1).execute().data
+    return rows[0][UPDATED_COL] if rows else None
+
+
+def changed_forests(table, forest_ids, start, end):
+    """上次同步之后数据库里改过 [start, end) 数据的林地：这些林地在重新同步前走实时查询"""
+    entry = load_manifest().get(table, {})
+    date_col = SNAPSHOT_TABLES[table]
+    rows = _changed_rows(table, entry.get("updated_watermark"),
+                         lambda q: q.in_("forest_id", list(forest_ids)).gte(date_col, start).lt(date_col, end))
+    return {int(r["forest_id"]) for r in rows}
+
+
+@st.cache_data(ttl=CHANGE_CHECK_TTL, show_spinner=False, max_entries=256)
+def _cached_changed_forests(table, forest_ids, start, end, watermark, data_version):
+    """按 (范围, 同步水位, 数据版本) 缓存 changed_forests；查询失败时抛出，不缓存"""
+    return changed_forests(table, forest_ids, start, end)
+
+
+# --- 同步 ---
+def _file_columns(table):
+    return [c for c in backend.schema_cols(table) if c != "forest_id"]
+
+
+def _fetch_pages(table, build):
+    """按 id 升序分页拉取，返回 list[dict]"""
+    rows, last_id = [], None
+    cols = backend.select_cols(table, backend.schema_cols(table))
+    while True:
+        q = build(backend.supabase.table(table).select(cols))
+        if last_id is not None: q = q.gt("id", last_id)
+        page = q.order("id").limit(PAGE_SIZE).execute().data
+        rows += page
+        if len(page) < PAGE_SIZE: return rows
+        last_id = page[-1]["id"]
+
+
+def _write_partition(table, forest_id, year, df):
+    """整块替换一个分区，返回行数"""
+    pa, pq = _arrow()
+    path = partition_path(table, forest_id, year)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    df = df[_file_columns(table)].sort_values("id").reset_index(drop=True)
+    tmp = path.parent / "_part-0.tmp"  # '_' 开头的文件读取时会被忽略
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp, compression="zstd")
+    os.replace(tmp, path)
+    return len(df)
+
+
+def _partition_rows(table, forest_id, year):
+    path = partition_path(table, forest_id, year)
+    return _arrow()[1].read_metadata(path).num_rows if path.exists() else 0
+
+
+def _split_partitions(table, rows):
+    """list[dict] -> {(forest_id, year): DataFrame}"""
+    if not rows: return {}
+    date_col = SNAPSHOT_TABLES[table]
+    df = backend.typed_frame(rows, table, backend.schema_cols(table))
+    df["_year"] = df[date_col].astype(str).str[:4]
+    return {(int(f), int(y)): part.drop(columns="_year") for (f, y), part in df.groupby(["forest_id", "_year"])}
+
+
+def _partition_keys(table, rows):
+    date_col = SNAPSHOT_TABLES[table]
+    return {(int(r["forest_id"]), int(str(r[date_col])[:4])) for r in rows if r.get("forest_id") is not None and r.get(date_col)}
+
+
+def _stale_partitions(table):
+    """
+    id 集合与源表不一致的分区 (源表删除了行，或行的日期 / 林地改到了别的分区)。
+    源表只拉 id / forest_id / 日期列，快照只读 id 列。
+    """
+    date_col = SNAPSHOT_TABLES[table]
+    source = {}
+    for r in _changed_rows(table, None):
+        if r.get("forest_id") is None or not r.get(date_col): continue
+        source.setdefault((int(r["forest_id"]), int(str(r[date_col])[:4])), set()).add(r["id"])
+    pq = _arrow()[1]
+    stale = set()
+    for path in table_dir(table).glob("forest_id=*/year=*/part-0.parquet"):
+        key = (int(path.parent.parent.name.split("=")[1]), int(path.parent.name.split("=")[1]))
+        if set(pq.read_table(path, columns=["id"]).column("id").to_pylist()) != source.get(key, set()): stale.add(key)
+    return stale
+
+
+def sync(tables=None, full=False):
+    """
+    同步快照：重拉上次同步后 updated_at 变化过的 (forest, year) 分区，以及 id 集合与源表不一致 (有删除) 的分区。
+    full=True 或旧版 manifest 时清空重建。
+    重拉过的分区会 bump 数据版本，已缓存的全年事实随之失效。
+    返回 {table: {"new_rows", "rewritten_partitions", "seconds"}} (new_rows 为本次拉取的行数)。
+    """
+    if not available(): raise RuntimeError("pyarrow is not installed")
+    if not backend.supabase: raise RuntimeError("Supabase is not connected")
+    manifest = load_manifest()
+    report = {}
+    for table in tables or SNAPSHOT_TABLES:
+        t0 = time.perf_counter()
+        entry = manifest.get(table, {})
+        rebuild = full or "updated_watermark" not in entry
+        date_col = SNAPSHOT_TABLES[table]
+        # 先取水位再拉数据：拉取期间的改动 updated_at 更大，下次同步会再拉一次
+        updated_wm = _max_updated(table)
+
+        if rebuild:
+            if table_dir(table).exists():
+                for f in table_dir(table).rglob("*.parquet"): f.unlink()
+            pulled = _fetch_pages(table, lambda q: q)
+            parts = _split_partitions(table, pulled)
+            n_rows = sum(_write_partition(table, fid, year, df) for (fid, year), df in parts.items())
+            backend.bump_data_version(table)
+        else:
+            keys = _partition_keys(table, _changed_rows(table, entry["updated_watermark"])) | _stale_partitions(table)
+            pulled, n_rows = [], entry.get("rows", 0)
+            for fid, year in sorted(keys):
+                start, end = backend.year_bounds(year)
+                rows = _fetch_pages(table, lambda q: q.eq("forest_id", fid).gte(date_col, start).lt(date_col, end))
+                part = _split_partitions(table, rows).get((fid, year))
+                n_rows -= _partition_rows(table, fid, year)
+                if part is not None: n_rows += _write_partition(table, fid, year, part)
+                elif partition_path(table, fid, year).exists(): partition_path(table, fid, year).unlink()
+                pulled += rows
+                backend.bump_data_version(table, fid, year)
+            parts = keys
+
+        watermark = max([entry.get("watermark_id", 0)] + [r["id"] for r in pulled])
+        manifest[table] = {"watermark_id": watermark, "updated_watermark": updated_wm if updated_wm is not None else entry.get("updated_watermark"),
+                           "synced_at": datetime.now(timezone.utc).isoformat(), "rows": n_rows}
+        report[table] = {"new_rows": len(pulled), "rewritten_partitions": len(parts), "seconds": time.perf_counter() - t0}
+    save_manifest(manifest)
+    return report
+
+
+# --- 读取 ---
+def _to_pushdown(filters):
+    return [(c, "in", list(v)) if op == "in" else (c, op, v) for c, op, v in filters]
+
+
+def _to_query(q, filters):
+    """(col, op, value) -> PostgREST 过滤，与 Parquet 下推用同一份条件"""
+    ops = {"=": "eq", "==": "eq", "!=": "neq", ">": "gt", ">=": "gte", "<": "lt", "<=": "lte", "in": "in_"}
+    for c, op, v in filters:
+        q = getattr(q, ops[op])(c, list(v) if op == "in" else v)
+    return q
+
+
+def read_snapshot(table, columns, forest_ids=None, years=None, filters=()):
+    """只读快照 (不做实时回退)。内存映射读取，forest/year 分区裁剪 + 列统计下推"""
+    pa, pq = _arrow()
+    import pyarrow.dataset as ds
+    path = table_dir(table)
+    if not path.exists(): return backend.typed_frame([], table, columns)
+    part_schema = pa.schema([("forest_id", pa.int64()), ("year", pa.int32())])
+    flt = list(_to_pushdown(filters))
+    if forest_ids is not None: flt.append(("forest_id", "in", [int(f) for f in forest_ids]))
+    if years is not None: flt.append(("year", "in", [int(y) for y in years]))
+    t = pq.read_table(path, columns=list(columns), filters=flt or None, memory_map=True,
+                      partitioning=ds.partitioning(part_schema, flavor="hive"))
+    return t.to_pandas()
+
+
+def query_year(table, columns, forest_ids, year, filters=(), compact=True):
+    """
+    某年 (若干林地) 的事实行：已结账月份读快照，本月及以后、以及上次同步后改过的分区走实时查询。
+    filters 为 [(col, op, value)]，op 支持 = != > >= < <= in。
+    """
+    date_col = SNAPSHOT_TABLES[table]
+    start, end = backend.year_bounds(year)
+    forest_ids = [int(f) for f in forest_ids]
+    cut = min(max(open_month(), start), end)
+
+    # 上次同步后改过 (快照覆盖的月份) 的林地走实时查询；查不到改动情况时 (例如网络错误) 全部走实时查询
+    changed = set()
+    if cut > start:
+        entry = load_manifest().get(table, {})
+        token = backend.data_token(*[(table, f, year) for f in forest_ids])
+        try: changed = _cached_changed_forests(table, tuple(forest_ids), start, cut, entry.get("updated_watermark"), token)
+        except Exception as e:
+            print(f"Snapshot change check error ({table}): {e}")
+            changed = set(forest_ids)
+    live_forests = [f for f in forest_ids if f in changed]
+    snap_forests = [f for f in forest_ids if f not in live_forests]
+    read_cols = list(dict.fromkeys(list(columns) + [date_col]))
+
+    parts = []
+    if snap_forests and cut > start:
+        parts.append(read_snapshot(table, read_cols, snap_forests, [year], list(filters) + [(date_col, "<", cut)]))
+
+    live_ranges = []
+    if live_forests: live_ranges.append((live_forests, start, end))
+    if snap_forests and cut < end: live_ranges.append((snap_forests, cut, end))
+    for fids, lo, hi in live_ranges:
+        live_filters = list(filters) + [("forest_id", "in", fids), (date_col, ">=", lo), (date_col, "<", hi)]
+        parts.append(backend.fetch_frame(table, read_cols, lambda q: _to_query(q, live_filters)))
+
+    parts = [p for p in parts if not p.empty]
+    df = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=read_cols)
+    df = df[list(columns)]
+    for c in df.columns:
+        if isinstance(df[c].dtype, pd.CategoricalDtype): df[c] = df[c].astype(object)
+    return backend.cast_frame(df, table, columns, compact)
+
+
+def status():
+    """每张表的同步状态 + 本地文件大小，供 Admin 页面展示"""
+    manifest = load_manifest()
+    out = []
+    for table in SNAPSHOT_TABLES:
+        files = list(table_dir(table).rglob("*.parquet")) if table_dir(table).exists() else []
+        entry = manifest.get(table, {})
+        out.append({"table": table, "rows": entry.get("rows", 0), "watermark_id": entry.get("watermark_id"),
+                    "synced_at": entry.get("synced_at"), "partitions": len(files),
+                    "size_mb": sum(f.stat().st_size for f in files) / 2 ** 20})
+    return out
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "sync":
+        print("usage: python snapshot.py sync [--full]")
+        sys.exit(2)
+    for table, r in sync(full="--full" in sys.argv).items():
+        print(f"{table}: {r['new_rows']} rows pulled, {r['rewritten_partitions']} partitions rewritten, {r['seconds']:.1f}s")
@@ -0,0 +1,86 @@
+import csv
+import io
+
+import pandas as pd
+
+# --- 大文件上传的流式读取 (CSV / Excel) ---
+# 先只读表头做校验，再按固定行数分块 yield DataFrame，调用方逐块处理、逐块写库，
+# 内存占用与块大小有关，而不是与文件行数有关。
+#   CSV  : pandas read_csv(chunksize=...)
+#   XLSX : openpyxl read_only 逐行迭代 (只读第一个工作表)
+# 每块的 index 延续文件中的数据行号 (0 起)，错误信息里的 "Row N" 与整表读取时一致。
+
+CHUNK_ROWS = 2000
+
+
+def is_excel(file):
+    return str(getattr(file, "name", "")).lower().endswith((".xlsx", ".xlsm"))
+
+
+def _open_sheet(file):
+    from openpyxl import load_workbook  # 只有 Excel 上传才需要
+    file.seek(0)
+    wb = load_workbook(file, read_only=True, data_only=True)
+    return wb, wb.worksheets[0]
+
+
+def _clean_header(values):
+    return [str(v).strip() if v is not None else "" for v in values]
+
+
+def read_header(file):
+    """只读第一行表头，不加载数据"""
+    if is_excel(file):
+        wb, ws = _open_sheet(file)
+        try: return _clean_header(next(ws.iter_rows(max_row=1, values_only=True), ()))
+        finally: wb.close()
+    file.seek(0)
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    try: return _clean_header(next(csv.reader(text), []))
+    finally: text.detach()  # 不让 wrapper 关闭底层上传文件
+
+
+def estimate_rows(file):
+    """估计数据行数，用于进度条 (Excel 取工作表维度；CSV 按前 64KB 的平均行长推算)"""
+    if is_excel(file):
+        wb, ws = _open_sheet(file)
+        try: return max((ws.max_row or 1) - 1, 1)
+        finally: wb.close()
+    file.seek(0, io.SEEK_END)
+    size = file.tell()
+    file.seek(0)
+    sample = file.read(65536)
+    file.seek(0)
+    lines = max(sample.count(b"\n"), 1)
+    return max(int(size / (len(sample) / lines)) - 1, 1)
+
+
+def iter_chunks(file, chunk_rows=CHUNK_ROWS, rename=None):
+    """按块 yield DataFrame；rename 为表头别名映射 (例如 {'Forest': 'Company'})"""
+    if is_excel(file):
+        yield from _iter_excel(file, chunk_rows, rename)
+        return
+    file.seek(0)
+    for chunk in pd.read_csv(file, chunksize=chunk_rows, encoding="utf-8-sig"):
+        chunk.columns = [str(c).strip() for c in chunk.columns]
+        yield chunk.rename(columns=rename) if rename else chunk
+
+
+def _iter_excel(file, chunk_rows, rename):
+    wb, ws = _open_sheet(file)
+    try:
+        rows = ws.iter_rows(values_only=True)
+        header = _clean_header(next(rows, ()))
+        if rename: header = [rename.get(h, h) for h in header]
+        # index 用工作表行号推出 (第 2 行 -> 0)：跳过空行后，之后各行的 "Row N" 仍对得上原表
+        buf, index = [], []
+        for sheet_row, row in enumerate(rows, start=2):
+            if not any(v is not None and v != "" for v in row): continue  # 跳过空行
+            buf.append(tuple(row[:len(header)]) + (None,) * (len(header) - len(row)))
+            index.append(sheet_row - 2)
+            if len(buf) >= chunk_rows:
+                yield pd.DataFrame(buf, columns=header, index=index)
+                buf, index = [], []
+        if buf: yield pd.DataFrame(buf, columns=header, index=index)
+    finally:
+        wb.close()
@@ -1,7 +1,104 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import backend
-import time
+
+# --- 0. GL Mapping 解析 (文件行 -> dim_gl_mappings 记录) ---
+GL_REQUIRED_COLS = ['Company', 'Type', 'Item Name', 'GL Code', 'GL Name']
+GL_MAX_ERRORS_SHOWN = 1000
+
+def build_activity_index(act_map):
+    """
+    activity 名称索引 (每次上传只建一次)：
+      positions: 名称 -> 在 act_map 中的位置，用于 "activity 名称是上传名称的子串" (枚举上传名称的子串查字典)
+      grams:     1-3 个字符的片段 -> 包含它的 activity 位置 (升序)，用于 "上传名称是 activity 名称的子串" 先缩小候选
+    """
+    keys = list(act_map)
+    positions, grams = {}, {}
+    for i, k in enumerate(keys):
+        positions.setdefault(k, i)
+        for g in {k[j:j + n] for n in (1, 2, 3) for j in range(len(k) - n + 1)}:
+            grams.setdefault(g, []).append(i)
+    return keys, positions, grams, max(map(len, keys), default=0)
+
+def _first_match(s, index):
+    """与 `k in s or s in k` 逐个扫描 activity 列表的结果相同：返回第一个命中的位置，没有返回 None"""
+    keys, positions, grams, max_len = index
+    if not keys: return None
+    if not s: return 0  # "" 是任何名称的子串
+    # 1. k in s：s 的所有 (不超过最长名称的) 子串里查字典
+    hits = [positions[s[i:j]] for i in range(len(s)) for j in range(i + 1, min(len(s), i + max_len) + 1) if s[i:j] in positions]
+    if "" in positions: hits.append(positions[""])
+    # 2. s in k：短名称的片段表就是答案；长名称取最稀有的三字片段作候选，再逐个确认
+    if len(s) <= 3:
+        hits += grams.get(s, [])[:1]
+    else:
+        candidates = min((grams.get(s[j:j + 3], []) for j in range(len(s) - 2)), key=len)
+        hits += next(([i] for i in candidates if s in keys[i]), [])
+    return min(hits, default=None)
+
+def match_activity_names(names, act_map):
+    """
+    Cost 名称模糊匹配 (子串包含，取 activity 列表中第一个命中)。
+    activity 索引只建一次，每个去重后的名称按索引查找，不再线性扫描整个 activity 列表。
+    """
+    index = build_activity_index(act_map)
+    out = {}
+    for name in names:
+        pos = _first_match(str(name), index)
+        out[name] = act_map[index[0][pos]] if pos is not None else None
+    return out
+
+def build_gl_mapping_records(df, forests, activities, products, on_progress=None):
+    """
+    向量化解析：精确匹配用 map，Cost 未命中的名称再做模糊匹配。返回 (records, errors)。
+    同一 (forest, type, item) 出现多次时保留最后一行，避免一次 upsert 命中同一行两次。
+    on_progress(比例) 只在几个阶段调用，不再逐行刷新进度条。
+    """
+    missing = [c for c in GL_REQUIRED_COLS if c not in df.columns]
+    if missing: return [], [f"缺少列: {', '.join(missing)}"]
+
+    forest_map = {f['name']: f['id'] for f in forests}
+    act_map = {a['activity_name']: a['id'] for a in activities}
+    prod_map = {p['grade_code']: p['id'] for p in products} 
+
+    row_no = pd.Series(df.index, index=df.index) + 1
+    company, item_type, item_name = df['Company'], df['Type'], df['Item Name']
+
+    # A. Company -> forest_id (数据库字段仍叫 forest_id，但逻辑上存的是 Company ID)
+    fid = company.map(forest_map)
+    if on_progress: on_progress(0.3)
+
+    # B. Item -> item_id
+    is_cost, is_rev = item_type == 'Cost', item_type == 'Revenue'
+    item_id = pd.Series(np.nan, index=df.index, dtype=float)
+    item_id[is_cost] = item_name[is_cost].map(act_map)
+    item_id[is_rev] = item_name[is_rev].map(prod_map)
+    has_name = item_name.notna() & item_name.astype(str).str.strip().ne('')
+    need_fuzzy = is_cost & item_id.isna() & has_name
+    if need_fuzzy.any():
+        fuzzy = match_activity_names(item_name[need_fuzzy].unique(), act_map)
+        item_id[need_fuzzy] = item_name[need_fuzzy].map(fuzzy).astype(float)
+    if on_progress: on_progress(0.7)
+
+    # C. 错误 (按行号排序，一次性生成)
+    no_forest = fid.isna()
+    no_item = ~no_forest & item_id.isna()
+    err_forest = "Row " + row_no[no_forest].astype(str) + ": Company '" + company[no_forest].astype(str) + "' 未在系统中找到 (请检查 dim_forests 配置)"
+    err_item = "Row " + row_no[no_item].astype(str) + ": Item '" + item_name[no_item].astype(str) + "' (" + item_type[no_item].astype(str) + ") 系统里没有这个项目"
+    errors = pd.concat([err_forest, err_item]).sort_index().tolist()
+
+    # D. 构建记录
+    ok = ~no_forest & ~no_item
+    out = pd.DataFrame({
+        "forest_id": fid[ok].astype('int64'),
+        "item_type": item_type[ok],
+        "item_id": item_id[ok].astype('int64'),
+        "gl_code": df.loc[ok, 'GL Code'].astype(str),
+        "gl_name": df.loc[ok, 'GL Name'].astype(object).where(df.loc[ok, 'GL Name'].notna(), None),
+    }).drop_duplicates(["forest_id", "item_type", "item_id"], keep="last")
+    if on_progress: on_progress(1.0)
+    return out.to_dict('records'), errors
 
 def view_admin_upload():
     st.title("⚙️ Admin: Chart of Accounts Setup")
@@ -12,94 +109,175 @@ def view_admin_upload():
     uploaded_file = st.file_uploader("Upload Mapping File", type=['csv', 'xlsx'])
     
     if uploaded_file and st.button("🚀 Process & Upload", type="primary"):
+        import upload_reader
         try:
-            # 1. 读取文件
-            if uploaded_file.name.endswith('.csv'):
-                df = pd.read_csv(uploaded_file)
-            else:
-                df = pd.read_excel(uploaded_file)
-            
+            # 1. 只读表头做校验 (大文件不整表载入内存)
+            header = upload_reader.read_header(uploaded_file)
+            rename = None
             # [修改点 2] 检查关键列名是否存在
-            if 'Company' not in df.columns and 'Forest' in df.columns:
+            if 'Company' not in header and 'Forest' in header:
                 st.warning("⚠️ 提示：检测到表头是 'Forest'，建议下次改为 'Company'。本次将自动按 'Company' 处理。")
-                df.rename(columns={'Forest': 'Company'}, inplace=True)
-            
-            if 'Company' not in df.columns:
-                st.error("❌ 错误：文件中缺少 `Company` 列！请检查表头。")
-                return
+                rename = {'Forest': 'Company'}
+                header = ['Company' if h == 'Forest' else h for h in header]
 
-            st.write("👀 文件预览 (前5行):", df.head())
+            missing = [c for c in GL_REQUIRED_COLS if c not in header]
+            if missing:
+                st.error(f"❌ 错误：文件中缺少 {', '.join(f'`{c}`' for c in missing)} 列！请检查表头。")
+                return
             
             # 2. 获取系统基础数据
             with st.spinner("正在同步数据库基础信息..."):
                 # 注意：数据库里表名可能还是 dim_forests，但里面存的是公司实体名(CFGCNZ等)
-                forests = backend.supabase.table("dim_forests").select("*").execute().data
-                activities = backend.supabase.table("dim_cost_activities").select("*").execute().data
-                products = backend.supabase.table("dim_products").select("*").execute().data
-            
-            forest_map = {f['name']: f['id'] for f in forests}
-            act_map = {a['activity_name']: a['id'] for a in activities}
-            prod_map = {p['grade_code']: p['id'] for p in products} 
+                forests = backend.supabase.table("dim_forests").select("id,name").execute().data
+                activities = backend.supabase.table("dim_cost_activities").select("id,activity_name").execute().data
+                products = backend.supabase.table("dim_products").select("id,grade_code").execute().data
             
-            records = []
+            # 3. 分块读取 -> 向量化匹配 -> 分块写入，每块更新一次进度
+            total_est = upload_reader.estimate_rows(uploaded_file)
+            progress_bar = st.progress(0, text="Reading...")
+            done = imported = n_errors = 0
             errors = []
-            
-            # 3. 循环处理
-            progress_bar = st.progress(0)
-            for i, row in df.iterrows():
-                try:
-                    # [修改点 3] 读取 Company 列来查找 ID
-                    company_name = row.get('Company')
-                    fid = forest_map.get(company_name)
-                    
-                    if not fid:
-                        errors.append(f"Row {i+1}: Company '{company_name}' 未在系统中找到 (请检查 dim_forests 配置)")
-                        continue
-                    
-                    # B. 找 Item ID
-                    item_type = row['Type']
-                    item_name = row['Item Name']
-                    item_id = None
-                    
-                    if item_type == 'Cost':
-                        item_id = act_map.get(item_name)
-                        if not item_id: # 模糊匹配
-                            for k, v in act_map.items():
-                                if k in str(item_name) or str(item_name) in k:
-                                    item_id = v; break
-                    elif item_type == 'Revenue':
-                        item_id = prod_map.get(item_name)
-                    
-                    if not item_id:
-                        errors.append(f"Row {i+1}: Item '{item_name}' ({item_type}) 系统里没有这个项目")
-                        continue
-                    
-                    # C. 构建记录
-                    records.append({
-                        "forest_id": fid, # 数据库字段仍叫 forest_id，但逻辑上存的是 Company ID
-                        "item_type": item_type,
-                        "item_id": item_id,
-                        "gl_code": str(row['GL Code']),
-                        "gl_name": row['GL Name']
-                    })
-                    
-                except Exception as e:
-                    errors.append(f"Row {i+1}: 数据格式错误 {str(e)}")
-                
-                progress_bar.progress((i+1)/len(df))
-                
-            # 4. 写入数据库
-            if records:
-                try:
-                    backend.supabase.table("dim_gl_mappings").upsert(records, on_conflict="forest_id,item_type,item_id").execute()
-                    st.success(f"✅ 成功导入 {len(records)} 条会计科目映射！")
-                    time.sleep(1)
-                except Exception as e:
-                    st.error(f"数据库写入失败: {e}")
-            
-            if errors:
-                st.warning(f"⚠️ 有 {len(errors)} 行数据处理失败:")
-                st.dataframe(pd.DataFrame(errors, columns=["Error Log"]), use_container_width=True)
+            for chunk in upload_reader.iter_chunks(uploaded_file, rename=rename):
+                if done == 0: st.write("👀 文件预览 (前5行):", chunk.head())
+                records, chunk_errors = build_gl_mapping_records(chunk, forests, activities, products)
+                n_errors += len(chunk_errors)
+                errors += chunk_errors[:max(0, GL_MAX_ERRORS_SHOWN - len(errors))]
+                if records:
+                    try:
+                        imported += backend.bulk_upsert("dim_gl_mappings", records, "forest_id,item_type,item_id")
+                    except Exception as e:
+                        st.error(f"数据库写入失败 (第 {done + 1} 行起的数据块): {e}")
+                        break
+                done += len(chunk)
+                progress_bar.progress(min(done / total_est, 1.0), text=f"Processed {done:,} rows...")
+            progress_bar.progress(1.0, text=f"Processed {done:,} rows")
+
+            # 4. 结果
+            if imported:
+                st.success(f"✅ 成功导入 {imported} 条会计科目映射！")
+            if n_errors:
+                st.warning(f"⚠️ 有 {n_errors} 行数据处理失败" + (f" (仅显示前 {GL_MAX_ERRORS_SHOWN} 条)" if n_errors > len(errors) else "") + ":")
+                st.dataframe(pd.DataFrame(errors, columns=["Error Log"]), width="stretch")
 
         except Exception as e:
-            st.error(f"文件处理失败: {e}")
\ No newline at end of file
+            st.error(f"文件处理失败: {e}")
+
+# --- 2. Budget Workbook Import ---
+def view_budget_import():
+    import budget_import
+
+    st.title("📥 Admin: Budget Workbook Import")
+    st.markdown("### 导入 FCO Budget Excel (每个 `<Forest> Budget` 工作表)")
+    st.info("按模板布局读取 REVENUE / Log and Load / Log Transport / Non-docket costs，写入全年 Budget 数据 (fact_production_volume, fact_operational_costs)。")
+
+    uploaded_file = st.file_uploader("Upload Budget Workbook", type=['xlsx'], key="budget_wb")
+    dry_run = st.checkbox("Dry run (只检查匹配，不写入数据库)", value=True)
+
+    if uploaded_file and st.button("🚀 Import Budget", type="primary"):
+        with st.spinner("正在流式读取工作簿..."):
+            try:
+                report = budget_import.import_budget_workbook(uploaded_file, dry_run=dry_run)
+            except Exception as e:
+                st.error(f"导入失败: {e}")
+                return
+
+        if not report["sheets"] and not report["unmatched"]:
+            st.warning("没有找到可导入的 Budget 工作表 (或数据库未连接)。")
+            return
+
+        verb = "将写入" if dry_run else "已写入"
+        st.success(f"✅ {verb} {report['volume_rows']} 条产量/收入记录, {report['cost_rows']} 条成本记录")
+        if report["empty_lines"]:
+            st.info(f"跳过 {report['empty_lines']} 行 12 个月全为 0 的行 (未填写的模板行)，数据库里对应的 Budget 保持不变。")
+        st.dataframe(pd.DataFrame(report["sheets"]), width="stretch", hide_index=True)
+
+        timings = " | ".join(f"{k}: {v:.2f}s" for k, v in report["timings"].items())
+        st.caption(f"⏱️ {timings}")
+
+        if report["unmatched"]:
+            st.warning(f"⚠️ 有 {len(report['unmatched'])} 行未能匹配到维度表:")
+            st.dataframe(pd.DataFrame(report["unmatched"]), width="stretch", hide_index=True)
+
+
+# --- 3. Query Profiler (每个 rerun 的查询 / AI 调用耗时) ---
+def view_query_profiler():
+    import json
+    import query_profiler
+
+    st.title("⏱️ Query Profiler")
+    st.caption("记录本会话最近的页面 rerun：每个 Supabase 查询和 Gemini 调用的表名、过滤条件、行数、数据量和耗时。")
+
+    history = [t for t in st.session_state.get("_profile_history", []) if t.get("page") != "7. ⏱️ Query Profiler"]
+    if not history:
+        st.info("还没有记录。先去其它页面操作几次，再回到这里查看。")
+        return
+
+    # 1. 每个 rerun 的汇总
+    st.markdown("### Rerun Totals")
+    df_runs = pd.DataFrame([query_profiler.summarize(t) for t in history])
+    st.dataframe(df_runs.iloc[::-1], column_config={
+        "total_ms": st.column_config.NumberColumn("Total (ms)", format="%.0f"),
+        "db_ms": st.column_config.NumberColumn("DB (ms)", format="%.0f"),
+        "ai_ms": st.column_config.NumberColumn("AI (ms)", format="%.0f"),
+        "db_bytes": st.column_config.NumberColumn("DB bytes", format="%d"),
+    }, hide_index=True, width="stretch")
+
+    st.markdown("### Per-Page Average")
+    st.dataframe(df_runs.groupby("page")[["total_ms", "db_calls", "db_ms", "ai_ms"]].mean().round(0).reset_index(),
+                 hide_index=True, width="stretch")
+
+    # 2. 最慢的查询
+    events = [dict(e, page=t["page"]) for t in history for e in t["events"]]
+    st.markdown("### Slowest Calls")
+    if events:
+        df_ev = pd.DataFrame(events).sort_values("latency_ms", ascending=False)
+        st.dataframe(df_ev[["page", "kind", "target", "detail", "rows", "bytes", "latency_ms", "error"]].head(25),
+                     column_config={"latency_ms": st.column_config.NumberColumn("ms", format="%.0f")},
+                     hide_index=True, width="stretch")
+    else:
+        st.info("No calls recorded.")
+
+    # 3. N+1 模式：同一形状的查询在一个 rerun 里重复出现
+    st.markdown("### N+1 Patterns")
+    n1 = [dict(p, page=t["page"]) for t in history for p in query_profiler.find_n_plus_one(t)]
+    if n1:
+        st.warning(f"⚠️ 发现 {len(n1)} 处重复查询模式 (同一 rerun 内 ≥ {query_profiler.N_PLUS_ONE_THRESHOLD} 次)")
+        st.dataframe(pd.DataFrame(n1).drop_duplicates(["page", "table", "shape"]), hide_index=True, width="stretch")
+    else:
+        st.success("✅ No N+1 patterns detected.")
+
+    # 4. 导出
+    st.download_button("⬇️ Export JSON", json.dumps(history, default=str, indent=1).encode("utf-8"),
+                       "query_profile.json", "application/json")
+    if st.button("🗑️ Clear History"):
+        st.session_state["_profile_history"] = []
+        st.rerun()
+
+
+# --- 4. Analytics Snapshot (本地 Parquet 快照) ---
+def view_snapshot_admin():
+    import snapshot
+
+    st.title("🗃️ Admin: Analytics Snapshot")
+    st.caption("把事实表增量同步成本地 Parquet (按 forest / year 分区)。Dashboard、预测和差异分析读取已结账月份时直接用快照，本月仍实时查询。")
+
+    if not snapshot.available():
+        st.error("pyarrow 未安装，快照不可用 (所有页面继续实时查询)。")
+        return
+
+    st.dataframe(pd.DataFrame(snapshot.status()), column_config={
+        "size_mb": st.column_config.NumberColumn("Size (MB)", format="%.2f"),
+    }, hide_index=True, width="stretch")
+    st.caption(f"📁 `{snapshot.SNAPSHOT_DIR.resolve()}` | 本月 ({snapshot.open_month()[:7]}) 起的数据始终走实时查询")
+
+    c1, c2 = st.columns(2)
+    full = c2.checkbox("Full rebuild (清空后重建)", value=False)
+    if c1.button("🔄 Sync Snapshot", type="primary"):
+        with st.spinner("正在同步..."):
+            try:
+                report = snapshot.sync(full=full)
+            except Exception as e:
+                st.error(f"同步失败: {e}")
+                return
+        st.success("✅ 同步完成")
+        st.dataframe(pd.DataFrame([dict(table=t, **r) for t, r in report.items()]), hide_index=True, width="stretch")
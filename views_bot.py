@@ -1,9 +1,29 @@
 import streamlit as st
 import pandas as pd
 import time
+import uuid
 import backend 
+import blob_store
+import invoice_jobs
+
+# 档案列表展示的列 (不取 id)
+ARCHIVE_COLS = ["invoice_date", "vendor", "invoice_no", "description", "amount", "status", "file_name", "file_url"]
 
 # --- 1. Invoice Bot ---
+def job_owner():
+    """
+    任务归属：登录用户用邮箱；未启用登录时每个浏览器会话生成一个随机 owner，和 job id 一样记在 URL 里，
+    刷新页面后仍能看到自己的任务，但看不到别人的
+    """
+    try:
+        if st.user.is_logged_in and st.user.get("email"): return st.user["email"]
+    except Exception:
+        pass  # 未配置 [auth]
+    owner = st.session_state.get('invoice_owner') or st.query_params.get("owner") or uuid.uuid4().hex
+    st.session_state['invoice_owner'] = owner
+    if st.query_params.get("owner") != owner: st.query_params["owner"] = owner
+    return owner
+
 def view_invoice_bot():
     st.title("🤖 Invoice Bot (Audit & Archive)")
     
@@ -15,35 +35,54 @@ def view_invoice_bot():
     
     with tab_audit:
         # [Upload Section]
+        # 识别在后台任务队列里跑 (invoice_jobs)，页面 rerun / 刷新不会中断；当前任务 id 记在 URL 里
+        invoice_jobs.start_workers()
+        owner = job_owner()
         st.subheader("1. Upload Invoices")
         uploaded_files = st.file_uploader("Drag PDFs here", type=["pdf"], accept_multiple_files=True)
         
         if uploaded_files:
+            # 提交前按内容哈希查档案：整份已归档过的 PDF 默认跳过，不再花 AI 费用
+            archived = archived_uploads(uploaded_files)
+            skip_archived = False
+            if archived:
+                st.warning(f"{len(archived)} file(s) were already archived: " + ", ".join(f"`{n}`" for n in archived))
+                skip_archived = st.checkbox("Skip files already in the archive", value=True)
             if st.button("🚀 Start AI Analysis", type="primary"):
-                results = []
-                progress_bar = st.progress(0)
-                status_text = st.empty()
-                total_files = len(uploaded_files)
-                
-                for i, file in enumerate(uploaded_files):
-                    status_text.markdown(f"**Analyzing {i+1}/{total_files}:** `{file.name}`...")
-                    
-                    # 1. Backend Call
-                    data_list = backend.real_extract_invoice_data(file)
-                    
-                    # 2. Re-attach file object
-                    for item in data_list:
-                        item['file_obj'] = file
-                        
-                    results.extend(data_list)
-                    progress_bar.progress((i + 1) / total_files)
-                
-                progress_bar.progress(100)
-                status_text.success("✅ Analysis Complete!")
-                time.sleep(1)
-                status_text.empty()
-                progress_bar.empty()
-                st.session_state['ocr_results'] = results
+                to_submit = [f for f in uploaded_files if not (skip_archived and f.name in archived)]
+                if not to_submit:
+                    st.info("Nothing to analyze: every file is already archived.")
+                    st.stop()
+                hashes = st.session_state.get("_upload_hashes", {})
+                job_id = invoice_jobs.submit([(f.name, f, hashes.get(upload_key(f))) for f in to_submit], owner=owner)
+                st.session_state['invoice_job'] = job_id
+                st.session_state.pop('ocr_results', None)
+                st.query_params["job"] = job_id
+
+        job_id = st.session_state.get('invoice_job') or st.query_params.get("job")
+        recent = invoice_jobs.list_jobs(owner)
+        if recent:
+            with st.expander("🗂️ Recent analysis jobs"):
+                labels = {j["job_id"]: f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(j['created_at']))} · "
+                                       f"{j['total']} file(s) · {'finished' if j['finished'] else 'running'}" for j in recent}
+                ids = list(labels)
+                picked = st.selectbox("Open job", ids, index=ids.index(job_id) if job_id in ids else 0, format_func=labels.get)
+                if st.button("Open") and picked != job_id:
+                    job_id = st.session_state['invoice_job'] = picked
+                    st.session_state.pop('ocr_results', None)
+                    st.query_params["job"] = picked
+
+        if job_id:
+            st.session_state['invoice_job'] = job_id
+            status = invoice_jobs.job_status(job_id, owner)
+            if status is None:
+                st.warning("This analysis job no longer exists.")
+                st.session_state.pop('invoice_job', None)
+            elif not status["finished"]:
+                show_job_progress(job_id)
+            elif st.session_state.get('ocr_results_job') != job_id:
+                st.session_state['ocr_results'] = invoice_jobs.job_results(job_id)
+                st.session_state['ocr_results_job'] = job_id
 
         st.divider()
 
@@ -52,48 +91,7 @@ def view_invoice_bot():
         
         if 'ocr_results' in st.session_state:
             results = st.session_state['ocr_results']
-            reconcile_data = []
-            
-            for i, item in enumerate(results):
-                # Init Variables
-                match_status = "❌ Not Found"
-                db_amount = 0.0
-                diff = 0.0
-                
-                if item.get("vendor_detected") == "Error":
-                    match_status = "❌ AI Error"
-                else:
-                    # --- [关键修改] 增加 try-except 异常捕获 ---
-                    try:
-                        # Database Match
-                        acts = backend.supabase.table("dim_cost_activities").select("id").ilike("activity_name", f"%{item['vendor_detected']}%").execute().data
-                        if acts:
-                            act_id = acts[0]['id']
-                            costs = backend.supabase.table("fact_operational_costs").select("total_amount")\
-                                .eq("activity_id", act_id).eq("record_type", "Actual").execute().data
-                            
-                            if costs:
-                                db_amount = float(costs[0]['total_amount'])
-                                diff = float(item['amount_detected']) - db_amount
-                                if abs(diff) < 1.0: match_status = "✅ Match"
-                                else: match_status = "⚠️ Variance"
-                    except Exception as e:
-                        # 如果数据库请求失败，记录错误但不崩溃
-                        match_status = "⚠️ Net Error"
-                        # 可选：在后台打印错误信息
-                        print(f"Supabase connection error for {item.get('filename')}: {e}")
-                    # ----------------------------------------
-
-                reconcile_data.append({
-                    "Select": False, "Index": i,
-                    "File": item.get('filename'), 
-                    "Vendor": item.get('vendor_detected'),
-                    "Date": item.get('invoice_date'),
-                    "Desc": item.get('description'),
-                    "Inv #": item.get('invoice_no', ''), 
-                    "Inv Amount": item.get('amount_detected', 0), 
-                    "ERP Amount": db_amount, "Diff": diff, "Status": match_status
-                })
+            reconcile_data = backend.reconcile_invoices(results)
             
             df_rec = pd.DataFrame(reconcile_data)
             
@@ -104,6 +102,9 @@ def view_invoice_bot():
                 df_rec["ERP Amount"] = df_rec["ERP Amount"].astype(float)
                 df_rec["Diff"] = df_rec["Diff"].astype(float)
 
+                n_dup = int((df_rec["Duplicate"] != "").sum())
+                if n_dup: st.warning(f"⚠️ {n_dup} invoice(s) look like duplicates of archived or repeated invoices — see the Duplicate column.")
+
                 edited_df = st.data_editor(
                     df_rec, 
                     column_config={
@@ -114,27 +115,29 @@ def view_invoice_bot():
                         "Inv Amount": st.column_config.NumberColumn(format="$%.2f"),
                         "ERP Amount": st.column_config.NumberColumn(format="$%.2f"),
                         "Diff": st.column_config.NumberColumn(format="$%.2f"),
+                        "Duplicate": st.column_config.TextColumn("Duplicate?", width="medium"),
                     },
                     hide_index=True, width="stretch"
                 )
                 
+                allow_dup = st.checkbox("Archive duplicates anyway", value=False) if n_dup else False
                 if st.button("💾 Confirm & Save"):
                     save_status = st.empty()
                     selected_rows = edited_df[edited_df["Select"] == True]
+                    # 已在档案里的 (exact / same PDF) 默认不再上传、不再写入
+                    blocked = selected_rows["Duplicate"].str.startswith(("exact", "same PDF"))
+                    if blocked.any() and not allow_dup:
+                        st.warning(f"Skipped {int(blocked.sum())} duplicate invoice(s): " + ", ".join(selected_rows.loc[blocked, "Inv #"].astype(str)))
+                        selected_rows = selected_rows[~blocked]
                     
                     if not selected_rows.empty:
                         save_status.info("Saving...")
                         for idx, row in selected_rows.iterrows():
                             try:
                                 original_item = results[row['Index']]
-                                file_obj = original_item['file_obj']
-                                file_obj.seek(0)
-                                
-                                path = f"{int(time.time())}_{row['Index']}_{row['File']}"
-                                backend.supabase.storage.from_("invoices").upload(path, file_obj.read(), {"content-type": "application/pdf"})
-                                public_url = backend.supabase.storage.from_("invoices").get_public_url(path)
+                                public_url = archive_file(original_item['job_id'], original_item['file_idx'])
                                 
-                                backend.supabase.table("invoice_archive").insert({
+                                backend.archive_invoice({
                                     "invoice_no": row['Inv #'], 
                                     "vendor": row['Vendor'], 
                                     "invoice_date": str(row['Date'].date()) if pd.notnull(row['Date']) else None,
@@ -143,7 +146,7 @@ def view_invoice_bot():
                                     "file_name": row['File'], 
                                     "file_url": public_url, 
                                     "status": "Verified"
-                                }).execute()
+                                })
                             except Exception as e:
                                 st.error(f"Error saving {row['File']}: {e}")
                         
@@ -151,19 +154,18 @@ def view_invoice_bot():
                     else:
                         st.warning("No invoices selected.")
         else:
-            if uploaded_files: st.info("Click 'Start AI Analysis' above.")
+            if uploaded_files and not job_id: st.info("Click 'Start AI Analysis' above.")
 
     with tab_archive:
         st.subheader("🗄️ Invoice Digital Cabinet")
         search = st.text_input("Search Vendor/Invoice #")
         try:
-            query = backend.supabase.table("invoice_archive").select("*").order("created_at", desc=True)
-            if search: query = query.or_(f"vendor.ilike.%{search}%,invoice_no.ilike.%{search}%")
-            res = query.execute().data
-            if res:
-                df_archive = pd.DataFrame(res)
-                if "invoice_date" in df_archive.columns:
-                     df_archive["invoice_date"] = pd.to_datetime(df_archive["invoice_date"], errors='coerce')
+            def archive_query(q):
+                q = q.order("created_at", desc=True)
+                return q.or_(f"vendor.ilike.%{search}%,invoice_no.ilike.%{search}%") if search else q
+            df_archive = backend.fetch_frame("invoice_archive", ARCHIVE_COLS, archive_query, compact=True)
+            if not df_archive.empty:
+                df_archive["invoice_date"] = pd.to_datetime(df_archive["invoice_date"], errors='coerce')
 
                 st.dataframe(df_archive, column_config={
                     "file_url": st.column_config.LinkColumn("Link", display_text="Download"),
@@ -173,6 +175,56 @@ def view_invoice_bot():
             else: st.info("No archives.")
         except Exception as e: st.error(f"Error loading archive: {e}")
 
+def upload_key(f):
+    return getattr(f, "file_id", None) or (f.name, f.size)
+
+def archived_uploads(uploaded_files):
+    """
+    已归档过的上传文件名 (按内容哈希比对)；哈希按 file_id 缓存在会话里，rerun 不重复计算，
+    提交任务时也直接交给 blob_store.put，每个上传文件只算一次哈希
+    """
+    hashes = st.session_state.setdefault("_upload_hashes", {})
+    try: idx = backend.duplicate_index()
+    except Exception as e:
+        print(f"Duplicate index error: {e}")
+        return []
+    out = []
+    for f in uploaded_files:
+        key = upload_key(f)
+        if key not in hashes: hashes[key] = blob_store.content_hash(f)
+        if idx.archived_file(hashes[key]): out.append(f.name)
+    return out
+
+def archive_file(job_id, file_idx):
+    """
+    把任务里的一个 PDF 上传到存储并返回 URL。同一文件 (一个 PDF 拆出的多张发票) 只上传一次，
+    路径按内容哈希命名；上传后本地 blob 释放，之后再归档直接复用 URL。
+    """
+    ref = invoice_jobs.file_ref(job_id, file_idx)
+    if ref is None: raise ValueError("analysis job no longer exists")
+    if ref["file_url"]: return ref["file_url"]
+    if not blob_store.exists(ref["blob"]): raise ValueError("uploaded file is no longer available")
+    path = f"{ref['blob'][:16]}_{ref['file_name']}"
+    bucket = backend.supabase.storage.from_("invoices")
+    bucket.upload(path, str(blob_store.path(ref["blob"])), {"content-type": "application/pdf", "upsert": "true"})
+    public_url = bucket.get_public_url(path)
+    invoice_jobs.mark_archived(job_id, file_idx, public_url)
+    return public_url
+
+@st.fragment(run_every=2)
+def show_job_progress(job_id):
+    """每 2 秒只重跑这一小块轮询任务进度；全部完成后整页 rerun 进入 Review"""
+    status = invoice_jobs.job_status(job_id)
+    if status is None or status["finished"]:
+        st.rerun()
+    done = status["done"] + status["failed"] + status["cancelled"]
+    st.progress(done / max(status["total"], 1))
+    current = f" — analyzing `{'`, `'.join(status['current'])}`" if status["current"] else ""
+    st.markdown(f"**Analyzing {done}/{status['total']}**{current}")
+    st.caption("Runs in the background: you can leave this page or refresh, the job keeps going.")
+    if st.button("⏹️ Cancel remaining files"):
+        invoice_jobs.cancel(job_id)
+
 # --- 2. Debug Models ---
 def view_debug_models():
     st.title("🛠️ Google Model Debugger")
@@ -180,12 +232,12 @@ def view_debug_models():
         st.error("❌ Google API Key not found in secrets!")
         return
 
-    import google.generativeai as genai
+    genai = backend.load_genai()
     genai.configure(api_key=st.secrets["google"]["api_key"])
     st.write("Checking available models...")
     try:
         models = list(genai.list_models())
         chat_models = [m for m in models if 'generateContent' in m.supported_generation_methods]
         st.success(f"✅ Found {len(chat_models)} models:")
-        st.dataframe(pd.DataFrame([{"Model": m.name} for m in chat_models]), use_container_width=True)
+        st.dataframe(pd.DataFrame([{"Model": m.name} for m in chat_models]), width="stretch")
     except Exception as e: st.error(f"❌ Connection Failed: {str(e)}")
\ No newline at end of file
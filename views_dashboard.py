@@ -5,6 +5,7 @@ import plotly.graph_objects as go
 import streamlit.components.v1 as components
 from datetime import date
 import backend 
+import json
 import time
 
 MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
@@ -43,6 +44,39 @@ def calculate_invoice_context(df_sales, df_costs, mgmt_fee_pct):
         "total_due": total_due
     }
 
+# --- 差异下钻 (Dashboard / Analysis 共用) ---
+def render_variance_drilldown(cube, measure, months, key, forest=None, top_n=None):
+    var = backend.cube_variance(cube, 'item', measure, months=months, forest=forest)
+    if var.empty:
+        st.info("No Budget/Actual data for this period.")
+        return
+    var = var.reindex(var['Variance'].abs().sort_values(ascending=False).index)
+    if top_n: var = var.head(top_n)
+
+    st.dataframe(var, column_config={
+        "item": "Item",
+        "Budget": st.column_config.NumberColumn(format="$%.0f"),
+        "Actual": st.column_config.NumberColumn(format="$%.0f"),
+        "Variance": st.column_config.NumberColumn(format="$%.0f"),
+        "Var %": st.column_config.NumberColumn(format="%.1f%%"),
+    }, hide_index=True, width="stretch")
+
+    chart_df = var.melt(id_vars='item', value_vars=['Budget', 'Actual'], var_name='Type', value_name='Amount')
+    fig = px.bar(chart_df, x='item', y='Amount', color='Type', barmode='group', title=f"{measure}: Budget vs Actual")
+    st.plotly_chart(fig, width="stretch", key=f"{key}_bar")
+
+    # 下钻：选中一个项目，看全年月度趋势
+    item = st.selectbox("Drill down", ["—"] + var['item'].astype(str).tolist(), key=f"{key}_drill")
+    if item != "—":
+        trend = backend.cube_variance(cube, 'month_no', measure, item=item, forest=forest)
+        trend['month'] = trend['month_no'].map(lambda m: MONTHS[int(m) - 1])
+        fig_t = go.Figure()
+        fig_t.add_bar(x=trend['month'], y=trend['Budget'], name="Budget")
+        fig_t.add_bar(x=trend['month'], y=trend['Actual'], name="Actual")
+        fig_t.add_scatter(x=trend['month'], y=trend['Variance'], name="Variance", mode="lines+markers")
+        fig_t.update_layout(barmode="group", title=f"{item} — monthly", height=350)
+        st.plotly_chart(fig_t, width="stretch", key=f"{key}_trend")
+
 # --- 1. Dashboard (保持原有功能) ---
 def view_dashboard():
     st.title("📊 Executive Dashboard")
@@ -52,41 +86,28 @@ def view_dashboard():
         st.warning("正在连接数据库或数据库为空...")
         return
     
+    years = backend.get_available_years()
     c1, c2 = st.columns([2, 1])
     with c1: 
         sel_forest = st.selectbox("Forest", ["ALL"] + [f['name'] for f in forests])
     with c2: 
-        sel_year = st.selectbox("Year", [2025, 2026])
+        sel_year = st.selectbox("Year", years, index=backend.default_year_index(years))
+
+    if sel_forest == "ALL":
+        view_consolidated(forests, sel_year)
+        return
     
     try:
-        # 简化的 Dashboard 逻辑，主要关注 Actual
-        q_vol = backend.supabase.table("fact_production_volume").select("*").eq("record_type", "Actual")
-        if sel_forest != "ALL":
-            fid = next(f['id'] for f in forests if f['name'] == sel_forest)
-            q_vol = q_vol.eq("forest_id", fid)
-        vol_data = q_vol.execute().data
-        df_vol = pd.DataFrame(vol_data)
-
-        q_cost = backend.supabase.table("fact_operational_costs").select("*").eq("record_type", "Actual")
-        if sel_forest != "ALL":
-            if 'fid' in locals(): q_cost = q_cost.eq("forest_id", fid)
-            else: 
-                fid = next(f['id'] for f in forests if f['name'] == sel_forest)
-                q_cost = q_cost.eq("forest_id", fid)
-
-        cost_data = q_cost.execute().data
-        df_cost = pd.DataFrame(cost_data)
-
-        rev = 0; cost = 0
-        if not df_vol.empty:
-            df_vol['month'] = pd.to_datetime(df_vol['month'])
-            df_vol = df_vol[df_vol['month'].dt.year == sel_year]
-            rev = df_vol['amount'].sum()
-        
-        if not df_cost.empty:
-            df_cost['month'] = pd.to_datetime(df_cost['month'])
-            df_cost = df_cost[df_cost['month'].dt.year == sel_year]
-            cost = df_cost['total_amount'].sum()
+        # 单林地：主要关注 Actual；与下方预测共用全年事实缓存 (有快照时读本地 Parquet)
+        fid = next(f['id'] for f in forests if f['name'] == sel_forest)
+
+        # 该林地两张事实表的全年数据 (之后的预测 / 差异立方体直接命中同一缓存)
+        def actual_total(table, col):
+            d = backend.load_year_facts(table, fid, sel_year)
+            return float(d.loc[d['record_type'] == 'Actual', col].sum()) if not d.empty else 0.0
+
+        rev = actual_total("fact_production_volume", "amount")
+        cost = actual_total("fact_operational_costs", "total_amount")
             
         margin = rev - cost
 
@@ -95,97 +116,211 @@ def view_dashboard():
         k2.metric("Total Costs", f"${cost:,.0f}")
         k3.metric("Net Profit", f"${margin:,.0f}", delta=f"{(margin/rev*100) if rev else 0:.1f}%")
 
+        # --- Forecast at Completion (Actual 至今 + 剩余 Budget) ---
+        st.divider()
+        fc = backend.get_forecast(fid, sel_year)
+        fc_monthly, fc_tot, cutoff = fc['monthly'], fc['totals'], fc['cutoff_month']
+
+        st.subheader("🔮 Full-Year Forecast")
+        st.caption(f"Actuals through {MONTHS[cutoff-1] if cutoff else '—'}, Budget for the remaining months.")
+        f1, f2, f3, f4 = st.columns(4)
+        f1.metric("Forecast Revenue", f"${fc_tot['revenue']:,.0f}", delta=f"${fc_tot['revenue'] - fc_tot['budget_revenue']:,.0f} vs Budget")
+        f2.metric("Forecast Costs", f"${fc_tot['cost']:,.0f}", delta=f"${fc_tot['cost'] - fc_tot['budget_cost']:,.0f} vs Budget", delta_color="inverse")
+        f3.metric("Forecast Margin", f"${fc_tot['margin']:,.0f}", delta=f"${fc_tot['margin'] - fc_tot['budget_margin']:,.0f} vs Budget")
+        f4.metric("Forecast Volume (t)", f"{fc_tot['volume']:,.0f}")
+
+        fig = go.Figure()
+        fig.add_bar(x=fc_monthly['month'], y=fc_monthly['revenue'], name="Revenue")
+        fig.add_bar(x=fc_monthly['month'], y=fc_monthly['cost'], name="Cost")
+        fig.add_scatter(x=fc_monthly['month'], y=fc_monthly['margin'], name="Margin", mode="lines+markers")
+        if cutoff: fig.add_vline(x=cutoff - 0.5, line_dash="dot", annotation_text="Forecast →")
+        fig.update_layout(barmode="group", height=380, margin=dict(t=30))
+        st.plotly_chart(fig, width="stretch")
+
+        # --- YTD 成本差异 (与 Analysis 页面共用差异立方体) ---
+        with st.expander("📉 YTD Cost Variance by Activity"):
+            ytd_months = list(range(1, max(cutoff, 1) + 1))
+            render_variance_drilldown(backend.get_variance_cube([fid], sel_year), "Cost", ytd_months, key="dash_cost", top_n=15)
+
         st.divider()
         st.info("💡 提示：更详细的净额结算和发票生成，请前往 'Analysis & Invoice' 页面。")
 
     except Exception as e:
         st.error(f"Dashboard Error: {e}")
 
+# --- 1b. 多林地合并 Dashboard ("ALL") ---
+# 全部来自一张 forest × month × record_type 聚合表 (backend.get_consolidated)：两次查询、一张 facet 图，与林地数量无关。
+SMALL_MULTIPLE_COLS = 4
+
+def view_consolidated(forests, year):
+    forest_names = {f['id']: f['name'] for f in forests}
+    try:
+        agg = backend.get_consolidated(list(forest_names), year)
+        if agg.empty:
+            st.info(f"No data for {year}.")
+            return
+        act = agg[agg['record_type'] == 'Actual']
+        rev, cost = float(act['revenue'].sum()), float(act['cost'].sum())
+        margin = rev - cost
+
+        k1, k2, k3 = st.columns(3)
+        k1.metric("Total Revenue (Est)", f"${rev:,.0f}")
+        k2.metric("Total Costs", f"${cost:,.0f}")
+        k3.metric("Net Profit", f"${margin:,.0f}", delta=f"{(margin/rev*100) if rev else 0:.1f}%")
+
+        # --- 全年预测 (逐林地截止月，再合并) ---
+        st.divider()
+        fc_monthly, cutoffs = backend.consolidated_forecast(agg)
+        bud = agg[agg['record_type'] == 'Budget']
+        f1, f2, f3, f4 = st.columns(4)
+        f1.metric("Forecast Revenue", f"${fc_monthly['revenue'].sum():,.0f}", delta=f"${fc_monthly['revenue'].sum() - bud['revenue'].sum():,.0f} vs Budget")
+        f2.metric("Forecast Costs", f"${fc_monthly['cost'].sum():,.0f}", delta=f"${fc_monthly['cost'].sum() - bud['cost'].sum():,.0f} vs Budget", delta_color="inverse")
+        f3.metric("Forecast Margin", f"${fc_monthly['margin'].sum():,.0f}", delta=f"${fc_monthly['margin'].sum() - bud['margin'].sum():,.0f} vs Budget")
+        f4.metric("Forecast Volume (t)", f"{fc_monthly['volume'].sum():,.0f}")
+        cutoff = max(cutoffs.values(), default=0)
+        st.caption(f"Each forest uses its own Actuals (latest through {MONTHS[cutoff-1] if cutoff else '—'}) and Budget for the remaining months.")
+
+        # --- 逐林地 Budget vs Actual ---
+        st.subheader("🌲 By Forest")
+        scope = st.radio("Period", ["YTD", "Full Year"], horizontal=True, key="cons_scope")
+        months = list(range(1, max(cutoff, 1) + 1)) if scope == "YTD" else None
+        summary = backend.consolidated_summary(agg, forest_names, months)
+        money = {c: st.column_config.NumberColumn(format="$%.0f") for c in summary.columns if c != 'Forest'}
+        st.dataframe(summary, column_config=money, hide_index=True, width="stretch")
+
+        # --- 小多图：每个林地一个子图 (一张 facet 图)，Actual vs Budget 按月 ---
+        measure = st.radio("Chart", ["Margin", "Revenue", "Cost"], horizontal=True, key="cons_measure")
+        long = agg[agg['record_type'].isin(['Actual', 'Budget'])].assign(
+            forest=lambda d: d['forest_id'].map(forest_names).fillna('Unknown'),
+            month=lambda d: d['month_no'].map(lambda m: MONTHS[m - 1]))
+        n_rows = -(-long['forest'].nunique() // SMALL_MULTIPLE_COLS)
+        fig = px.line(long.sort_values(['forest', 'month_no']), x='month', y=measure.lower(), color='record_type',
+                      facet_col='forest', facet_col_wrap=SMALL_MULTIPLE_COLS, facet_row_spacing=0.08,
+                      category_orders={"month": MONTHS}, markers=True, height=max(260 * n_rows, 300))
+        fig.for_each_annotation(lambda a: a.update(text=a.text.split("=")[-1]))
+        fig.update_yaxes(matches=None, showticklabels=True, title=None)
+        fig.update_xaxes(title=None)
+        fig.update_layout(margin=dict(t=40), legend_title_text=None)
+        st.plotly_chart(fig, width="stretch")
+
+        # 活动级差异需要逐林地的明细事实，按需加载
+        if st.toggle("📉 Show YTD cost variance by activity (loads detail for every forest)", key="cons_cube"):
+            render_variance_drilldown(backend.get_variance_cube(list(forest_names), year), "Cost",
+                                      list(range(1, max(cutoff, 1) + 1)), key="cons_cost", top_n=15)
+
+    except Exception as e:
+        st.error(f"Dashboard Error: {e}")
+
 # --- 2. Analysis & Invoice (全面升级版) ---
+def load_invoice_data(fid, year, month_no):
+    """拉取某林地某月的 GL 映射、销售明细和 Actual 成本，并展平名称、套上 GL Code"""
+    target_date = f"{year}-{month_no:02d}-01"
+
+    # 销售按月筛选：计算月末 (简单处理)
+    start_date = target_date
+    if month_no == 12: end_date = f"{year+1}-01-01"
+    else: end_date = f"{year}-{month_no+1:02d}-01"
+
+    # 1. GL Mappings  2. 销售数据 (Log Sales Transactions)  3. 成本数据 (Actual Costs) —— 三个查询互不依赖，并发发出
+    res = backend.fetch_parallel({
+        "gl": lambda: backend.get_gl_mapping(fid),
+        "sales": lambda: backend.fetch_frame(
+            "actual_sales_transactions", ["grade_id", "sale_type", "total_value", "dim_products(grade_code)"],
+            lambda q: q.eq("forest_id", fid).gte("date", start_date).lt("date", end_date), compact=True),
+        "costs": lambda: backend.fetch_frame(
+            "fact_operational_costs", ["activity_id", "total_amount", "dim_cost_activities(activity_name)"],
+            lambda q: q.eq("forest_id", fid).eq("month", target_date).eq("record_type", "Actual"), compact=True),
+    })
+    cost_map, rev_map = res["gl"]
+    df_sales, df_costs = res["sales"], res["costs"]
+
+    # 数据预处理：嵌入的名称列已展平 (activity_name / grade_code)，再套上 GL Code
+    if not df_costs.empty:
+        df_costs['activity'] = df_costs['activity_name'].astype(object).fillna('Unknown')
+        # 应用 GL Mapping
+        def apply_gl_cost(row):
+            act_id = row['activity_id']
+            mapping = cost_map.get(act_id) # 假设 map key 是 int
+            if mapping: return mapping['code'], mapping['name']
+            return "UNMAPPED", row['activity']
+
+        df_costs[['gl_code', 'gl_desc']] = df_costs.apply(lambda row: pd.Series(apply_gl_cost(row)), axis=1)
+
+    if not df_sales.empty:
+        df_sales['grade'] = df_sales['grade_code'].astype(object).fillna('Unknown')
+        # 应用 GL Mapping (Revenue)
+        def apply_gl_rev(row):
+            gid = row['grade_id']
+            mapping = rev_map.get(gid)
+            if mapping: return mapping['code'], mapping['name']
+            return "UNMAPPED", f"Log Sales - {row['grade']}"
+
+        df_sales[['gl_code', 'gl_desc']] = df_sales.apply(lambda row: pd.Series(apply_gl_rev(row)), axis=1)
+
+    return cost_map, rev_map, df_sales, df_costs
+
 def view_analysis_invoice():
     st.title("📈 Analysis & Invoicing (F360 Style)")
     
-    forests = backend.get_forest_list()
+    forests = backend.memo_query("forests", (), backend.get_forest_list)
     if not forests: return
     
     # --- A. 筛选栏 ---
     c1, c2, c3 = st.columns([2, 1, 1])
     with c1: sel_forest = st.selectbox("Forest", [f['name'] for f in forests], key="inv_f")
-    with c2: year = st.selectbox("Year", [2025, 2026], key="inv_y")
+    with c2:
+        years = backend.get_available_years()
+        year = st.selectbox("Year", years, index=backend.default_year_index(years), key="inv_y")
     with c3: month_str = st.selectbox("Month", MONTHS, key="inv_m")
     
     fid = next(f['id'] for f in forests if f['name'] == sel_forest)
     target_date = f"{year}-{MONTH_MAP[month_str]:02d}-01"
     
     # --- B. 数据获取 (Fine Granularity) ---
+    # 已结账月份：对账单 / 财务导出直接读冻结的快照，不再拉当月明细重算
+    try: closed = backend.get_closed_period(fid, target_date)
+    except Exception as e:
+        # 查不到结账状态时不能当作未结账 (会绕过冻结)，先停在这里
+        st.error(f"Could not check whether this period is closed: {e}")
+        return
+
+    # 会话级缓存：只改 "Mgmt Fee %" / "Bill To" 等控件时不会重新查询，只重算展示层
+    # 当月明细和全年差异立方体 (含 Budget 成本) 同时拉取
     with st.spinner("Fetching Transactional Data & GL Mappings..."):
-        # 1. 获取 GL Mappings (需要 backend.py 支持 get_gl_mapping)
-        # 如果 backend 还没更新，这里做一个容错
-        try:
-            cost_map, rev_map = backend.get_gl_mapping(fid)
-        except AttributeError:
-            st.warning("⚠️ backend.py 未包含 get_gl_mapping 函数，GL 功能将不可用。")
-            cost_map, rev_map = {}, {}
-
-        # 2. 获取销售数据 (Log Sales Transactions)
-        # 注意：这里我们按月筛选，假设 transactions 里的 date 需要转换
-        # 简单起见，这里拉取当月的数据
-        start_date = target_date
-        # 计算月末 (简单处理)
-        if MONTH_MAP[month_str] == 12: end_date = f"{year+1}-01-01"
-        else: end_date = f"{year}-{MONTH_MAP[month_str]+1:02d}-01"
-
-        sales_res = backend.supabase.table("actual_sales_transactions")\
-            .select("*, dim_products(grade_code)")\
-            .eq("forest_id", fid).gte("date", start_date).lt("date", end_date).execute()
-        df_sales = pd.DataFrame(sales_res.data)
-
-        # 3. 获取成本数据 (Actual Costs)
-        cost_res = backend.supabase.table("fact_operational_costs")\
-            .select("*, dim_cost_activities(activity_name)")\
-            .eq("forest_id", fid).eq("month", target_date).eq("record_type", "Actual").execute()
-        df_costs = pd.DataFrame(cost_res.data)
-        
-        # 数据预处理：展平 Activity Name 和 Grade Code
-        if not df_costs.empty:
-            df_costs['activity'] = df_costs['dim_cost_activities'].apply(lambda x: x['activity_name'] if x else 'Unknown')
-            # 应用 GL Mapping
-            def apply_gl_cost(row):
-                act_id = row['activity_id']
-                mapping = cost_map.get(act_id) # 假设 map key 是 int
-                if mapping: return mapping['code'], mapping['name']
-                return "UNMAPPED", row['activity']
-            
-            df_costs[['gl_code', 'gl_desc']] = df_costs.apply(lambda row: pd.Series(apply_gl_cost(row)), axis=1)
-
-        if not df_sales.empty:
-            df_sales['grade'] = df_sales['dim_products'].apply(lambda x: x['grade_code'] if x else 'Unknown')
-            # 应用 GL Mapping (Revenue)
-            def apply_gl_rev(row):
-                gid = row['grade_id']
-                mapping = rev_map.get(gid)
-                if mapping: return mapping['code'], mapping['name']
-                return "UNMAPPED", f"Log Sales - {row['grade']}"
-            
-            df_sales[['gl_code', 'gl_desc']] = df_sales.apply(lambda row: pd.Series(apply_gl_rev(row)), axis=1)
+        tasks = {"cube": lambda: backend.get_variance_cube([fid], year)}
+        if not closed:
+            tasks["invoice"] = lambda: backend.memo_query(
+                "invoice_data", (fid, target_date, "Actual"),
+                lambda: load_invoice_data(fid, year, MONTH_MAP[month_str]),
+                scopes=[("dim_gl_mappings", fid), ("actual_sales_transactions", fid, None, target_date),
+                        ("fact_operational_costs", fid, None, target_date)])
+        res = backend.fetch_parallel(tasks)
+        if not closed: cost_map, rev_map, df_sales, df_costs = res["invoice"]
 
     # --- C. 界面显示 ---
     
     tab_overview, tab_invoice, tab_finance = st.tabs(["📊 Budget Analysis", "📑 Statement Preview", "💳 Finance Export"])
     
-    # [Tab 1: Budget Analysis] (保留原有逻辑，做简单对比)
+    # [Tab 1: Budget Analysis] (差异立方体：Month / YTD, 按 Activity / Grade 下钻)
     with tab_overview:
-        # 这里为了简单，只用 Cost 对比
-        bud_costs = backend.supabase.table("fact_operational_costs").select("total_amount").eq("forest_id", fid).eq("month", target_date).eq("record_type", "Budget").execute().data
-        total_act = df_costs['total_amount'].sum() if not df_costs.empty else 0
-        total_bud = sum([x['total_amount'] for x in bud_costs]) if bud_costs else 0
-        
-        c1, c2 = st.columns(2)
+        cube = res["cube"]
+        m_no = MONTH_MAP[month_str]
+        scope = st.radio("Period", ["Month", "YTD"], horizontal=True, key="var_scope")
+        months = [m_no] if scope == "Month" else list(range(1, m_no + 1))
+
+        cost_tot = backend.cube_variance(cube, 'dim', 'Cost', months=months)
+        rev_tot = backend.cube_variance(cube, 'dim', 'Revenue', months=months)
+        vol_tot = backend.cube_variance(cube, 'dim', 'Volume', months=months)
+        total_act = cost_tot['Actual'].sum(); total_bud = cost_tot['Budget'].sum()
+
+        c1, c2, c3 = st.columns(3)
         c1.metric("Actual Costs", f"${total_act:,.0f}", delta=f"${total_bud - total_act:,.0f} (vs Budget)", delta_color="inverse")
-        
-        if not df_costs.empty:
-            fig = px.bar(df_costs, x='activity', y='total_amount', title="Cost Breakdown by Activity")
-            st.plotly_chart(fig, use_container_width=True)
+        c2.metric("Actual Revenue", f"${rev_tot['Actual'].sum():,.0f}", delta=f"${rev_tot['Actual'].sum() - rev_tot['Budget'].sum():,.0f} (vs Budget)")
+        c3.metric("Actual Volume (t)", f"{vol_tot['Actual'].sum():,.0f}", delta=f"{vol_tot['Actual'].sum() - vol_tot['Budget'].sum():,.0f} (vs Budget)")
+
+        t_act, t_grade = st.tabs(["💰 By Activity (Cost)", "🌲 By Grade (Revenue)"])
+        with t_act: render_variance_drilldown(cube, "Cost", months, key="ana_cost")
+        with t_grade: render_variance_drilldown(cube, "Revenue", months, key="ana_rev")
 
     # [Tab 2: Statement Preview (F360 Style)]
     with tab_invoice:
@@ -194,12 +329,22 @@ def view_analysis_invoice():
         col_set, col_view = st.columns([1, 3])
         with col_set:
             st.markdown("### Settings")
-            bill_to = st.text_input("Bill To", "CFG Forestry Group")
-            mgmt_fee_pct = st.number_input("Mgmt Fee %", 0.0, 20.0, 8.0, 0.5)
-            invoice_no = st.text_input("Ref No.", f"INV-{year}{MONTH_MAP[month_str]:02d}-{fid}")
-            
-            # 计算核心数据
-            ctx = calculate_invoice_context(df_sales, df_costs, mgmt_fee_pct)
+            if closed:
+                # 冻结的设置只读展示
+                stmt = closed["statement"]
+                cfg = stmt["settings"]
+                st.info(f"🔒 Period closed on {str(closed['closed_at'])[:10]}. Statement is frozen.")
+                st.text_input("Bill To", cfg["bill_to"], disabled=True)
+                st.number_input("Mgmt Fee %", value=float(cfg["mgmt_fee_pct"]), disabled=True)
+                st.text_input("Ref No.", cfg["invoice_no"], disabled=True)
+            else:
+                bill_to = st.text_input("Bill To", "CFG Forestry Group")
+                mgmt_fee_pct = st.number_input("Mgmt Fee %", 0.0, 20.0, 8.0, 0.5)
+                invoice_no = st.text_input("Ref No.", f"INV-{year}{MONTH_MAP[month_str]:02d}-{fid}")
+                
+                # 计算核心数据
+                stmt = build_statement(df_sales, df_costs, mgmt_fee_pct, invoice_no, bill_to)
+            ctx = stmt["ctx"]
             
             st.divider()
             if ctx['total_due'] > 0:
@@ -207,111 +352,32 @@ def view_analysis_invoice():
             else:
                 st.success(f"CREDIT TO CFGC\n\n${abs(ctx['total_due']):,.2f}")
 
+            # 结账：只允许已经结束的月份；结账后该月对账单不再随事实数据变化
+            if not closed and target_date < date.today().replace(day=1).isoformat():
+                st.divider()
+                if st.button("🔒 Close Period", help="Freeze this statement and finance export. Later edits to this month's facts will not change it."):
+                    try:
+                        backend.close_period(fid, target_date, stmt)
+                        st.rerun()
+                    except Exception as e:
+                        st.error(f"Close failed: {e}")
+
         with col_view:
-            st.markdown(f"### **TAX INVOICE / CREDIT NOTE**")
-            st.markdown(f"**Date:** {date.today()} | **Ref:** {invoice_no}")
-            
-            # 第一部分：Debits (Costs)
-            st.markdown("#### 1. Costs Incurred (Debits)")
-            if not df_costs.empty:
-                # 按 GL Code 或 Activity 汇总显示
-                cost_view = df_costs.groupby(['activity', 'gl_code'])['total_amount'].sum().reset_index()
-                st.dataframe(
-                    cost_view, 
-                    column_config={
-                        "total_amount": st.column_config.NumberColumn("Amount", format="$%.2f"),
-                        "gl_code": "GL Code"
-                    },
-                    hide_index=True, use_container_width=True
-                )
-            
-            # Mgmt Fee
-            st.markdown(f"**Management Fee ({mgmt_fee_pct}%):** `${ctx['mgmt_fee']:,.2f}`")
-            st.markdown(f"**Total Debits:** `${ctx['costs'] + ctx['mgmt_fee']:,.2f}`")
-            
-            st.divider()
-            
-            # 第二部分：Credits (Revenue)
-            st.markdown("#### 2. Revenue Credits (F360 Sales)")
-            if not df_sales.empty:
-                # 筛选出 Purchase 类型的销售
-                if 'sale_type' in df_sales.columns:
-                    credits_df = df_sales[df_sales['sale_type'].str.contains("Purchase", na=False, case=False)]
-                else:
-                    credits_df = df_sales
-                
-                if not credits_df.empty:
-                    rev_view = credits_df.groupby(['grade', 'gl_code'])['total_value'].sum().reset_index()
-                    st.dataframe(
-                        rev_view,
-                        column_config={
-                            "total_value": st.column_config.NumberColumn("Credit", format="$%.2f"),
-                            "gl_code": "GL Code"
-                        },
-                        hide_index=True, use_container_width=True
-                    )
-                else:
-                    st.info("No 'Purchase' type sales found (Direct Sales only).")
-            
-            st.markdown(f"**Total Credits:** `-${ctx['revenue']:,.2f}`")
-            
-            st.divider()
-            # 总结
-            st.metric("NET TOTAL (Ex GST)", f"${ctx['subtotal_ex_gst']:,.2f}")
+            render_statement(stmt)
 
     # [Tab 3: Finance Export (Killer Feature)]
     with tab_finance:
         st.subheader("💳 CFG Finance Integration")
         st.markdown("Use this file to import directly into Xero/SAP.")
+        if closed: st.caption(f"🔒 Frozen at period close ({str(closed['closed_at'])[:10]}).")
         
-        # 构造财务报表：将 Cost 和 Revenue 合并
-        finance_rows = []
-        
-        # 1. Costs
-        if not df_costs.empty:
-            grouped_costs = df_costs.groupby(['gl_code', 'gl_desc'])['total_amount'].sum().reset_index()
-            for _, row in grouped_costs.iterrows():
-                finance_rows.append({
-                    "Type": "Debit (Cost)",
-                    "GL Account": row['gl_code'],
-                    "Account Name": row['gl_desc'],
-                    "Amount": row['total_amount'],
-                    "Reference": invoice_no
-                })
-        
-        # 2. Mgmt Fee (通常也有一个固定的 GL Code)
-        finance_rows.append({
-            "Type": "Debit (Fee)",
-            "GL Account": "6000-MGMT", # 示例代码
-            "Account Name": "Management Fees",
-            "Amount": ctx['mgmt_fee'],
-            "Reference": invoice_no
-        })
-        
-        # 3. Revenue
-        if not df_sales.empty:
-            # 同样的筛选逻辑
-            if 'sale_type' in df_sales.columns:
-                sales_export = df_sales[df_sales['sale_type'].str.contains("Purchase", na=False, case=False)]
-            else:
-                sales_export = df_sales
-                
-            grouped_rev = sales_export.groupby(['gl_code', 'gl_desc'])['total_value'].sum().reset_index()
-            for _, row in grouped_rev.iterrows():
-                finance_rows.append({
-                    "Type": "Credit (Rev)",
-                    "GL Account": row['gl_code'],
-                    "Account Name": row['gl_desc'],
-                    "Amount": -row['total_value'], # 负数表示 Credit
-                    "Reference": invoice_no
-                })
-        
-        df_fin = pd.DataFrame(finance_rows)
+        df_fin = pd.DataFrame(stmt["finance_rows"])
+        invoice_no = stmt["settings"]["invoice_no"]
         
         st.dataframe(
             df_fin,
             column_config={"Amount": st.column_config.NumberColumn(format="$%.2f")},
-            use_container_width=True, hide_index=True
+            width="stretch", hide_index=True
         )
         
         if not df_fin.empty:
@@ -322,4 +388,93 @@ def view_analysis_invoice():
                 f"AP_Import_{invoice_no}.csv",
                 "text/csv",
                 type="primary"
-            )
\ No newline at end of file
+            )
+
+# --- 对账单 (Statement) 计算与展示 ---
+# build_statement 的结果只含 JSON 可序列化的值：未结账时每次 rerun 现算，结账时原样存进 closed_periods。
+def _records(df):
+    return json.loads(df.to_json(orient="records")) if not df.empty else []
+
+def _purchase_sales(df_sales):
+    """只计算 Sale Type 包含 'Purchase' 的销售 (F360 买断/代售)；旧数据没有 sale_type 时全部计入"""
+    if 'sale_type' not in df_sales.columns: return df_sales
+    return df_sales[df_sales['sale_type'].str.contains("Purchase", na=False, case=False)]
+
+def build_statement(df_sales, df_costs, mgmt_fee_pct, invoice_no, bill_to):
+    """对账单 + 财务导出需要的全部数据：ctx、按 GL 汇总的成本 / 收入明细、财务导出行、设置"""
+    ctx = {k: float(v) for k, v in calculate_invoice_context(df_sales, df_costs, mgmt_fee_pct).items()}
+    credits_df = _purchase_sales(df_sales) if not df_sales.empty else df_sales
+
+    # 1. Costs / 2. Revenue 明细 (按 GL Code 或 Activity / Grade 汇总显示)
+    cost_lines = df_costs.groupby(['activity', 'gl_code'])['total_amount'].sum().reset_index() if not df_costs.empty else pd.DataFrame()
+    rev_lines = credits_df.groupby(['grade', 'gl_code'])['total_value'].sum().reset_index() if not credits_df.empty else pd.DataFrame()
+
+    # 财务导出：将 Cost 和 Revenue 合并
+    finance_rows = []
+    if not df_costs.empty:
+        grouped_costs = df_costs.groupby(['gl_code', 'gl_desc'])['total_amount'].sum().reset_index()
+        for _, row in grouped_costs.iterrows():
+            finance_rows.append({"Type": "Debit (Cost)", "GL Account": row['gl_code'], "Account Name": row['gl_desc'],
+                                 "Amount": float(row['total_amount']), "Reference": invoice_no})
+    # Mgmt Fee (通常也有一个固定的 GL Code)
+    finance_rows.append({"Type": "Debit (Fee)", "GL Account": "6000-MGMT", "Account Name": "Management Fees",  # 示例代码
+                         "Amount": ctx['mgmt_fee'], "Reference": invoice_no})
+    if not credits_df.empty:
+        grouped_rev = credits_df.groupby(['gl_code', 'gl_desc'])['total_value'].sum().reset_index()
+        for _, row in grouped_rev.iterrows():
+            finance_rows.append({"Type": "Credit (Rev)", "GL Account": row['gl_code'], "Account Name": row['gl_desc'],
+                                 "Amount": -float(row['total_value']), "Reference": invoice_no})  # 负数表示 Credit
+
+    return {
+        "settings": {"bill_to": bill_to, "mgmt_fee_pct": float(mgmt_fee_pct), "invoice_no": invoice_no},
+        "statement_date": str(date.today()),
+        "ctx": ctx,
+        "has_sales": not df_sales.empty,
+        "cost_lines": _records(cost_lines),
+        "rev_lines": _records(rev_lines),
+        "finance_rows": finance_rows,
+    }
+
+def render_statement(stmt):
+    cfg, ctx = stmt["settings"], stmt["ctx"]
+    st.markdown("### **TAX INVOICE / CREDIT NOTE**")
+    st.markdown(f"**Date:** {stmt['statement_date']} | **Ref:** {cfg['invoice_no']}")
+    
+    # 第一部分：Debits (Costs)
+    st.markdown("#### 1. Costs Incurred (Debits)")
+    if stmt["cost_lines"]:
+        st.dataframe(
+            pd.DataFrame(stmt["cost_lines"]), 
+            column_config={
+                "total_amount": st.column_config.NumberColumn("Amount", format="$%.2f"),
+                "gl_code": "GL Code"
+            },
+            hide_index=True, width="stretch"
+        )
+    
+    # Mgmt Fee
+    st.markdown(f"**Management Fee ({cfg['mgmt_fee_pct']}%):** `${ctx['mgmt_fee']:,.2f}`")
+    st.markdown(f"**Total Debits:** `${ctx['costs'] + ctx['mgmt_fee']:,.2f}`")
+    
+    st.divider()
+    
+    # 第二部分：Credits (Revenue)
+    st.markdown("#### 2. Revenue Credits (F360 Sales)")
+    if stmt["has_sales"]:
+        if stmt["rev_lines"]:
+            st.dataframe(
+                pd.DataFrame(stmt["rev_lines"]),
+                column_config={
+                    "total_value": st.column_config.NumberColumn("Credit", format="$%.2f"),
+                    "gl_code": "GL Code"
+                },
+                hide_index=True, width="stretch"
+            )
+        else:
+            st.info("No 'Purchase' type sales found (Direct Sales only).")
+    
+    st.markdown(f"**Total Credits:** `-${ctx['revenue']:,.2f}`")
+    
+    st.divider()
+    # 总结
+    st.metric("NET TOTAL (Ex GST)", f"${ctx['subtotal_ex_gst']:,.2f}")
@@ -26,13 +26,14 @@ def view_log_sales():
     fid = next(f['id'] for f in forests if f['name'] == sel_forest)
     
     # 获取基础配置数据
-    products = backend.supabase.table("dim_products").select("*").execute().data
+    products = backend.supabase.table("dim_products").select("id,grade_code").execute().data
     product_codes = [p['grade_code'] for p in products] if products else []
     compartment_opts = get_compartment_options(fid) 
     
     # 获取现有数据
-    res = backend.supabase.table("actual_sales_transactions").select("*").eq("forest_id", fid).order("date", desc=True).limit(50).execute()
-    df = pd.DataFrame(res.data)
+    # 只取编辑器用到的列；grade_code 通过嵌入 dim_products 带回，保存时按它反查 grade_id
+    df = backend.fetch_frame("actual_sales_transactions", backend.SALES_COLS + ["dim_products(grade_code)"],
+                             lambda q: q.eq("forest_id", fid).order("date", desc=True).limit(50))
     
     # 初始化空行 (如果没数据)
     if df.empty: 
@@ -108,7 +109,7 @@ def view_log_sales():
                 "total_value": calc_total
             })
         try:
-            backend.supabase.table("actual_sales_transactions").upsert(recs).execute()
+            backend.save_sales_transactions(recs)
             st.success("Transactions Saved! (Total calculated automatically where 0)")
         except Exception as e: st.error(f"Error: {e} (Check if DB columns exist!)")
 
@@ -119,13 +120,32 @@ def view_monthly_input(mode):
     forests = backend.get_forest_list()
     if not forests: return
 
+    # Budget 支持全年矩阵模式 (一次编辑 12 个月)
+    entry_mode = "Monthly"
+    if mode == "Budget":
+        entry_mode = st.radio("Entry Mode", ["Monthly", "Year Matrix"], horizontal=True, key=f"em_{mode}")
+
     c1, c2, c3 = st.columns([2, 1, 1])
     with c1: sel_forest = st.selectbox("Forest", [f['name'] for f in forests], key=f"f_{mode}")
-    with c2: year = st.selectbox("Year", [2025, 2026], key=f"y_{mode}")
-    with c3: month_str = st.selectbox("Month", MONTHS, key=f"m_{mode}")
+    with c2:
+        years = backend.get_available_years(include_next=(mode == "Budget"))  # Budget 可以编制下一年
+        year = st.selectbox("Year", years, index=backend.default_year_index(years), key=f"y_{mode}")
+    with c3: month_str = st.selectbox("Month", MONTHS, key=f"m_{mode}", disabled=(entry_mode == "Year Matrix"))
 
     target_date = f"{year}-{MONTH_MAP[month_str]:02d}-01"
     fid = next(f['id'] for f in forests if f['name'] == sel_forest)
+
+    if entry_mode == "Year Matrix":
+        view_budget_year_matrix(fid, year)
+        return
+
+    # 已结账月份：Actual 仍可修改，但不会影响冻结的对账单
+    try: closed = backend.get_closed_period(fid, target_date) if mode == "Actual" else None
+    except Exception as e:
+        closed = None
+        st.warning(f"Could not check whether {month_str} {year} is closed: {e}")
+    if closed:
+        st.warning(f"🔒 {month_str} {year} was closed on {str(closed['closed_at'])[:10]}. Changes here will not update the frozen statement.")
     
     if mode == "Budget":
         tabs = ["📋 Sales Forecast", "🚛 Log Transport & Volume", "💰 Operational & Harvesting"]
@@ -188,31 +208,11 @@ def view_monthly_input(mode):
                      # 检查是否为空数据 (假设 total_amount sum 为 0 即未录入)
                      if df['total_amount'].sum() == 0:
                          st.info("💡 智能提示：已自动加载本月【预算单价】。请填入实际数量，系统将自动计算总额。")
-                         
-                         # 拉取 Budget 数据
-                         df_budget = backend.get_monthly_data("fact_operational_costs", "dim_cost_activities", "activity_id", "activity_name", fid, target_date, "Budget", ['unit_rate', 'total_amount'])
-                         
-                         if not df_budget.empty:
-                             # [修复点]: 使用 'activity_id' 而不是 'id'，因为 backend.get_monthly_data 重命名了列
-                             bud_rate_map = df_budget.set_index('activity_id')['unit_rate'].to_dict()
-                             
-                             # 应用逻辑
-                             for idx, row in df.iterrows():
-                                 act_name = str(row['activity_name']).lower()
-                                 is_lump_sum = any(x in act_name for x in ['road', 'construct', 'mainten', 'fee', 'lump', 'fixed', 'general'])
-                                 
-                                 # [修复点]: 使用 row['activity_id'] 获取单价
-                                 bud_rate = bud_rate_map.get(row['activity_id'], 0.0)
-                                 
-                                 if is_lump_sum:
-                                     # 一次性项目：单价置0，总额留空让用户填，数量设为1作为标记
-                                     df.at[idx, 'unit_rate'] = 0.0
-                                     df.at[idx, 'quantity'] = 1.0 
-                                 else:
-                                     # 常规项目 (Logging/Cartage)：预填预算单价
-                                     if bud_rate > 0:
-                                         df.at[idx, 'unit_rate'] = bud_rate
-                                         # Quantity 留 0 等待输入
+
+                         # 复用全年事实缓存，切换月份不再重新拉取 Budget
+                         df_year = backend.load_year_facts("fact_operational_costs", fid, year)
+                         df_budget = df_year[(df_year['record_type'] == "Budget") & (df_year['month'] == pd.Timestamp(target_date))] if not df_year.empty else df_year
+                         df = backend.prefill_actual_costs(df, df_budget, backend.get_lump_sum_flags())
 
                  # 3. 列配置 (根据发票优化)
                  cfg = {
@@ -231,16 +231,107 @@ def view_monthly_input(mode):
                  # 4. 保存 & 自动计算补全
                  if st.button("Save Costs", key=f"b2_{mode}"):
                      # 自动计算逻辑：如果用户只填了 Qty 和 Rate，没算 Total，帮他算
-                     for i, row in edited.iterrows():
-                         current_total = row['total_amount']
-                         qty = row['quantity']
-                         rate = row['unit_rate']
-                         
-                         # 只有当 Total 为 0 且有单价和数量时才自动计算 (避免覆盖用户手动输入的一次性总额)
-                         if current_total == 0 and qty > 0 and rate > 0:
-                             edited.at[i, 'total_amount'] = qty * rate
-                             
+                     edited = backend.fill_cost_totals(edited)
+
                      if backend.save_monthly_data(edited, "fact_operational_costs", "activity_id", fid, target_date, mode): 
                          st.success("Costs Saved! (Totals auto-calculated based on Rates)")
                          time.sleep(1)
-                         st.rerun()
\ No newline at end of file
+                         st.rerun()
+
+
+# --- 3. Budget Year Matrix (全年规划 + 批量保存) ---
+# 每个 tab: (事实表, 维度表, 维度 ID 列, 维度名称列, 可编辑的度量列)
+YEAR_MATRIX_TABLES = {
+    "🚛 Volume & Revenue": ("fact_production_volume", "dim_products", "grade_id", "grade_code", ['vol_tonnes', 'vol_jas', 'price_jas', 'amount']),
+    "💰 Operational Costs": ("fact_operational_costs", "dim_cost_activities", "activity_id", "activity_name", ['total_amount', 'quantity', 'unit_rate']),
+}
+
+def view_budget_year_matrix(fid, year):
+    st.caption("全年矩阵：每行一个 Grade/Activity，Jan–Dec 为列。填写 Total 后可一键分摊，保存时只写入改动过的单元格。")
+
+    tab_objs = st.tabs(list(YEAR_MATRIX_TABLES.keys()))
+    for tab_obj, (tab_name, spec) in zip(tab_objs, YEAR_MATRIX_TABLES.items()):
+        table_name, dim_table, dim_id_col, dim_name_col, measures = spec
+        with tab_obj:
+            measure = st.selectbox("Measure", measures, key=f"ym_meas_{table_name}")
+            state_key = f"ym_{table_name}_{fid}_{year}_{measure}"
+
+            # 原始矩阵只在数据版本不变时复用 (一次查询)，之后的编辑/分摊都在工作副本上进行。
+            # 别处写入过这一年 (Monthly 保存、工作簿导入、其他用户编辑) 时重新加载，避免把旧值当基准写回去
+            token = backend.data_token((table_name, fid, year))
+            state = st.session_state.get(state_key)
+            if state is None or state["token"] != token:
+                try:
+                    original = backend.get_yearly_data(table_name, dim_table, dim_id_col, dim_name_col, fid, year, "Budget", measure)
+                except Exception as e:
+                    # 加载失败不写入 session_state，下次 rerun 重新查询
+                    st.error(f"Failed to load {year} budget: {e}")
+                    continue
+                if state is not None:
+                    pending = st.session_state.get(f"{state_key}_ed_{state['rev']}") or {}
+                    if pending.get("edited_rows") or not state["work"].equals(state["original"]):
+                        st.info("This year's data changed since it was loaded; the matrix was reloaded and unsaved edits were discarded.")
+                    state.update(original=original, work=original.copy(), token=token, rev=state["rev"] + 1)
+                else:
+                    state = st.session_state[state_key] = {"original": original, "work": original.copy(), "token": token, "rev": 0}
+            if state["original"].empty:
+                st.warning("No dimension data found.")
+                continue
+
+            work = state["work"].copy()
+            work["Total"] = work[backend.MONTHS].sum(axis=1)
+
+            cfg = {
+                dim_id_col: None,
+                dim_name_col: st.column_config.TextColumn("Item", disabled=True),
+                "Total": st.column_config.NumberColumn("Total (编辑后可分摊)", format="%.2f"),
+            }
+            for m in backend.MONTHS: cfg[m] = st.column_config.NumberColumn(m, format="%.2f")
+
+            edited = st.data_editor(work, key=f"{state_key}_ed_{state['rev']}", hide_index=True, width="stretch", column_config=cfg)
+
+            # --- 分摊工具 ---
+            with st.expander("🧮 Spread Helpers"):
+                s1, s2 = st.columns([2, 1])
+                with s1:
+                    method = st.selectbox("Method", ["Flat (Total / 12)", "Seasonal Profile", "Copy Prior Year Budget", "Prior Year Actual Shape"], key=f"{state_key}_method")
+                    profile_name = st.selectbox("Profile", list(backend.SEASONAL_PROFILES.keys()), key=f"{state_key}_prof", disabled=(method != "Seasonal Profile"))
+                with s2:
+                    st.write("")
+                    apply_spread = st.button("Apply", key=f"{state_key}_apply")
+
+                if apply_spread:
+                    totals = edited.set_index(dim_id_col)["Total"].astype(float)
+                    try:
+                        if method == "Flat (Total / 12)":
+                            spread = backend.spread_flat(totals)
+                        elif method == "Seasonal Profile":
+                            spread = backend.spread_seasonal(totals, backend.SEASONAL_PROFILES[profile_name])
+                        elif method == "Copy Prior Year Budget":
+                            prior = backend.get_yearly_data(table_name, dim_table, dim_id_col, dim_name_col, fid, year - 1, "Budget", measure)
+                            spread = prior.set_index(dim_id_col)[backend.MONTHS].reindex(totals.index).fillna(0.0)
+                        else:
+                            prior = backend.get_yearly_data(table_name, dim_table, dim_id_col, dim_name_col, fid, year - 1, "Actual", measure)
+                            spread = backend.spread_seasonal(totals, backend.profile_from_matrix(prior))
+                    except Exception as e:
+                        st.error(f"Failed to load {year - 1} data: {e}")
+                        spread = None
+
+                    if spread is not None:
+                        new_work = edited.drop(columns=["Total"]).set_index(dim_id_col)
+                        new_work[backend.MONTHS] = spread.reindex(new_work.index).fillna(0.0).to_numpy()
+                        state["work"] = new_work.reset_index()
+                        state["rev"] += 1
+                        st.rerun()
+
+            if st.button("💾 Save Year", key=f"{state_key}_save", type="primary"):
+                to_save = edited.drop(columns=["Total"])
+                ok, n = backend.save_yearly_data(state["original"], to_save, table_name, dim_id_col, fid, year, "Budget", measure)
+                if ok:
+                    # 保存成功后，当前值即为新的基准
+                    state["original"] = to_save.copy()
+                    state["work"] = to_save.copy()
+                    state["token"] = backend.data_token((table_name, fid, year))
+                    st.success(f"Saved {n} changed cells.")
+                else:
+                    st.error("Save failed.")